@@ -0,0 +1,30 @@
+import argparse
+import os
+import torch
+from models.segment_anything_samus.modeling import slim_apg_state_dict
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Drop the unused AutoPromptGenerator weights from a SAMUS checkpoint')
+    parser.add_argument('input', type=str, help='full SAMUS checkpoint (state dict), e.g. saved by train.py')
+    parser.add_argument('output', type=str, help='slim checkpoint, to be loaded with --slim_apg')
+    args = parser.parse_args()
+
+    checkpoint = torch.load(args.input, map_location='cpu')
+    #------when the load model is saved under multiple GPU
+    new_state_dict = {}
+    for k,v in checkpoint.items():
+        if k[:7] == 'module.':
+            new_state_dict[k[7:]] = v
+        else:
+            new_state_dict[k] = v
+    slim_state_dict = slim_apg_state_dict(new_state_dict)
+
+    dropped = sum(v.numel() for k, v in new_state_dict.items() if k not in slim_state_dict)
+    print("dropped", len(new_state_dict) - len(slim_state_dict), "tensors,", dropped, "parameters")
+    torch.save(slim_state_dict, args.output)
+    print("saved", args.output, "(%.1f MB -> %.1f MB)" % (os.path.getsize(args.input) / 2**20, os.path.getsize(args.output) / 2**20))
+
+
+if __name__ == '__main__':
+    main()
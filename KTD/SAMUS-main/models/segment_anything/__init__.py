@@ -11,5 +11,5 @@ from .build_sam import (
     build_sam_vit_b,
     sam_model_registry,
 )
-from .predictor import SamPredictor
+from .predictor import EmbeddingCache, SamPredictor
 from .automatic_mask_generator import SamAutomaticMaskGenerator
@@ -14,7 +14,6 @@ from .modeling import Sam
 from .predictor import SamPredictor
 from .utils.amg import (
     MaskData,
-    area_from_rle,
     batch_iterator,
     batched_mask_to_box,
     box_xyxy_to_xywh,
@@ -24,8 +23,9 @@ from .utils.amg import (
     generate_crop_boxes,
     is_box_near_crop_edge,
     mask_to_rle_pytorch,
-    remove_small_regions,
-    rle_to_mask,
+    pack_masks,
+    remove_small_regions_batched,
+    unpack_masks,
     uncrop_boxes_xyxy,
     uncrop_masks,
     uncrop_points,
@@ -88,7 +88,7 @@ class SamAutomaticMaskGenerator:
             list is used in the nth crop layer. Exclusive with points_per_side.
           min_mask_region_area (int): If >0, postprocessing will be applied
             to remove disconnected regions and holes in masks with area smaller
-            than min_mask_region_area. Requires opencv.
+            than min_mask_region_area.
           output_mode (str): The form masks are returned in. Can be 'binary_mask',
             'uncompressed_rle', or 'coco_rle'. 'coco_rle' requires pycocotools.
             For large resolutions, 'binary_mask' may consume large amounts of
@@ -117,9 +117,6 @@ class SamAutomaticMaskGenerator:
         if output_mode == "coco_rle":
             from pycocotools import mask as mask_utils  # type: ignore # noqa: F401
 
-        if min_mask_region_area > 0:
-            import cv2  # type: ignore # noqa: F401
-
         self.predictor = SamPredictor(model)
         self.points_per_batch = points_per_batch
         self.pred_iou_thresh = pred_iou_thresh
@@ -159,8 +156,9 @@ class SamAutomaticMaskGenerator:
                  the mask, given in XYWH format.
         """
 
-        # Generate masks
+        # Generate masks, kept on the model's device as packed bits
         mask_data = self._generate_masks(image)
+        mask_size = image.shape[:2]
 
         # Filter small disconnected regions and holes in masks
         if self.min_mask_region_area > 0:
@@ -168,22 +166,29 @@ class SamAutomaticMaskGenerator:
                 mask_data,
                 self.min_mask_region_area,
                 max(self.box_nms_thresh, self.crop_nms_thresh),
+                mask_size,
+                self.points_per_batch,
             )
 
-        # Encode masks
+        # Encode masks, only for the masks that survived all filtering
+        segmentations = []
+        for (packed,) in batch_iterator(self.points_per_batch, mask_data["masks"]):
+            masks = unpack_masks(packed, *mask_size)
+            if self.output_mode == "binary_mask":
+                segmentations.extend(masks.cpu().numpy())
+            else:
+                segmentations.extend(mask_to_rle_pytorch(masks))
         if self.output_mode == "coco_rle":
-            mask_data["segmentations"] = [coco_encode_rle(rle) for rle in mask_data["rles"]]
-        elif self.output_mode == "binary_mask":
-            mask_data["segmentations"] = [rle_to_mask(rle) for rle in mask_data["rles"]]
-        else:
-            mask_data["segmentations"] = mask_data["rles"]
+            segmentations = [coco_encode_rle(rle) for rle in segmentations]
+        del mask_data["masks"]
+        mask_data.to_numpy()
 
         # Write mask records
         curr_anns = []
-        for idx in range(len(mask_data["segmentations"])):
+        for idx in range(len(segmentations)):
             ann = {
-                "segmentation": mask_data["segmentations"][idx],
-                "area": area_from_rle(mask_data["rles"][idx]),
+                "segmentation": segmentations[idx],
+                "area": int(mask_data["areas"][idx]),
                 "bbox": box_xyxy_to_xywh(mask_data["boxes"][idx]).tolist(),
                 "predicted_iou": mask_data["iou_preds"][idx].item(),
                 "point_coords": [mask_data["points"][idx].tolist()],
@@ -201,10 +206,12 @@ class SamAutomaticMaskGenerator:
         )
 
         # Iterate over image crops
-        data = MaskData()
-        for crop_box, layer_idx in zip(crop_boxes, layer_idxs):
-            crop_data = self._process_crop(image, crop_box, layer_idx, orig_size)
-            data.cat(crop_data)
+        data = MaskData.cat_all(
+            [
+                self._process_crop(image, crop_box, layer_idx, orig_size)
+                for crop_box, layer_idx in zip(crop_boxes, layer_idxs)
+            ]
+        )
 
         # Remove duplicate masks between crops
         if len(crop_boxes) > 1:
@@ -219,7 +226,6 @@ class SamAutomaticMaskGenerator:
             )
             data.filter(keep_by_nms)
 
-        data.to_numpy()
         return data
 
     def _process_crop(
@@ -240,11 +246,12 @@ class SamAutomaticMaskGenerator:
         points_for_image = self.point_grids[crop_layer_idx] * points_scale
 
         # Generate masks for this crop in batches
-        data = MaskData()
-        for (points,) in batch_iterator(self.points_per_batch, points_for_image):
-            batch_data = self._process_batch(points, cropped_im_size, crop_box, orig_size)
-            data.cat(batch_data)
-            del batch_data
+        data = MaskData.cat_all(
+            [
+                self._process_batch(points, cropped_im_size, crop_box, orig_size)
+                for (points,) in batch_iterator(self.points_per_batch, points_for_image)
+            ]
+        )
         self.predictor.reset_image()
 
         # Remove duplicates within this crop.
@@ -259,7 +266,9 @@ class SamAutomaticMaskGenerator:
         # Return to the original image frame
         data["boxes"] = uncrop_boxes_xyxy(data["boxes"], crop_box)
         data["points"] = uncrop_points(data["points"], crop_box)
-        data["crop_boxes"] = torch.tensor([crop_box for _ in range(len(data["rles"]))])
+        data["crop_boxes"] = torch.tensor(
+            [crop_box for _ in range(len(data["masks"]))], device=data["boxes"].device
+        )
 
         return data
 
@@ -313,60 +322,59 @@ class SamAutomaticMaskGenerator:
         if not torch.all(keep_mask):
             data.filter(keep_mask)
 
-        # Compress to RLE
-        data["masks"] = uncrop_masks(data["masks"], crop_box, orig_h, orig_w)
-        data["rles"] = mask_to_rle_pytorch(data["masks"])
-        del data["masks"]
+        # Pack to bits, RLEs are only computed for the final masks
+        masks = uncrop_masks(data["masks"], crop_box, orig_h, orig_w)
+        data["areas"] = masks.flatten(1).sum(1)
+        data["masks"] = pack_masks(masks)
 
         return data
 
     @staticmethod
     def postprocess_small_regions(
-        mask_data: MaskData, min_area: int, nms_thresh: float
+        mask_data: MaskData,
+        min_area: int,
+        nms_thresh: float,
+        mask_size: Tuple[int, ...],
+        batch_size: int = 64,
     ) -> MaskData:
         """
         Removes small disconnected regions and holes in masks, then reruns
         box NMS to remove any new duplicates.
 
-        Edits mask_data in place.
-
-        Requires open-cv as a dependency.
+        Edits mask_data in place. Masks are packed bits of size mask_size and
+        are processed batch_size at a time on their device.
         """
-        if len(mask_data["rles"]) == 0:
+        if len(mask_data["masks"]) == 0:
             return mask_data
 
         # Filter small disconnected regions and holes
-        new_masks = []
-        scores = []
-        for rle in mask_data["rles"]:
-            mask = rle_to_mask(rle)
+        new_masks, boxes, areas, scores = [], [], [], []
+        for (packed,) in batch_iterator(batch_size, mask_data["masks"]):
+            masks = unpack_masks(packed, *mask_size)
 
-            mask, changed = remove_small_regions(mask, min_area, mode="holes")
-            unchanged = not changed
-            mask, changed = remove_small_regions(mask, min_area, mode="islands")
-            unchanged = unchanged and not changed
+            masks, changed_holes = remove_small_regions_batched(masks, min_area, mode="holes")
+            masks, changed_islands = remove_small_regions_batched(masks, min_area, mode="islands")
 
-            new_masks.append(torch.as_tensor(mask).unsqueeze(0))
+            new_masks.append(pack_masks(masks))
+            boxes.append(batched_mask_to_box(masks))
+            areas.append(masks.flatten(1).sum(1))
             # Give score=0 to changed masks and score=1 to unchanged masks
             # so NMS will prefer ones that didn't need postprocessing
-            scores.append(float(unchanged))
+            scores.append((~(changed_holes | changed_islands)).float())
 
         # Recalculate boxes and remove any new duplicates
-        masks = torch.cat(new_masks, dim=0)
-        boxes = batched_mask_to_box(masks)
+        boxes = torch.cat(boxes)
         keep_by_nms = batched_nms(
             boxes.float(),
-            torch.as_tensor(scores),
+            torch.cat(scores),
             torch.zeros_like(boxes[:, 0]),  # categories
             iou_threshold=nms_thresh,
         )
 
-        # Only recalculate RLEs for masks that have changed
-        for i_mask in keep_by_nms:
-            if scores[i_mask] == 0.0:
-                mask_torch = masks[i_mask].unsqueeze(0)
-                mask_data["rles"][i_mask] = mask_to_rle_pytorch(mask_torch)[0]
-                mask_data["boxes"][i_mask] = boxes[i_mask]  # update res directly
+        # Unchanged masks get back the same masks, boxes and areas
+        mask_data["masks"] = torch.cat(new_masks)
+        mask_data["boxes"] = boxes
+        mask_data["areas"] = torch.cat(areas)
         mask_data.filter(keep_by_nms)
 
         return mask_data
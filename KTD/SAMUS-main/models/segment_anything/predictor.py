@@ -4,20 +4,124 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+import hashlib
+import os
+from collections import OrderedDict
+
 import numpy as np
 import torch
 
 from models.segment_anything.modeling import Sam
 
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple
 
 from .utils.transforms import ResizeLongestSide
 
 
+class EmbeddingCache:
+    def __init__(
+        self,
+        max_bytes: int = 512 * 2**20,
+        spill_dir: Optional[str] = None,
+    ) -> None:
+        """
+        LRU cache of image embeddings keyed by image content, so that a
+        SamPredictor revisiting an image only runs the prompt encoder and
+        mask decoder.
+
+        Arguments:
+          max_bytes (int): Memory budget of the cached embeddings (on the
+            device they were computed on).
+          spill_dir (str or None): If set, embeddings evicted from memory are
+            written there in fp16 and reloaded on a later hit instead of
+            re-encoding the image.
+
+        Keys include a fingerprint of the model that computed the embedding,
+        so a cache (or spill_dir) can be shared across predictors and runs
+        with different checkpoints.
+        """
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.entries: "OrderedDict[str, Tuple[torch.Tensor, Tuple[int, ...], Tuple[int, ...]]]" = OrderedDict()
+        self.nbytes = 0
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    @staticmethod
+    def key(image: np.ndarray, namespace: str = "") -> str:
+        """Content hash of an image (pixels, shape and dtype) within a model namespace."""
+        sha = hashlib.sha1(str((namespace, image.shape, image.dtype.str)).encode())
+        sha.update(np.ascontiguousarray(image).data)
+        return sha.hexdigest()
+
+    @staticmethod
+    def model_fingerprint(model: torch.nn.Module) -> str:
+        """Hash of the names, shapes, dtypes and values of a model's parameters and buffers."""
+        sha = hashlib.sha1()
+        for name, tensor in model.state_dict().items():
+            tensor = tensor.detach().cpu().contiguous()
+            sha.update(str((name, tuple(tensor.shape), str(tensor.dtype))).encode())
+            sha.update(tensor.reshape(-1).view(torch.uint8).numpy().data)
+        return sha.hexdigest()
+
+    def _spill_path(self, key: str) -> str:
+        return os.path.join(self.spill_dir, key + ".pt")
+
+    def get(
+        self, key: str, device: torch.device
+    ) -> Optional[Tuple[torch.Tensor, Tuple[int, ...], Tuple[int, ...]]]:
+        """Returns (features, original_size, input_size) of an image key, or None."""
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        if self.spill_dir is not None and os.path.exists(self._spill_path(key)):
+            spilled = torch.load(self._spill_path(key), map_location=device)
+            features = spilled["features"].to(spilled["dtype"])
+            self.put(key, features, spilled["original_size"], spilled["input_size"])
+            return self.entries[key]
+        return None
+
+    def put(
+        self,
+        key: str,
+        features: torch.Tensor,
+        original_size: Tuple[int, ...],
+        input_size: Tuple[int, ...],
+    ) -> None:
+        if key in self.entries:
+            old_features = self.entries.pop(key)[0]
+            self.nbytes -= old_features.nelement() * old_features.element_size()
+        self.entries[key] = (features, tuple(original_size), tuple(input_size))
+        self.nbytes += features.nelement() * features.element_size()
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            self._evict()
+
+    def _evict(self) -> None:
+        key, (features, original_size, input_size) = self.entries.popitem(last=False)
+        self.nbytes -= features.nelement() * features.element_size()
+        if self.spill_dir is not None and not os.path.exists(self._spill_path(key)):
+            torch.save(
+                {
+                    "features": features.half().cpu(),
+                    "dtype": features.dtype,
+                    "original_size": original_size,
+                    "input_size": input_size,
+                },
+                self._spill_path(key),
+            )
+
+    def clear(self) -> None:
+        """Drops the in-memory entries (spilled files are kept)."""
+        self.entries.clear()
+        self.nbytes = 0
+
+
 class SamPredictor:
     def __init__(
         self,
         sam_model: Sam,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        cache_namespace: Optional[str] = None,
     ) -> None:
         """
         Uses SAM to calculate the image embedding for an image, and then
@@ -25,10 +129,20 @@ class SamPredictor:
 
         Arguments:
           sam_model (Sam): The model to use for mask prediction.
+          embedding_cache (EmbeddingCache or None): If set, image embeddings
+            are kept across set_image calls, so switching back to an image
+            does not re-encode it.
+          cache_namespace (str or None): Namespace of this model's entries in
+            the embedding cache. Defaults to a hash of the image encoder
+            weights at construction; pass a new one after changing them.
         """
         super().__init__()
         self.model = sam_model
         self.transform = ResizeLongestSide(sam_model.image_encoder.img_size)
+        self.embedding_cache = embedding_cache
+        if embedding_cache is not None and cache_namespace is None:
+            cache_namespace = EmbeddingCache.model_fingerprint(sam_model.image_encoder)
+        self.cache_namespace = cache_namespace
         self.reset_image()
 
     def set_image(
@@ -52,12 +166,85 @@ class SamPredictor:
         if image_format != self.model.image_format:
             image = image[..., ::-1]
 
+        if self.embedding_cache is not None:
+            key = self.embedding_cache.key(image, self.cache_namespace)
+            cached = self.embedding_cache.get(key, self.device)
+            if cached is not None:
+                self._set_features(*cached)
+                return
+
         # Transform the image to the form expected by the model
+        input_image_torch = self._transform_image(image)
+
+        self.set_torch_image(input_image_torch, image.shape[:2])
+        if self.embedding_cache is not None:
+            self.embedding_cache.put(key, self.features, self.original_size, self.input_size)
+
+    @torch.no_grad()
+    def set_images(
+        self,
+        images: List[np.ndarray],
+        image_format: str = "RGB",
+        batch_size: int = 4,
+    ) -> None:
+        """
+        Calculates the image embeddings of several images, batch_size images
+        per image encoder forward, and stores them in the embedding cache.
+        The last image is then set as with 'set_image'; the others are set
+        from the cache by later 'set_image' calls.
+
+        Arguments:
+          images (list(np.ndarray)): The images, each in HWC uint8 format,
+            with pixel values in [0, 255].
+          image_format (str): The color format of the images, in ['RGB', 'BGR'].
+          batch_size (int): The number of images per image encoder forward.
+        """
+        assert self.embedding_cache is not None, "set_images needs a SamPredictor with an embedding_cache."
+        assert image_format in [
+            "RGB",
+            "BGR",
+        ], f"image_format must be in ['RGB', 'BGR'], is {image_format}."
+        if image_format != self.model.image_format:
+            images = [image[..., ::-1] for image in images]
+
+        missing = {}
+        for image in images:
+            key = self.embedding_cache.key(image, self.cache_namespace)
+            if key not in missing and self.embedding_cache.get(key, self.device) is None:
+                missing[key] = image
+        missing_items = list(missing.items())
+        for i in range(0, len(missing_items), batch_size):
+            batch = missing_items[i : i + batch_size]
+            input_images = [self._transform_image(image) for _, image in batch]
+            features = self.model.image_encoder(
+                torch.cat([self.model.preprocess(input_image) for input_image in input_images])
+            )
+            for (key, image), input_image, curr_features in zip(batch, input_images, features):
+                # clone, a view would keep the whole batch output alive
+                self.embedding_cache.put(
+                    key, curr_features[None].clone(), image.shape[:2], tuple(input_image.shape[-2:])
+                )
+
+        if images:
+            # a cache hit unless the budget is smaller than one batch
+            self.set_image(images[-1], self.model.image_format)
+
+    def _transform_image(self, image: np.ndarray) -> torch.Tensor:
         input_image = self.transform.apply_image(image)
         input_image_torch = torch.as_tensor(input_image, device=self.device)
-        input_image_torch = input_image_torch.permute(2, 0, 1).contiguous()[None, :, :, :]
+        return input_image_torch.permute(2, 0, 1).contiguous()[None, :, :, :]
 
-        self.set_torch_image(input_image_torch, image.shape[:2])
+    def _set_features(
+        self,
+        features: torch.Tensor,
+        original_size: Tuple[int, ...],
+        input_size: Tuple[int, ...],
+    ) -> None:
+        self.reset_image()
+        self.original_size = original_size
+        self.input_size = input_size
+        self.features = features
+        self.is_image_set = True
 
     @torch.no_grad()
     def set_torch_image(
@@ -69,6 +69,24 @@ class MaskData:
             else:
                 raise TypeError(f"MaskData key {k} has an unsupported type {type(v)}.")
 
+    @staticmethod
+    def cat_all(items: List["MaskData"]) -> "MaskData":
+        """Concatenates several MaskData at once, one torch.cat per key."""
+        out = MaskData()
+        if not items:
+            return out
+        for k, v in items[0].items():
+            values = [item[k] for item in items]
+            if isinstance(v, torch.Tensor):
+                out[k] = torch.cat(values, dim=0)
+            elif isinstance(v, np.ndarray):
+                out[k] = np.concatenate(values, axis=0)
+            elif isinstance(v, list):
+                out[k] = [a for value in values for a in value]
+            else:
+                raise TypeError(f"MaskData key {k} has an unsupported type {type(v)}.")
+        return out
+
     def to_numpy(self) -> None:
         for k, v in self._stats.items():
             if isinstance(v, torch.Tensor):
@@ -291,6 +309,96 @@ def remove_small_regions(
     return mask, True
 
 
+def pack_masks(masks: torch.Tensor) -> torch.Tensor:
+    """
+    Packs binary masks NxHxW into bits, Nx(ceil(H*W/8)) uint8, on the
+    masks' device. unpack_masks reverses it given (H, W).
+    """
+    n, h, w = masks.shape
+    flat = masks.reshape(n, h * w).to(torch.uint8)
+    flat = torch.nn.functional.pad(flat, (0, (-h * w) % 8))
+    shifts = torch.arange(8, dtype=torch.uint8, device=masks.device)
+    return (flat.view(n, flat.shape[1] // 8, 8) << shifts).sum(-1, dtype=torch.uint8)
+
+
+def unpack_masks(packed: torch.Tensor, h: int, w: int) -> torch.Tensor:
+    """Binary masks NxHxW from the output of pack_masks."""
+    shifts = torch.arange(8, dtype=torch.uint8, device=packed.device)
+    bits = (packed[..., None] >> shifts) & 1
+    return bits.view(packed.shape[0], packed.shape[1] * 8)[:, : h * w].view(-1, h, w).bool()
+
+
+def _run_max(labels: torch.Tensor, masks: torch.Tensor, dim: int) -> torch.Tensor:
+    """Max label of each horizontal (dim=-1) or vertical (dim=-2) run of foreground pixels."""
+    def prefix_max(labels: torch.Tensor, masks: torch.Tensor) -> torch.Tensor:
+        # Offsetting every run above the runs before it keeps cummax inside the run
+        previous = torch.nn.functional.pad(masks, (1, 0) if dim == -1 else (0, 0, 1, 0))
+        previous = previous[..., :-1] if dim == -1 else previous[..., :-1, :]
+        offset = (masks & ~previous).cumsum(dim) * (labels.shape[-1] * labels.shape[-2] + 1)
+        return torch.cummax(labels + offset, dim).values - offset
+
+    forward = prefix_max(labels, masks)
+    backward = prefix_max(labels.flip(dim), masks.flip(dim)).flip(dim)
+    return torch.where(masks, torch.maximum(forward, backward), torch.zeros_like(labels))
+
+
+def connected_components(masks: torch.Tensor) -> torch.Tensor:
+    """
+    8-connected components of a batch of binary masks NxHxW, computed on the
+    masks' device by label propagation with pointer jumping. Each foreground
+    pixel gets 1 + the flat index of the last pixel of its component,
+    background pixels get 0.
+    """
+    n, h, w = masks.shape
+    index = torch.arange(1, h * w + 1, device=masks.device).view(1, h, w)
+    labels = torch.where(masks, index, torch.zeros_like(index))
+    while True:
+        # Max label along rows and columns of foreground, then over the
+        # diagonal neighbours
+        labels = _run_max(_run_max(labels, masks, -1), masks, -2)
+        padded = torch.nn.functional.pad(labels, (1, 1, 1, 1))
+        propagated = labels
+        for dy, dx in product((0, 2), (0, 2)):
+            propagated = torch.maximum(propagated, padded[:, dy : dy + h, dx : dx + w])
+        propagated = torch.where(masks, propagated, torch.zeros_like(propagated)).view(n, -1)
+        # Pointer jumping: take the label of the pixel a label points to
+        jumped = propagated.gather(1, (propagated - 1).clamp(min=0))
+        propagated = torch.where(propagated > 0, torch.maximum(propagated, jumped), propagated)
+        propagated = propagated.view(n, h, w)
+        if torch.equal(propagated, labels):
+            return labels
+        labels = propagated
+
+
+def remove_small_regions_batched(
+    masks: torch.Tensor, area_thresh: float, mode: str
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    remove_small_regions for a batch of masks NxHxW on their device. Returns
+    the masks and an N boolean tensor of which masks have been modified.
+    """
+    assert mode in ["holes", "islands"]
+    correct_holes = mode == "holes"
+    working_mask = masks ^ correct_holes
+    labels = connected_components(working_mask)
+    n = labels.shape[0]
+    flat_labels = labels.view(n, -1)
+    region_sizes = torch.zeros(n, flat_labels.shape[1] + 1, dtype=torch.long, device=labels.device)
+    region_sizes.scatter_add_(1, flat_labels, torch.ones_like(flat_labels))
+    sizes = region_sizes.gather(1, flat_labels).view_as(labels)  # Size of each pixel's region
+    small_regions = working_mask & (sizes < area_thresh)
+    changed = small_regions.flatten(1).any(dim=1)
+    if correct_holes:
+        return masks | small_regions, changed
+    keep = working_mask & ~small_regions
+    # If every region is below threshold, keep largest
+    all_small = changed & ~keep.flatten(1).any(dim=1)
+    if all_small.any():
+        largest = flat_labels.gather(1, (sizes * working_mask).flatten(1).argmax(dim=1, keepdim=True))
+        keep[all_small] = (labels == largest.view(n, 1, 1))[all_small] & working_mask[all_small]
+    return keep, changed
+
+
 def coco_encode_rle(uncompressed_rle: Dict[str, Any]) -> Dict[str, Any]:
     from pycocotools import mask as mask_utils  # type: ignore
 
@@ -8,7 +8,7 @@ import torch
 
 from functools import partial
 
-from .modeling import ImageEncoderViT, MaskDecoder, PromptEncoder, Samus, TwoWayTransformer,AutoPromptGenerator
+from .modeling import ImageEncoderViT, MaskDecoder, PromptEncoder, Samus, TwoWayTransformer,AutoPromptGenerator, slim_apg_state_dict
 from torch.nn import functional as F
 
 
@@ -69,6 +69,8 @@ def _build_samus(
     # patch_size = image_size//32
     patch_size=16
     image_embedding_size = 14
+    # 只构建 forward 用到的 APG 子模块, 需配合 slim_apg_state_dict / convert_slim_apg.py 转换的权重
+    slim_apg = getattr(args, 'slim_apg', False)
     samus = Samus(
        image_encoder=ImageEncoderViT(
             depth=encoder_depth,
@@ -83,6 +85,9 @@ def _build_samus(
             global_attn_indexes=encoder_global_attn_indexes,
             window_size=14,  # 224//16 = 14
             out_chans=prompt_embed_dim,
+            # 两个分支共用的 token 网格, 低分辨率 mask 为 4 * token_size
+            token_size=getattr(args, 'encoder_token_size', 32),
+            patch_stride=getattr(args, 'encoder_patch_stride', 8),
         ),
         auto_prompt_generator= AutoPromptGenerator(
             embed_dim=prompt_embed_dim,
@@ -91,7 +96,8 @@ def _build_samus(
             mlp_ratio= 4,
             batchsize= args.batch_size,
             task_number = 2,
-            device= args.device
+            device= args.device,
+            slim= slim_apg
         ),
         prompt_encoder=PromptEncoder(
             embed_dim=prompt_embed_dim,
@@ -116,6 +122,8 @@ def _build_samus(
     if checkpoint is not None:
         with open(checkpoint, "rb") as f:
             state_dict = torch.load(f)
+        if slim_apg:
+            state_dict = slim_apg_state_dict(state_dict)
         try:
             samus.load_state_dict(state_dict)
         except:
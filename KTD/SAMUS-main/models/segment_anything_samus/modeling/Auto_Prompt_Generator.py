@@ -5,6 +5,32 @@ from torch import nn
 from typing import Any, Optional, Tuple, Type
 from .common import LayerNorm2d
 import torch.nn.functional as F
+
+# 当前 forward 未使用的子模块 (旧版 task/output token 分支), slim 构建时不再创建
+UNUSED_APG_MODULES = (
+    'mask_adapter',
+    'task_output_attn_blocks',
+    'image_output_attn_blocks',
+    'task_output_common_mlp',
+    'task_tokens',
+)
+
+
+def slim_apg_state_dict(state_dict, prefix='auto_prompt_generator.'):
+    """
+    Drop the AutoPromptGenerator entries of UNUSED_APG_MODULES from a state dict,
+    so that a full checkpoint loads strictly into a slim build.
+
+    Arguments:
+      state_dict (dict): model (or AutoPromptGenerator) state dict, a leading
+        'module.' (DataParallel) is tolerated.
+      prefix (str): key prefix of the AutoPromptGenerator, '' for its own state dict.
+    """
+    unused = tuple(prefix + name for name in UNUSED_APG_MODULES)
+    return {k: v for k, v in state_dict.items()
+            if not (k[7:] if k.startswith('module.') else k).startswith(unused)}
+
+
 class AutoPromptGenerator(nn.Module):
     def __init__(
         self,
@@ -14,7 +40,8 @@ class AutoPromptGenerator(nn.Module):
         mlp_ratio: float = 4.0,
         batchsize: int = 8,
         task_number: int = 2,
-        device: str = 'cuda'
+        device: str = 'cuda',
+        slim: bool = False
     ) -> None:
 
         """
@@ -28,30 +55,17 @@ class AutoPromptGenerator(nn.Module):
             encoding input masks.
           activation (nn.Module): The activation to use when encoding
             input masks.
+          slim (bool): Skip the submodules in UNUSED_APG_MODULES, which the
+            forward does not use; load full checkpoints through slim_apg_state_dict.
         """
         super().__init__()
         self.embed_dim = embed_dim
-
-        self.mask_adapter = FourConv(in_channels=embed_dim,out_channels=embed_dim, mid_channels=embed_dim//4)
-        self.task_output_attn_blocks = nn.ModuleList()
-        self.image_output_attn_blocks = nn.ModuleList()
         self.task_number = task_number
         self.device = device
+        self.slim = slim
 
-        self.task_output_common_mlp = nn.Linear(embed_dim, embed_dim)
-        self.task_tokens = nn.Parameter(torch.randn(1,task_number, embed_dim)) # 1 task_n dim
-
-        for i in range(depth):
-            task_output_attn_block = DoubleAttnBlock(
-                dim = embed_dim,
-                num_heads = num_heads,
-                mlp_ratio= mlp_ratio)
-            image_output_attn_block = DoubleAttnBlock(
-                dim = embed_dim,
-                num_heads = num_heads,
-                mlp_ratio= mlp_ratio)
-            self.task_output_attn_blocks.append(task_output_attn_block)
-            self.image_output_attn_blocks.append(image_output_attn_block)
+        if not slim:
+            self._build_unused_modules(embed_dim, depth, num_heads, mlp_ratio, task_number)
 
         self.Ps = nn.Parameter(torch.randn(1,task_number, embed_dim))  #1 2 256
         self.Pd = nn.Parameter(torch.randn(embed_dim, 32, 32))  # 256 32 32
@@ -69,12 +83,36 @@ class AutoPromptGenerator(nn.Module):
             self.ps_image_attn_blocks.append(ps_image_attn_block)
             self.pd_image_attn_blocks.append(pd_image_attn_block)
 
+    def _build_unused_modules(self, embed_dim, depth, num_heads, mlp_ratio, task_number):
+        # 保留以兼容旧 checkpoint 的严格加载, forward 中不使用
+        self.mask_adapter = FourConv(in_channels=embed_dim,out_channels=embed_dim, mid_channels=embed_dim//4)
+        self.task_output_attn_blocks = nn.ModuleList()
+        self.image_output_attn_blocks = nn.ModuleList()
+
+        self.task_output_common_mlp = nn.Linear(embed_dim, embed_dim)
+        self.task_tokens = nn.Parameter(torch.randn(1,task_number, embed_dim)) # 1 task_n dim
+
+        for i in range(depth):
+            task_output_attn_block = DoubleAttnBlock(
+                dim = embed_dim,
+                num_heads = num_heads,
+                mlp_ratio= mlp_ratio)
+            image_output_attn_block = DoubleAttnBlock(
+                dim = embed_dim,
+                num_heads = num_heads,
+                mlp_ratio= mlp_ratio)
+            self.task_output_attn_blocks.append(task_output_attn_block)
+            self.image_output_attn_blocks.append(image_output_attn_block)
 
     def forward(self,image_embeddings,output_tokens):
         origin_image_embedding = image_embeddings  # 返回原始图像
         batchsize = image_embeddings.size(0)
         Ps = self.Ps.expand(batchsize,-1,-1,-1)
-        Pd = self.Pd.expand(batchsize,-1,-1,-1)
+        Pd = self.Pd
+        if Pd.shape[-2:] != image_embeddings.shape[-2:]:
+            # 编码器 token 网格不是 32x32 时 (encoder_token_size), 将 Pd 插值到该网格
+            Pd = F.interpolate(Pd[None], image_embeddings.shape[-2:], mode="bilinear", align_corners=False)[0]
+        Pd = Pd.expand(batchsize,-1,-1,-1)
 
         image_embeddings = image_embeddings.permute(0, 2, 3, 1)
         for blk in self.ps_image_attn_blocks:
@@ -4,9 +4,9 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
-from .samus import Samus
+from .samus import Samus, SamusOutput
 from .image_encoder import ImageEncoderViT
 from .mask_decoder import MaskDecoder
 from .prompt_encoder import PromptEncoder
 from .transformer import TwoWayTransformer
-from .Auto_Prompt_Generator import AutoPromptGenerator
\ No newline at end of file
+from .Auto_Prompt_Generator import AutoPromptGenerator, slim_apg_state_dict
\ No newline at end of file
@@ -36,6 +36,8 @@ class ImageEncoderViT(nn.Module):
         rel_pos_zero_init: bool = True,
         window_size: int = 0,
         global_attn_indexes: Tuple[int, ...] = (),
+        token_size: int = 32,
+        patch_stride: int = 8,
     ) -> None:
         """
         Args:
@@ -54,16 +56,30 @@ class ImageEncoderViT(nn.Module):
             rel_pos_zero_init (bool): If True, zero initialize relative positional parameters.
             window_size (int): Window size for window attention blocks.
             global_attn_indexes (list): Indexes for blocks using global attention.
+            token_size (int): Side of the token grid both branches share, for any input size. The
+                mask decoder upsamples it 4x, so low-res masks are 4 * token_size (128 by default).
+            patch_stride (int): Stride of both patch embeddings, a power of 2 up to patch_size. The
+                CNN branch always runs on a (token_size * patch_stride)^2 resize of the input
+                (256x256 by default), PatchEmbed0 on a (token_size * patch_stride + 16 - patch_stride)^2 one.
         """
         super().__init__()
+        assert patch_stride & (patch_stride - 1) == 0 and patch_stride <= patch_size, \
+            "patch_stride must be a power of 2 no larger than patch_size"
         self.img_size = img_size
+        # both branches share one token grid for any input size: PatchEmbed0 resizes its input to 264
+        # and strides by 8 (32x32 tokens by default, the grid the mask decoder is built for), the CNN
+        # branch runs on a 256x256 resize of the input and pools by the same stride 8
+        self.patch_stride = patch_stride
+        self.token_size = token_size
 
-        self.cnn_embed = SingleCNNEmbed(patchsize=patch_size, in_chans=3, embed_dim=embed_dim) # new to sam
+        self.cnn_embed = SingleCNNEmbed(patchsize=patch_size, in_chans=3, embed_dim=embed_dim, stride=self.patch_stride) # new to sam
         self.patch_embed = PatchEmbed0(
             kernel_size=(patch_size, patch_size),
             stride=(patch_size, patch_size),
             in_chans=3,
             embed_dim=embed_dim,
+            token_size=token_size,
+            token_stride=patch_stride,
         )
 
         self.pos_embed: Optional[nn.Parameter] = None
@@ -73,6 +89,8 @@ class ImageEncoderViT(nn.Module):
                 torch.zeros(1, 1024//16, 1024//16, embed_dim) # torch.zeros(1, 1024//16, 1024//16, embed_dim)
             )
             self.post_pos_embed = PostPosEmbed(embed_dim=embed_dim, ori_feature_size=1024//16, new_feature_size=img_size//patch_size) # new to sam
+        # adapted positional embedding per (feature size, device, dtype, autocast), see adapted_pos_embed
+        self._pos_embed_cache = {}
 
         self.blocks = nn.ModuleList()
 
@@ -130,63 +148,97 @@ class ImageEncoderViT(nn.Module):
     #     x = self.neck(x.permute(0, 3, 1, 2))
         
     #     return x
+    def _compute_pos_embed(self, size: Tuple[int, int]) -> torch.Tensor:
+        if tuple(size) == tuple(self.pos_embed.shape[1:3]):
+            return self.pos_embed
+        # 使用 post_pos_embed 处理
+        pos_embed = self.post_pos_embed(self.pos_embed)  # 1 h w c
+        # 检查 post_pos_embed 处理后的尺寸是否匹配
+        if pos_embed.shape[1:3] != size:
+            # 动态调整位置编码尺寸
+            pos_embed = F.interpolate(
+                pos_embed.permute(0, 3, 1, 2),  # [1, C, H, W]
+                size=tuple(size),
+                mode='bilinear',
+                align_corners=False
+            ).permute(0, 2, 3, 1)  # [1, H, W, C]
+        return pos_embed
+
+    def adapted_pos_embed(self, size: Tuple[int, int], dtype: torch.dtype = torch.float32) -> torch.Tensor:
+        """
+        Positional embedding adapted to an (h, w) token grid, [1, h, w, c].
+
+        It only depends on the parameters and the grid size, so it is cached: the cached tensor is
+        reused until pos_embed or post_pos_embed change (tracked by their in-place version counters,
+        which optimizer steps and load_state_dict bump). While those parameters take gradients it
+        is recomputed, the backward pass needs the graph.
+        """
+        params = [self.pos_embed] + list(self.post_pos_embed.parameters())
+        if torch.is_grad_enabled() and any(p.requires_grad for p in params):
+            return self._compute_pos_embed(size)
+        key = (tuple(size), self.pos_embed.device, dtype, torch.is_autocast_enabled())
+        versions = tuple(p._version for p in params)
+        cached = self._pos_embed_cache.get(key)
+        if cached is None or cached[0] != versions:
+            with torch.no_grad():
+                cached = (versions, self._compute_pos_embed(size))
+            self._pos_embed_cache[key] = cached
+        return cached[1]
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         """原始实现，支持 cnnx 参数，并修复空间尺寸不匹配问题"""
-        B = x.shape[0]
-        
+        x, cnnx = self.forward_prefix(x, 0)
+        return self.forward_suffix(x, cnnx, 0)
+
+    def forward_prefix(self, x: torch.Tensor, num_blocks: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Stem (cnn_embed, patch_embed, input_Adapter, positional embedding) and the first
+        num_blocks blocks. Returns the (x, cnnx) activations, both b h w c, that
+        forward_suffix(x, cnnx, num_blocks) continues from.
+        """
         # 处理单通道输入
         if x.size()[1] == 1:
             x = x.repeat(1, 3, 1, 1)  # b c h w
         
-        # 生成 cnnx
-        cnnx = self.cnn_embed(x)  # b h w c
+        # 生成 cnnx，与 patch_embed 同一网格
+        cnn_size = self.token_size * self.patch_stride
+        if x.shape[2:] != (cnn_size, cnn_size):
+            cnnx = self.cnn_embed(F.interpolate(x, (cnn_size, cnn_size), mode="bilinear", align_corners=False))  # b h w c
+        else:
+            cnnx = self.cnn_embed(x)  # b h w c
         x = self.patch_embed(x)  # b h w c
         x = self.input_Adapter(x)
         
-        # 处理位置编码
+        # 处理位置编码：按特征图尺寸缓存，广播相加
         if self.pos_embed is not None:
-            # 动态调整位置编码尺寸以匹配特征图
-            if x.shape[1:3] != self.pos_embed.shape[1:3]:
-                # 使用 post_pos_embed 处理
-                pos_embed = self.post_pos_embed(self.pos_embed)  # 1 h w c
-                
-                # 检查 post_pos_embed 处理后的尺寸是否匹配
-                if pos_embed.shape[1:3] != x.shape[1:3]:
-                    # print(f"调整位置编码尺寸: {pos_embed.shape[1:3]} -> {x.shape[1:3]}")
-                    # 动态调整位置编码尺寸
-                    pos_embed = F.interpolate(
-                        pos_embed.permute(0, 3, 1, 2),  # [1, C, H, W]
-                        size=(x.shape[1], x.shape[2]),
-                        mode='bilinear',
-                        align_corners=False
-                    ).permute(0, 2, 3, 1)  # [1, H, W, C]
-                
-                x = x + pos_embed.repeat(x.shape[0], 1, 1, 1)
-            else:
-                # 直接使用
-                x = x + self.pos_embed.repeat(x.shape[0], 1, 1, 1)
+            x = x + self.adapted_pos_embed(x.shape[1:3], x.dtype)
         
         # 传递两个参数给 blocks
-        for blk in self.blocks:
+        for blk in self.blocks[:num_blocks]:
+            x, cnnx = blk(x, cnnx)  # b h w c
+        return x, cnnx
+
+    def forward_suffix(self, x: torch.Tensor, cnnx: torch.Tensor, start_block: int) -> torch.Tensor:
+        """Blocks from start_block on and the neck, on the activations of forward_prefix."""
+        for blk in self.blocks[start_block:]:
             x, cnnx = blk(x, cnnx)  # b h w c
         
-        # 添加 cnnx 并使用 neck - 修复尺寸不匹配问题
-        if x.shape[1:3] != cnnx.shape[1:3]:
-            # print(f"调整cnnx尺寸: {cnnx.shape[1:3]} -> {x.shape[1:3]}")
-            # 将 cnnx 调整为与 x 相同的空间尺寸
-            cnnx = F.interpolate(
-                cnnx.permute(0, 3, 1, 2),  # [B, C, H, W]
-                size=(x.shape[1], x.shape[2]),
-                mode='bilinear',
-                align_corners=False
-            ).permute(0, 2, 3, 1)  # [B, H, W, C]
-        
-        # 现在可以安全地相加
+        # cnn_embed 与 patch_embed 的网格一致，直接相加
         x = x + 0.5 * cnnx
         x = self.neck(x.permute(0, 3, 1, 2))
         
         return x  
 
+    def freeze_prefix(self, num_blocks: int) -> None:
+        """Freeze everything forward_prefix(x, num_blocks) runs, so its activations can be cached."""
+        prefix = [self.cnn_embed, self.patch_embed, self.input_Adapter, *self.blocks[:num_blocks]]
+        if self.pos_embed is not None:
+            prefix += [self.post_pos_embed]
+            self.pos_embed.requires_grad = False
+        for module in prefix:
+            for param in module.parameters():
+                param.requires_grad = False
+
 
 class ParaBlock(nn.Module):
     """Transformer blocks with support of window attention and residual propagation blocks"""
@@ -314,6 +366,26 @@ class Attention(nn.Module):
             # initialize relative positional embeddings
             self.rel_pos_h = nn.Parameter(torch.zeros(2 * input_size[0] - 1, head_dim))
             self.rel_pos_w = nn.Parameter(torch.zeros(2 * input_size[1] - 1, head_dim))
+            # (Rh, Rw) per (q_size, k_size), see rel_pos_tables
+            self._rel_pos_cache = {}
+
+    def rel_pos_tables(self, q_size: Tuple[int, int], k_size: Tuple[int, int]) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        get_rel_pos tables (Rh, Rw) of this block for a query / key grid, cached per resolution until
+        rel_pos_h / rel_pos_w change (version counters); recomputed while they take gradients.
+        """
+        params = (self.rel_pos_h, self.rel_pos_w)
+        if torch.is_grad_enabled() and any(p.requires_grad for p in params):
+            return get_rel_pos(q_size[0], k_size[0], self.rel_pos_h), get_rel_pos(q_size[1], k_size[1], self.rel_pos_w)
+        key = (tuple(q_size), tuple(k_size), self.rel_pos_h.device)
+        versions = tuple(p._version for p in params)
+        cached = self._rel_pos_cache.get(key)
+        if cached is None or cached[0] != versions:
+            with torch.no_grad():
+                tables = (get_rel_pos(q_size[0], k_size[0], self.rel_pos_h), get_rel_pos(q_size[1], k_size[1], self.rel_pos_w))
+            cached = (versions, tables)
+            self._rel_pos_cache[key] = cached
+        return cached[1]
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         B, H, W, _ = x.shape
@@ -321,6 +393,18 @@ class Attention(nn.Module):
         qkv0 = self.qkv(x)
         qkv = qkv0.reshape(B, H * W, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4)
 
+        if hasattr(F, 'scaled_dot_product_attention'):
+            # fused attention (torch >= 2.0), the decomposed rel-pos is folded into extra q / k
+            # columns, so no (HW, HW) bias is built and the flash kernel stays usable
+            q, k, v = qkv.unbind(0)  # B nHead HW C
+            C = q.shape[-1]
+            if self.use_rel_pos:
+                Rh, Rw = self.rel_pos_tables((H, W), (H, W))
+                q, k, v = fold_decomposed_rel_pos(q, k, v, Rh, Rw, (H, W), (H, W), self.scale)
+            x = F.scaled_dot_product_attention(q, k, v)[..., :C]
+            x = x.permute(0, 2, 1, 3).reshape(B, H, W, -1)
+            return self.proj(x)
+
         # q, k, v with shape (B * nHead, H * W, C)
         q, k, v = qkv.reshape(3, B * self.num_heads, H * W, -1).unbind(0)
 
@@ -394,75 +478,27 @@ class qkvAttention(nn.Module):
 
     #     return x
     def forward(self, q: torch.Tensor, k: torch.Tensor, v:torch.Tensor) -> torch.Tensor:
-        # 获取各张量的实际尺寸
-        B, Hq, Wq, C = q.shape
-        _, Hk, Wk, _ = k.shape
-        _, Hv, Wv, _ = v.shape
-        
-        # 应用线性变换
-        q_proj = self.q(q)  # 线性投影
-        k_proj = self.k(k)
-        v_proj = self.v(v)
-        
-        # 获取实际特征维度
-        C_proj = q_proj.size(-1)
-        head_dim = C_proj // self.num_heads
-        
-        # 调整k和v的空间尺寸以匹配q
-        if Hk != Hq or Wk != Wq:
-            k_proj = F.interpolate(
-                k_proj.permute(0, 3, 1, 2),  # [B, C, H, W]
-                size=(Hq, Wq),
-                mode='bilinear',
-                align_corners=False
-            ).permute(0, 2, 3, 1)  # [B, H, W, C]
-        
-        if Hv != Hq or Wv != Wq:
-            v_proj = F.interpolate(
-                v_proj.permute(0, 3, 1, 2),  # [B, C, H, W]
-                size=(Hq, Wq),
-                mode='bilinear',
-                align_corners=False
-            ).permute(0, 2, 3, 1)  # [B, H, W, C]
-        
-        # 所有张量现在有相同的空间尺寸，可以安全地处理
-        hw = Hq * Wq
-        
-        # 展平张量
-        q_flat = q_proj.reshape(B * hw, C_proj)
-        k_flat = k_proj.reshape(B * hw, C_proj)
-        v_flat = v_proj.reshape(B * hw, C_proj)
-        
-        # 重塑为多头注意力格式
-        q_4d = q_flat.reshape(B, hw, self.num_heads, head_dim)
-        k_4d = k_flat.reshape(B, hw, self.num_heads, head_dim)
-        v_4d = v_flat.reshape(B, hw, self.num_heads, head_dim)
-        
-        # 轴交换
-        q_perm = q_4d.permute(0, 2, 1, 3)
-        k_perm = k_4d.permute(0, 2, 1, 3)
-        v_perm = v_4d.permute(0, 2, 1, 3)
-        
-        # 重塑为注意力计算格式
-        q_attn = q_perm.reshape(B * self.num_heads, hw, head_dim)
-        k_attn = k_perm.reshape(B * self.num_heads, hw, head_dim)
-        v_attn = v_perm.reshape(B * self.num_heads, hw, head_dim)
-        
-        # 计算注意力
-        attn = (q_attn * self.scale) @ k_attn.transpose(-2, -1)
-        
-        if self.use_rel_pos:
-            attn = add_decomposed_rel_pos(attn, q_attn, self.rel_pos_h, self.rel_pos_w, (Hq, Wq), (Hq, Wq))
-        
-        attn = attn.softmax(dim=-1)
-        
-        # 应用注意力并重塑
-        out_attn = attn @ v_attn
-        out = out_attn.reshape(B, self.num_heads, Hq, Wq, head_dim)
-        out = out.permute(0, 2, 3, 1, 4).reshape(B, Hq, Wq, self.num_heads * head_dim)
-        out = self.proj(out)
-        
-        return out
+        # q 来自 ViT 分支，k/v 来自 CNN 分支，两者网格一致（见 ImageEncoderViT.patch_stride）
+        B, H, W, _ = q.shape
+        assert k.shape[1:3] == (H, W) and v.shape[1:3] == (H, W), (q.shape, k.shape, v.shape)
+        q = self.q(q).reshape(B, H * W, self.num_heads, -1).permute(0, 2, 1, 3)  # B nHead HW C
+        k = self.k(k).reshape(B, H * W, self.num_heads, -1).permute(0, 2, 1, 3)
+        v = self.v(v).reshape(B, H * W, self.num_heads, -1).permute(0, 2, 1, 3)
+
+        if not self.use_rel_pos and hasattr(F, 'scaled_dot_product_attention'):
+            # fused kernel (flash / memory-efficient) on torch >= 2.0
+            x = F.scaled_dot_product_attention(q, k, v)
+        else:
+            q, k, v = (t.reshape(B * self.num_heads, H * W, -1) for t in (q, k, v))
+            attn = (q * self.scale) @ k.transpose(-2, -1)
+            if self.use_rel_pos:
+                attn = add_decomposed_rel_pos(attn, q, self.rel_pos_h, self.rel_pos_w, (H, W), (H, W))
+            attn = attn.softmax(dim=-1)
+            x = (attn @ v).view(B, self.num_heads, H * W, -1)
+        x = x.permute(0, 2, 1, 3).reshape(B, H, W, -1)
+        x = self.proj(x)
+
+        return x
 
 
 def window_partition(x: torch.Tensor, window_size: int) -> Tuple[torch.Tensor, Tuple[int, int]]:
@@ -547,6 +583,52 @@ def get_rel_pos(q_size: int, k_size: int, rel_pos: torch.Tensor) -> torch.Tensor
     return rel_pos_resized[relative_coords.long()]
 
 
+def fold_decomposed_rel_pos(
+    q: torch.Tensor,
+    k: torch.Tensor,
+    v: torch.Tensor,
+    Rh: torch.Tensor,
+    Rw: torch.Tensor,
+    q_size: Tuple[int, int],
+    k_size: Tuple[int, int],
+    scale: float,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Operands of F.scaled_dot_product_attention (default scale) whose attention logits are
+    scale * q @ k^T plus the term add_decomposed_rel_pos adds: q gets the rel_h / rel_w columns,
+    k the matching one-hot key row / column indicators. q and k are zero padded to a multiple
+    of 8 and v to the same width, keep the first C channels of the output.
+    Args:
+        q, k, v (Tensor): with shape (..., q_h * q_w, C) and (..., k_h * k_w, C).
+        Rh (Tensor): get_rel_pos table (q_h, k_h, C) for height axis.
+        Rw (Tensor): get_rel_pos table (q_w, k_w, C) for width axis.
+        q_size (Tuple): spatial sequence size of query q with (q_h, q_w).
+        k_size (Tuple): spatial sequence size of key k with (k_h, k_w).
+        scale (float): scale of the q @ k^T logits.
+
+    Returns:
+        q, k, v (Tensor): with C + k_h + k_w channels, rounded up to a multiple of 8.
+    """
+    q_h, q_w = q_size
+    k_h, k_w = k_size
+    C = q.shape[-1]
+    r_q = q.reshape(*q.shape[:-2], q_h, q_w, C)
+    rel_h = torch.einsum("...hwc,hkc->...hwk", r_q, Rh).reshape(*q.shape[:-1], k_h)
+    rel_w = torch.einsum("...hwc,wkc->...hwk", r_q, Rw).reshape(*q.shape[:-1], k_w)
+    index = torch.arange(k_h * k_w, device=k.device)
+    one_hot_h = F.one_hot(index // k_w, k_h).to(k.dtype).expand(*k.shape[:-1], k_h)
+    one_hot_w = F.one_hot(index % k_w, k_w).to(k.dtype).expand(*k.shape[:-1], k_w)
+
+    dim = C + k_h + k_w
+    pad = -dim % 8
+    # undo the default 1 / sqrt(dim + pad) scale of scaled_dot_product_attention
+    norm = (dim + pad) ** 0.5
+    q = F.pad(torch.cat([q * scale, rel_h.to(q.dtype), rel_w.to(q.dtype)], dim=-1), (0, pad)) * norm
+    k = F.pad(torch.cat([k, one_hot_h, one_hot_w], dim=-1), (0, pad))
+    v = F.pad(v, (0, dim + pad - C))
+    return q, k, v
+
+
 def add_decomposed_rel_pos(
     attn: torch.Tensor,
     q: torch.Tensor,
@@ -700,15 +782,20 @@ class SingleCNNEmbed(nn.Module):
         patchsize: int = 8,
         in_chans: int = 1,
         embed_dim: int = 768,
+        stride: Optional[int] = None,
     ) -> None:
         """
         Args:
             patch_size (int): kernel size of the tokenization layer.
             in_chans (int): Number of input image channels.
             embed_dim (int): Patch embedding dimension.
+            stride (int): total downsampling, patch_size by default. The layers are the same for
+                any stride (log2(patch_size) SingleDown blocks), the last blocks skip their
+                max-pooling, so weights trained with another stride load unchanged.
         """
         super().__init__()
         downtimes = int(math.log2(patchsize))
+        pooltimes = int(math.log2(stride or patchsize))
         mid_channel = 64
         self.inc = SingleConv(in_chans, mid_channel)
         self.downs = nn.ModuleList()
@@ -717,6 +804,8 @@ class SingleCNNEmbed(nn.Module):
                 down = SingleDown(mid_channel, embed_dim)
             else:
                 down = SingleDown(mid_channel, mid_channel*2)
+            if i >= pooltimes:
+                down.maxpool_conv[0] = nn.Identity()
             mid_channel = mid_channel*2
             self.downs.append(down)
 
@@ -774,6 +863,8 @@ class PatchEmbed0(nn.Module):
         padding: Tuple[int, int] = (0, 0),
         in_chans: int = 3,
         embed_dim: int = 768,
+        token_size: int = 32,
+        token_stride: int = 8,
     ) -> None:
         """
         Args:
@@ -782,12 +873,16 @@ class PatchEmbed0(nn.Module):
             padding (Tuple): padding size of the projection layer.
             in_chans (int): Number of input image channels.
             embed_dim (int):  embed_dim (int): Patch embedding dimension.
+            token_size (int): side of the output token grid, the input is resized to match it.
+            token_stride (int): stride of the 16x16 projection.
         """
         super().__init__()
 
         self.proj = nn.Conv2d(
-            in_chans, embed_dim, kernel_size=16, stride=(8, 8), padding=padding
+            in_chans, embed_dim, kernel_size=16, stride=(token_stride, token_stride), padding=padding
         )
+        # 256+8 for the default 32x32 grid with stride 8
+        self.resize = token_size * token_stride + 16 - token_stride
 
     # def forward(self, x: torch.Tensor) -> torch.Tensor:
     #     x = F.interpolate(x, (256+8, 256+8), mode="bilinear", align_corners=False)
@@ -800,7 +895,7 @@ class PatchEmbed0(nn.Module):
         if x.size(1) == 1:
             x = x.repeat(1, 3, 1, 1)  # 复制通道以创建 RGB 图像
             
-        x = F.interpolate(x, (256+8, 256+8), mode="bilinear", align_corners=False)
+        x = F.interpolate(x, (self.resize, self.resize), mode="bilinear", align_corners=False)
         x = self.proj(x)
         # B C H W -> B H W C
         x = x.permute(0, 2, 3, 1)
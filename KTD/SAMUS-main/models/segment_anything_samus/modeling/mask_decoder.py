@@ -8,7 +8,7 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 
-from typing import List, Tuple, Type
+from typing import List, Optional, Tuple, Type
 
 from .common import LayerNorm2d
 
@@ -78,6 +78,7 @@ class MaskDecoder(nn.Module):
         sparse_prompt_embeddings: torch.Tensor,
         dense_prompt_embeddings: torch.Tensor,
         multimask_output: bool,
+        prompt_padding_mask: Optional[torch.Tensor] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """
         Predict masks given image and prompt embeddings.
@@ -89,6 +90,8 @@ class MaskDecoder(nn.Module):
           dense_prompt_embeddings (torch.Tensor): the embeddings of the mask inputs
           multimask_output (bool): Whether to return multiple masks or a single
             mask.
+          prompt_padding_mask (torch.Tensor or None): BxN, True for the entries
+            of sparse_prompt_embeddings that are padding.
 
         Returns:
           torch.Tensor: batched predicted masks
@@ -99,6 +102,7 @@ class MaskDecoder(nn.Module):
             image_pe=image_pe,
             sparse_prompt_embeddings=sparse_prompt_embeddings,
             dense_prompt_embeddings=dense_prompt_embeddings,
+            prompt_padding_mask=prompt_padding_mask,
         )
 
         # Select the correct mask or masks for output
@@ -118,12 +122,16 @@ class MaskDecoder(nn.Module):
         image_pe: torch.Tensor,                 # 1 256 32 32
         sparse_prompt_embeddings: torch.Tensor, # b 2 256
         dense_prompt_embeddings: torch.Tensor, # b 256 32 32
+        prompt_padding_mask: Optional[torch.Tensor] = None, # b 2
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """Predicts masks. See 'forward' for more details."""
         # Concatenate output tokens
         output_tokens = torch.cat([self.iou_token.weight, self.mask_tokens.weight], dim=0) # 1 iou + 1 total mask + 3 sub mask = (5, 256)
         output_tokens = output_tokens.unsqueeze(0).expand(sparse_prompt_embeddings.size(0), -1, -1) # b 5 256
         tokens = torch.cat((output_tokens, sparse_prompt_embeddings), dim=1) # only cat with sparse_prompt # b 7 256 when sparse_prompt point is 2
+        token_padding_mask = None
+        if prompt_padding_mask is not None:
+            token_padding_mask = torch.cat((prompt_padding_mask.new_zeros(output_tokens.shape[:2]), prompt_padding_mask), dim=1) # b 7
 
         # Expand per-image data in batch direction to be per-mask
         if len(image_embeddings.shape) == 3:
@@ -136,7 +144,7 @@ class MaskDecoder(nn.Module):
         b, c, h, w = src.shape
 
         # Run the transformer
-        hs, src = self.transformer(src, pos_src, tokens) # hs (b nt c), src (b N c)
+        hs, src = self.transformer(src, pos_src, tokens, token_padding_mask) # hs (b nt c), src (b N c)
         iou_token_out = hs[:, 0, :] # b c
         mask_tokens_out = hs[:, 1 : (1 + self.num_mask_tokens), :] # b 4 c
 
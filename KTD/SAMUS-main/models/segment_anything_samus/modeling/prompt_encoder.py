@@ -168,6 +168,55 @@ class PromptEncoder(nn.Module):
 
         return sparse_embeddings, dense_embeddings
 
+    def forward_packed(
+        self,
+        coords: torch.Tensor,
+        labels: torch.Tensor,
+        point_valid: torch.Tensor,
+        boxes: torch.Tensor,
+        box_valid: torch.Tensor,
+        masks: Optional[torch.Tensor] = None,
+        mask_index: Optional[torch.Tensor] = None,
+        embedding_size: Optional[Tuple[int, int]] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Embeds prompts of different kinds and sizes packed into one batch, as
+        'forward' would embed each prompt on its own, plus a padding mask of
+        the sparse embeddings.
+
+        Arguments:
+          coords (torch.Tensor): point coordinates, padded to BxNx2.
+          labels (torch.Tensor): BxN point labels, -1 for the not-a-point entry
+            'forward' appends to points without a box.
+          point_valid (torch.Tensor): BxN, False for padding points.
+          boxes (torch.Tensor): Bx4 boxes, any value where box_valid is False.
+          box_valid (torch.Tensor): B, whether the prompt has a box.
+          masks (torch.Tensor or None): mask inputs (M 1 h w) of the prompts
+            in mask_index (M), the others get the no-mask embedding.
+          embedding_size (tuple(int, int) or None): spatial size of the dense
+            embeddings, image_embedding_size by default.
+
+        Returns:
+          torch.Tensor: sparse embeddings, Bx(N+2)x(embed_dim).
+          torch.Tensor: dense embeddings, Bx(embed_dim)x(embed_H)x(embed_W).
+          torch.Tensor: Bx(N+2), True for padding entries of the sparse embeddings.
+        """
+        bs = coords.shape[0]
+        point_embeddings = self._embed_points(coords, labels, pad=False)
+        box_embeddings = self._embed_boxes(boxes)
+        sparse_embeddings = torch.cat([point_embeddings, box_embeddings], dim=1)
+        padding_mask = ~torch.cat([point_valid, box_valid[:, None].expand(-1, 2)], dim=1)
+
+        embedding_size = embedding_size or self.image_embedding_size
+        dense_embeddings = self.no_mask_embed.weight.reshape(1, -1, 1, 1).expand(
+            bs, -1, embedding_size[0], embedding_size[1]
+        )
+        if masks is not None:
+            dense_embeddings = dense_embeddings.clone()
+            dense_embeddings[mask_index] = self._embed_masks(masks)
+
+        return sparse_embeddings, dense_embeddings, padding_mask
+
 
 class PositionEmbeddingRandom(nn.Module):
     """
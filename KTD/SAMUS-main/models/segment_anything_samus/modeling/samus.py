@@ -9,7 +9,7 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
 from .image_encoder import ImageEncoderViT
 from .mask_decoder import MaskDecoder
@@ -17,6 +17,42 @@ from .prompt_encoder import PromptEncoder
 from einops import rearrange
 from .Auto_Prompt_Generator import AutoPromptGenerator
 
+
+class SamusOutput(dict):
+    """
+    Outputs of Samus.forward. Holds the low resolution logits, "masks" is
+    upsampled to output_size only when it is first read, and upsample()
+    gives the logits at any target size, so training on "low_res_logits"
+    and consumers at other sizes never materialize the default masks.
+    Built like a dict, so DataParallel can gather it.
+    """
+
+    output_size: Tuple[int, int] = (224, 224)
+
+    def upsample(self, size: Optional[Tuple[int, int]] = None) -> torch.Tensor:
+        """Mask logits bilinearly upsampled to size (default output_size), Bx1xHxW."""
+        size = self.output_size if size is None else tuple(int(s) for s in size)
+        if size == self.output_size and dict.__contains__(self, "masks"):
+            return dict.__getitem__(self, "masks")
+        low_res_logits = self["low_res_logits"]
+        if size == tuple(low_res_logits.shape[-2:]):
+            return low_res_logits
+        return F.interpolate(low_res_logits, size, mode="bilinear", align_corners=False)
+
+    def __missing__(self, key: str) -> torch.Tensor:
+        if key != "masks":
+            raise KeyError(key)
+        masks = self.upsample()
+        self["masks"] = masks
+        return masks
+
+    def __contains__(self, key: object) -> bool:
+        return key == "masks" or dict.__contains__(self, key)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self[key] if key in self else default
+
+
 class Samus(nn.Module):
     mask_threshold: float = 0.0
     image_format: str = "RGB"
@@ -111,46 +147,108 @@ class Samus(nn.Module):
         input_images = torch.stack([self.preprocess(x["image"]) for x in batched_input], dim=0)
         image_embeddings = self.image_encoder(input_images)
 
+        # 所有图像的 prompt 打包成一个 batch, 只运行一次 prompt encoder 和 mask decoder
+        counts, packed_prompts = self._pack_prompts(batched_input)
+        image_index = torch.repeat_interleave(
+            torch.arange(len(counts), device=image_embeddings.device),
+            torch.as_tensor(counts, device=image_embeddings.device),
+        )
+        # dense 嵌入与 image encoder 输出同尺寸 (image_embedding_size 可能与之不同)
+        sparse_embeddings, dense_embeddings, padding_mask = self.prompt_encoder.forward_packed(
+            *packed_prompts, embedding_size=tuple(image_embeddings.shape[-2:])
+        )
+        low_res_masks, iou_predictions = self.mask_decoder(
+            image_embeddings=image_embeddings[image_index],
+            image_pe=self.prompt_encoder.get_dense_pe(),
+            sparse_prompt_embeddings=sparse_embeddings,
+            dense_prompt_embeddings=dense_embeddings,
+            multimask_output=multimask_output,
+            prompt_padding_mask=padding_mask,
+        )
+        masks = self.postprocess_masks_grouped(
+            low_res_masks,
+            counts,
+            input_sizes=[x["image"].shape[-2:] for x in batched_input],
+            original_sizes=[x["original_size"] for x in batched_input],
+        )
+
         outputs = []
-        for image_record, curr_embedding in zip(batched_input, image_embeddings):
-            if "point_coords" in image_record:
-                points = (image_record["point_coords"], image_record["point_labels"])
-            else:
-                points = None
-            sparse_embeddings, dense_embeddings = self.prompt_encoder(
-                points=points,
-                boxes=image_record.get("boxes", None),
-                masks=image_record.get("mask_inputs", None),
-            )
-            low_res_masks, iou_predictions = self.mask_decoder(
-                image_embeddings=curr_embedding.unsqueeze(0),
-                image_pe=self.prompt_encoder.get_dense_pe(),
-                sparse_prompt_embeddings=sparse_embeddings,
-                dense_prompt_embeddings=dense_embeddings,
-                multimask_output=multimask_output,
-            )
-            masks = self.postprocess_masks(
-                low_res_masks,
-                input_size=image_record["image"].shape[-2:],
-                original_size=image_record["original_size"],
-            )
-            masks = masks > self.mask_threshold
+        for image_masks, image_iou_predictions, image_low_res_masks in zip(
+            masks, iou_predictions.split(counts), low_res_masks.split(counts)
+        ):
             outputs.append(
                 {
-                    "masks": masks,
-                    "iou_predictions": iou_predictions,
-                    "low_res_logits": low_res_masks,
+                    "masks": image_masks > self.mask_threshold,
+                    "iou_predictions": image_iou_predictions,
+                    "low_res_logits": image_low_res_masks,
                 }
             )
         return outputs
 
+    def _pack_prompts(
+        self, batched_input: List[Dict[str, Any]]
+    ) -> Tuple[List[int], Tuple[torch.Tensor, ...]]:
+        """
+        Packs the prompts of all records of forward_sam into one batch: points
+        are padded to the largest count (plus the not-a-point entry the prompt
+        encoder appends to points without a box), records without points or
+        boxes get invalid ones. Returns the number of prompts of each record and
+        the arguments of PromptEncoder.forward_packed.
+        """
+        counts, num_points = [], 0
+        for record in batched_input:
+            if "point_coords" in record:
+                counts.append(record["point_coords"].shape[0])
+                num_points = max(num_points, record["point_coords"].shape[1] + (record.get("boxes", None) is None))
+            elif record.get("boxes", None) is not None:
+                counts.append(record["boxes"].shape[0])
+            elif record.get("mask_inputs", None) is not None:
+                counts.append(record["mask_inputs"].shape[0])
+            else:
+                counts.append(1)
+
+        num_prompts = sum(counts)
+        coords = torch.zeros((num_prompts, num_points, 2), device=self.device)
+        labels = -torch.ones((num_prompts, num_points), device=self.device)
+        point_valid = torch.zeros((num_prompts, num_points), dtype=torch.bool, device=self.device)
+        boxes = torch.zeros((num_prompts, 4), device=self.device)
+        box_valid = torch.zeros(num_prompts, dtype=torch.bool, device=self.device)
+        masks, mask_index = [], []
+        start = 0
+        for record, count in zip(batched_input, counts):
+            rows = slice(start, start + count)
+            has_box = record.get("boxes", None) is not None
+            if "point_coords" in record:
+                n = record["point_coords"].shape[1]
+                coords[rows, :n] = record["point_coords"]
+                labels[rows, :n] = record["point_labels"].to(labels.dtype)
+                point_valid[rows, :n + (not has_box)] = True  # not-a-point entry: label -1 at (0, 0)
+            if has_box:
+                boxes[rows] = record["boxes"].reshape(count, 4)
+                box_valid[rows] = True
+            if record.get("mask_inputs", None) is not None:
+                masks.append(record["mask_inputs"])
+                mask_index.append(torch.arange(start, start + count, device=self.device))
+            start += count
+
+        if masks:
+            return counts, (coords, labels, point_valid, boxes, box_valid, torch.cat(masks), torch.cat(mask_index))
+        return counts, (coords, labels, point_valid, boxes, box_valid, None, None)
+
     def forward(
         self, 
         imgs: torch.Tensor,
+        *,
+        cnnx: Optional[torch.Tensor] = None,
+        start_block: int = 0,
         # pt: Tuple[torch.Tensor, torch.Tensor],  # [b n 2, b n]
         # bbox: torch.Tensor=None, # b 4
-    ) -> torch.Tensor:
-        imge= self.image_encoder(imgs)
+    ) -> SamusOutput:
+        # 给定 cnnx 时 imgs 为缓存的前 start_block 个 block 的输出 (image_encoder.forward_prefix)
+        if cnnx is None:
+            imge= self.image_encoder(imgs)
+        else:
+            imge= self.image_encoder.forward_suffix(imgs, cnnx, start_block)
         # if len(pt[0].shape) == 3:
         #   se, de = self.prompt_encoder(            # se b 2 256, de b 256 32 32
         #                 points=pt,
@@ -165,8 +263,8 @@ class Samus(nn.Module):
                     dense_prompt_embeddings=de,
                     multimask_output=False,
                     )
-        masks = F.interpolate(low_res_masks, (224, 224), mode="bilinear", align_corners=False)
-        outputs = {"low_res_logits": low_res_masks, "masks": masks}
+        # masks 按需上采样, 训练时 loss 只用 low_res_logits
+        outputs = SamusOutput(low_res_logits=low_res_masks)
         return outputs
         # else:
         #   low_res_masks, masks = [], []
@@ -231,6 +329,42 @@ class Samus(nn.Module):
         masks = F.interpolate(masks, original_size, mode="bilinear", align_corners=False)
         return masks
 
+    def postprocess_masks_grouped(
+        self,
+        masks: torch.Tensor,
+        counts: List[int],
+        input_sizes: List[Tuple[int, ...]],
+        original_sizes: List[Tuple[int, ...]],
+    ) -> List[torch.Tensor]:
+        """
+        postprocess_masks for the masks of several images, stacked in one
+        batch with counts[i] masks of image i: one interpolation to the encoder
+        input size, then one per distinct (input_size, original_size).
+
+        Returns:
+          (list(torch.Tensor)): The masks of each image, counts[i]xCxHxW with
+            (H, W) given by original_sizes[i].
+        """
+        masks = F.interpolate(
+            masks,
+            (self.image_encoder.img_size, self.image_encoder.img_size),
+            mode="bilinear",
+            align_corners=False,
+        )
+        starts = [sum(counts[:i]) for i in range(len(counts))]
+        groups: Dict[Tuple[Tuple[int, ...], Tuple[int, ...]], List[int]] = {}
+        for i, (input_size, original_size) in enumerate(zip(input_sizes, original_sizes)):
+            groups.setdefault((tuple(int(s) for s in input_size), tuple(int(s) for s in original_size)), []).append(i)
+
+        outputs: List[torch.Tensor] = [None] * len(counts)
+        for (input_size, original_size), images in groups.items():
+            group_masks = torch.cat([masks[starts[i]:starts[i] + counts[i]] for i in images])
+            group_masks = group_masks[..., : input_size[0], : input_size[1]]
+            group_masks = F.interpolate(group_masks, original_size, mode="bilinear", align_corners=False)
+            for i, image_masks in zip(images, group_masks.split([counts[i] for i in images])):
+                outputs[i] = image_masks
+        return outputs
+
     def preprocess(self, x: torch.Tensor) -> torch.Tensor:
         """Normalize pixel values and pad to a square input."""
         # Normalize colors
@@ -8,7 +8,7 @@ import torch
 from torch import Tensor, nn
 
 import math
-from typing import Tuple, Type
+from typing import Optional, Tuple, Type
 
 from .common import MLPBlock
 
@@ -109,6 +109,7 @@ class TwoWayTransformer(nn.Module):
         image_embedding: Tensor, # b c h w
         image_pe: Tensor,        # b c h w
         point_embedding: Tensor, # b nt c
+        token_padding_mask: Optional[Tensor] = None, # b nt
     ) -> Tuple[Tensor, Tensor]:
         """
         Args:
@@ -118,6 +119,8 @@ class TwoWayTransformer(nn.Module):
             have the same shape as image_embedding.
         point_embedding (torch.Tensor): the embedding to add to the query points.
             Must have shape B x N_points x embedding_dim for any N_points.
+        token_padding_mask (torch.Tensor or None): B x N_points, True for padding
+            tokens, which no token or image position attends to.
 
         Returns:
         torch.Tensor: the processed point_embedding
@@ -154,6 +157,7 @@ class TwoWayTransformer(nn.Module):
                 keys=keys,
                 query_pe=point_embedding,
                 key_pe=image_pe,
+                token_padding_mask=token_padding_mask,
             )
         
         # Apply the final attention layer from the points to the image
@@ -224,14 +228,19 @@ class TwoWayAttentionBlock(nn.Module):
         self.skip_first_layer_pe = skip_first_layer_pe
 
     def forward(
-        self, queries: Tensor, keys: Tensor, query_pe: Tensor, key_pe: Tensor
+        self,
+        queries: Tensor,
+        keys: Tensor,
+        query_pe: Tensor,
+        key_pe: Tensor,
+        token_padding_mask: Optional[Tensor] = None,
     ) -> Tuple[Tensor, Tensor]:
         # Self attention block
         if self.skip_first_layer_pe:
-            queries = self.self_attn(q=queries, k=queries, v=queries) # self.attention among tokens: (b nt c)
+            queries = self.self_attn(q=queries, k=queries, v=queries, key_padding_mask=token_padding_mask) # self.attention among tokens: (b nt c)
         else:
             q = queries + query_pe
-            attn_out = self.self_attn(q=q, k=q, v=queries)
+            attn_out = self.self_attn(q=q, k=q, v=queries, key_padding_mask=token_padding_mask)
             queries = queries + attn_out
         queries = self.norm1(queries)
 
@@ -250,7 +259,7 @@ class TwoWayAttentionBlock(nn.Module):
         # Cross attention block, image embedding attending to tokens
         q = queries + query_pe # (b nt c)
         k = keys + key_pe   # enhance the positional information before attention 
-        attn_out = self.cross_attn_image_to_token(q=k, k=q, v=queries) #(b N c)
+        attn_out = self.cross_attn_image_to_token(q=k, k=q, v=queries, key_padding_mask=token_padding_mask) #(b N c)
         keys = keys + attn_out
         keys = self.norm4(keys)
 
@@ -290,7 +299,7 @@ class Attention(nn.Module):
         x = x.transpose(1, 2)
         return x.reshape(b, n_tokens, n_heads * c_per_head)  # B x N_tokens x C
 
-    def forward(self, q: Tensor, k: Tensor, v: Tensor) -> Tensor:
+    def forward(self, q: Tensor, k: Tensor, v: Tensor, key_padding_mask: Optional[Tensor] = None) -> Tensor:
         # Input projections
         q = self.q_proj(q)
         k = self.k_proj(k)
@@ -305,6 +314,8 @@ class Attention(nn.Module):
         _, _, _, c_per_head = q.shape
         attn = q @ k.permute(0, 1, 3, 2)  # B x N_heads x N_tokens x N_tokens
         attn = attn / math.sqrt(c_per_head)
+        if key_padding_mask is not None:
+            attn = attn.masked_fill(key_padding_mask[:, None, None, :], float("-inf"))  # B x N_keys, True = padding
         attn = torch.softmax(attn, dim=-1)
 
         # Get output
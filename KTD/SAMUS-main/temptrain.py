@@ -24,6 +24,7 @@ from torch.nn.modules.loss import CrossEntropyLoss
 # from monai.losses import DiceCELoss
 from einops import rearrange
 from models.model_dict import get_model
+from models.segment_anything_samus.modeling import slim_apg_state_dict
 from utils.data_us import JointTransform2D, ImageToImage2D
 from utils.loss_functions.sam_loss import get_criterion
 from utils.generate_prompts import get_click_prompt
@@ -120,6 +121,7 @@ def main():
     parser.add_argument('--warmup', type=bool, default=False, help='If activated, warp up the learning from a lower lr to the base_lr') 
     parser.add_argument('--warmup_period', type=int, default=250, help='Warp up iterations, only valid whrn warmup is activated')
     parser.add_argument('-keep_log', type=bool, default=True, help='keep the loss&lr&dice during training or not')
+    parser.add_argument('--slim_apg', action='store_true', help='build the AutoPromptGenerator without its unused submodules (see convert_slim_apg.py)')
 
     args = parser.parse_args()
     opt = get_config(args.task)
@@ -182,6 +184,8 @@ def main():
                 new_state_dict[k[7:]] = v
             else:
                 new_state_dict[k] = v
+        if args.slim_apg:
+            new_state_dict = slim_apg_state_dict(new_state_dict)
         model.load_state_dict(new_state_dict)
       
     if args.n_gpu > 1:
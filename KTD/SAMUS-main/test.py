@@ -24,6 +24,7 @@ from torch.nn.modules.loss import CrossEntropyLoss
 from monai.losses import DiceCELoss
 from einops import rearrange
 from models.model_dict import get_model
+from models.segment_anything_samus.modeling import slim_apg_state_dict
 from utils.data_us import JointTransform2D, ImageToImage2D
 from utils.loss_functions.sam_loss import get_criterion
 from utils.generate_prompts import get_click_prompt
@@ -49,6 +50,9 @@ def main():
     parser.add_argument('--warmup_period', type=int, default=250, help='Warp up iterations, only valid whrn warmup is activated')
     parser.add_argument('-keep_log', type=bool, default=False, help='keep the loss&lr&dice during training or not')
     parser.add_argument('--device', type=str, default='cuda', help='cuda or cpu')
+    parser.add_argument('--slim_apg', action='store_true', help='build the AutoPromptGenerator without its unused submodules (see convert_slim_apg.py)')
+    parser.add_argument('--encoder_token_size', type=int, default=32, help='token grid side shared by the ViT and CNN branches of SAMUS, low_image_size must be 4x it')
+    parser.add_argument('--encoder_patch_stride', type=int, default=8, help='patch embedding stride of SAMUS, the CNN branch runs at encoder_token_size * encoder_patch_stride')
 
     args = parser.parse_args()
     opt = get_config(args.task)  # please configure your hyper-parameter
@@ -56,6 +60,7 @@ def main():
     opt.mode = "val"
     #opt.classes=2
     opt.visual = True
+    opt.visual_compare = -1  # every test slice, rendered in background processes
     #opt.eval_mode = "patient"
     opt.modelname = args.modelname
     args.device = opt.device
@@ -95,6 +100,8 @@ def main():
             new_state_dict[k[7:]] = v
         else:
             new_state_dict[k] = v
+    if args.slim_apg:
+        new_state_dict = slim_apg_state_dict(new_state_dict)
     model.load_state_dict(new_state_dict)
     
 
@@ -24,6 +24,8 @@ from torch.nn.modules.loss import CrossEntropyLoss
 # from monai.losses import DiceCELoss
 from einops import rearrange
 from models.model_dict import get_model
+from models.segment_anything_samus.modeling import slim_apg_state_dict
+from utils.feature_cache import SeededAugmentation, FeatureCache, CachedPrefixDataset
 from utils.data_us import JointTransform2D, ImageToImage2D
 from utils.loss_functions.sam_loss import get_criterion
 from utils.generate_prompts import get_click_prompt
@@ -121,6 +123,12 @@ def main():
     parser.add_argument('--warmup', type=bool, default=False, help='If activated, warp up the learning from a lower lr to the base_lr') 
     parser.add_argument('--warmup_period', type=int, default=250, help='Warp up iterations, only valid whrn warmup is activated')
     parser.add_argument('-keep_log', type=bool, default=True, help='keep the loss&lr&dice during training or not')
+    parser.add_argument('--slim_apg', action='store_true', help='build the AutoPromptGenerator without its unused submodules (see convert_slim_apg.py)')
+    parser.add_argument('--encoder_token_size', type=int, default=32, help='token grid side shared by the ViT and CNN branches of SAMUS, low_image_size must be 4x it')
+    parser.add_argument('--encoder_patch_stride', type=int, default=8, help='patch embedding stride of SAMUS, the CNN branch runs at encoder_token_size * encoder_patch_stride')
+    parser.add_argument('--prefix_cache_dir', type=str, default='', help='if set, freeze the image encoder up to --prefix_blocks and train from its activations cached here')
+    parser.add_argument('--prefix_blocks', type=int, default=12, help='encoder blocks in the frozen, cached prefix (12 = the whole ViT-B, only the neck, APG and decoder run)')
+    parser.add_argument('--prefix_seeds', type=int, default=4, help='cached augmentations per training image, epoch e uses seed e %% prefix_seeds')
 
     args = parser.parse_args()
     opt = get_config(args.task)
@@ -181,7 +189,19 @@ def main():
                 new_state_dict[k[7:]] = v
             else:
                 new_state_dict[k] = v
+        if args.slim_apg:
+            new_state_dict = slim_apg_state_dict(new_state_dict)
         model.load_state_dict(new_state_dict)
+
+    if args.prefix_cache_dir:
+        # 冻结 image encoder 前缀, 训练集按 (图像, 增强种子) 预先计算并缓存前缀输出
+        model.image_encoder.freeze_prefix(args.prefix_blocks)
+        seeded_dataset = SeededAugmentation(train_dataset, num_seeds=args.prefix_seeds, base_seed=seed_value)
+        prefix_cache = FeatureCache(args.prefix_cache_dir, model.image_encoder, args.prefix_blocks, seeded_dataset,
+                                    meta={'task': args.task, 'split': opt.train_split, 'encoder_input_size': args.encoder_input_size})
+        prefix_cache.build(model.image_encoder, device, batch_size=opt.batch_size)
+        train_dataset = CachedPrefixDataset(prefix_cache)
+        trainloader = DataLoader(train_dataset, batch_size=opt.batch_size, shuffle=True, num_workers=8, pin_memory=True)
       
     if args.n_gpu > 1:
         model = nn.DataParallel(model)
@@ -218,8 +238,9 @@ def main():
         #  --------------------------------------------------------- training ---------------------------------------------------------
         model.train()
         train_losses = 0
+        if args.prefix_cache_dir:
+            train_dataset.set_epoch(epoch)
         for batch_idx, (datapack) in enumerate(trainloader):
-            imgs = datapack['image'].to(dtype = torch.float32, device=opt.device)
             masks = datapack['low_mask'].to(dtype = torch.float32, device=opt.device)
             
             # class_labels = torch.as_tensor(datapack['class_label'],dtype = torch.float32, device=opt.device)
@@ -227,7 +248,13 @@ def main():
             # pt = get_click_prompt(datapack, opt)
             # print(imgs.shape) # 8 1 256 256
             # -------------------------------------------------------- forward --------------------------------------------------------
-            pred = model(imgs) # pred = model(imgs, pt, bbox)
+            if args.prefix_cache_dir:
+                prefix_x = datapack['prefix_x'].to(dtype = torch.float32, device=opt.device)
+                prefix_cnnx = datapack['prefix_cnnx'].to(dtype = torch.float32, device=opt.device)
+                pred = model(prefix_x, cnnx=prefix_cnnx, start_block=args.prefix_blocks)
+            else:
+                imgs = datapack['image'].to(dtype = torch.float32, device=opt.device)
+                pred = model(imgs) # pred = model(imgs, pt, bbox)
             train_loss = criterion(pred, masks)
             # -------------------------------------------------------- backward -------------------------------------------------------
             optimizer.zero_grad()
@@ -29,6 +29,9 @@ class Config_US30K:
     pre_trained = False
     mode = "train"
     visual = False
+    visual_compare = 0                  # ori/gt/pred/crop strips written per evaluation, -1 for all slices, 0 disables
+    visual_compare_mode = "first"       # "first": the first visual_compare slices, "worst": the lowest-Dice ones
+    patient_pattern = None              # patient-level key regex on image names, None uses obtain_patien_id
     modelname = "SAM"
 
 # -------------------------------------------------------------------------------------------------
@@ -63,6 +66,9 @@ class Config_TN3K:
     pre_trained = False
     mode = "train"
     visual = False
+    visual_compare = 0                  # ori/gt/pred/crop strips written per evaluation, -1 for all slices, 0 disables
+    visual_compare_mode = "first"       # "first": the first visual_compare slices, "worst": the lowest-Dice ones
+    patient_pattern = None              # patient-level key regex on image names, None uses obtain_patien_id
     modelname = "SAMUS"
 
     # 分类参数
@@ -107,6 +113,9 @@ class Config_KTD:
     pre_trained = False
     mode = "train"
     visual = False
+    visual_compare = 0                  # ori/gt/pred/crop strips written per evaluation, -1 for all slices, 0 disables
+    visual_compare_mode = "first"       # "first": the first visual_compare slices, "worst": the lowest-Dice ones
+    patient_pattern = None              # patient-level key regex on image names, None uses obtain_patien_id
     modelname = "SAMUS"
 
     # 分类参数
@@ -150,6 +159,9 @@ class Config_BUSI:
     pre_trained = False
     mode = "train"
     visual = False
+    visual_compare = 0                  # ori/gt/pred/crop strips written per evaluation, -1 for all slices, 0 disables
+    visual_compare_mode = "first"       # "first": the first visual_compare slices, "worst": the lowest-Dice ones
+    patient_pattern = None              # patient-level key regex on image names, None uses obtain_patien_id
     modelname = "SAM"
 
 class Config_CAMUS:
@@ -183,6 +195,9 @@ class Config_CAMUS:
     pre_trained = False
     mode = "train"
     visual = False
+    visual_compare = 0                  # ori/gt/pred/crop strips written per evaluation, -1 for all slices, 0 disables
+    visual_compare_mode = "first"       # "first": the first visual_compare slices, "worst": the lowest-Dice ones
+    patient_pattern = r"^(\d{4})_(\d)"    # patient-level key regex on image names, (patient, view) of xxxx_2CH_xxx
     modelname = "SAM"
 
 class Config_OurDataset:
@@ -215,6 +230,9 @@ class Config_OurDataset:
     pre_trained = False
     mode = "train"
     visual = False
+    visual_compare = 0                  # ori/gt/pred/crop strips written per evaluation, -1 for all slices, 0 disables
+    visual_compare_mode = "first"       # "first": the first visual_compare slices, "worst": the lowest-Dice ones
+    patient_pattern = None              # patient-level key regex on image names, None uses obtain_patien_id
     modelname = "SAM"
 class Config_UUSIC:
     datatype="private_Thyroid/"
@@ -249,6 +267,9 @@ class Config_UUSIC:
     pre_trained = False
     mode = "train"
     visual = False
+    visual_compare = 0                  # ori/gt/pred/crop strips written per evaluation, -1 for all slices, 0 disables
+    visual_compare_mode = "first"       # "first": the first visual_compare slices, "worst": the lowest-Dice ones
+    patient_pattern = None              # patient-level key regex on image names, None uses obtain_patien_id
     modelname = "SAMUS"
 
     # 分类参数
@@ -3,12 +3,13 @@ from tkinter import image_names
 from torch.autograd import Variable
 from torch.utils.data import DataLoader
 import os
+import re
 import numpy as np
 import torch
 import torch.nn.functional as F
 import utils.metrics as metrics
-from hausdorff import hausdorff_distance
-from utils.visualization import visual_segmentation, visual_segmentation_binary, visual_segmentation_sets, visual_segmentation_sets_with_pt,visual_compare
+from utils.streaming_metrics import WelfordAccumulator, PatientAccumulator
+from utils.visualization import visual_segmentation, visual_segmentation_binary, visual_segmentation_sets, visual_segmentation_sets_with_pt, VisualWriter
 from einops import rearrange
 from utils.generate_prompts import get_click_prompt
 import time
@@ -29,6 +30,22 @@ def obtain_patien_id(filename):
         patientid = filename[:3]
     return patientid
 
+def patient_key(filename, pattern=None):
+    # patient-level grouping key of a slice: the groups of the dataset regex (opt.patient_pattern),
+    # e.g. (patient, view) for CAMUS, or obtain_patien_id when no pattern is configured
+    if pattern is None:
+        return obtain_patien_id(filename)
+    match = re.match(pattern, filename)
+    if match is None:
+        raise ValueError("image name %s does not match patient pattern %s" % (filename, pattern))
+    return match.groups()
+
+def mask_logits(pred, size):
+    # mask logits at the size of the ground truth, SAMUS outputs are upsampled once from the low-res logits
+    if hasattr(pred, 'upsample'):
+        return pred.upsample(size)
+    return pred['masks']
+
 def eval_mask_slice(valloader, model, criterion, opt, args):
     model.eval()
     val_losses, mean_dice = 0, 0
@@ -57,25 +74,17 @@ def eval_mask_slice(valloader, model, criterion, opt, args):
         else:
             gt = label.detach().cpu().numpy()
         gt = gt[:, 0, :, :]
-        predict = torch.sigmoid(pred['masks'])
+        predict = torch.sigmoid(mask_logits(pred, gt.shape[-2:]))
         predict = predict.detach().cpu().numpy()  # (b, c, h, w)
         seg = predict[:, 0, :, :] > 0.5  # (b, h, w)
         b, h, w = seg.shape
-        for j in range(0, b):
-            pred_i = np.zeros((1, h, w))
-            pred_i[seg[j:j+1, :, :] == 1] = 255
-            gt_i = np.zeros((1, h, w))
-            gt_i[gt[j:j+1, :, :] == 1] = 255
-            dice_i = metrics.dice_coefficient(pred_i, gt_i)
-            #print("name:", name[j], "coord:", coords_torch[j], "dice:", dice_i)
-            dices[1] += dice_i
-            iou, acc, se, sp = metrics.sespiou_coefficient2(pred_i, gt_i, all=False)
-            ious[1] += iou
-            accs[1] += acc
-            ses[1] += se
-            sps[1] += sp
-            hds[1] += hausdorff_distance(pred_i[0, :, :], gt_i[0, :, :], distance="manhattan")
-            del pred_i, gt_i
+        hds[1] += metrics.hausdorff_metrics(seg, gt == 1, device=opt.device)[0].sum()
+        batch_metrics = metrics.batch_metrics(seg, gt == 1)
+        dices[1] += batch_metrics['dice'].sum()
+        ious[1] += batch_metrics['iou'].sum()
+        accs[1] += batch_metrics['acc'].sum()
+        ses[1] += batch_metrics['se'].sum()
+        sps[1] += batch_metrics['sp'].sum()
         eval_number = eval_number + b
     dices = dices / eval_number
     hds = hds / eval_number
@@ -94,10 +103,11 @@ def eval_mask_slice(valloader, model, criterion, opt, args):
 def eval_mask_slice2(valloader, model, criterion, opt, args,epoch):
     model.eval()
     val_losses, mean_dice = 0, 0
-    max_slice_number = opt.batch_size * (len(valloader) + 1)
-    dices = np.zeros((max_slice_number, opt.classes))
-    hds = np.zeros((max_slice_number, opt.classes))
-    ious, accs, ses, sps = np.zeros((max_slice_number, opt.classes)), np.zeros((max_slice_number, opt.classes)), np.zeros((max_slice_number, opt.classes)), np.zeros((max_slice_number, opt.classes))
+    # per-slice metrics are streamed into O(classes) mean/std accumulators
+    dices, hds = WelfordAccumulator(opt.classes), WelfordAccumulator(opt.classes)
+    ious, accs, ses, sps = [WelfordAccumulator(opt.classes) for _ in range(4)]
+    # comparison figures are sampled and rendered by background processes, off by default in training
+    writer = VisualWriter(opt, epoch, num_samples=opt.visual_compare, mode=opt.visual_compare_mode)
     eval_number = 0
     sum_time = 0
     for batch_idx, (datapack) in enumerate(valloader):
@@ -122,83 +132,53 @@ def eval_mask_slice2(valloader, model, criterion, opt, args,epoch):
         else:
             gt = label.detach().cpu().numpy()
         gt = gt[:, 0, :, :]
-        predict = torch.sigmoid(pred['masks'])
+        predict = torch.sigmoid(mask_logits(pred, gt.shape[-2:]))
         predict = predict.detach().cpu().numpy()  # (b, c, h, w)
         seg = predict[:, 0, :, :] > 0.5  # (b, h, w)
         b, h, w = seg.shape
+        gt_masks = []
         for j in range(0, b):
-            pred_i = np.zeros((1, h, w))
-            pred_i[seg[j:j+1, :, :] == 1] = 255
-            gt_i = np.zeros((1, h, w))
-            # gt_i[gt[j:j+1, :, :] == 1] = 255
-            # 添加调试信息
-            # print(f"gt.shape: {gt.shape}, gt_i.shape: {gt_i.shape}")
-            # print(f"j: {j}")
-
             # 安全地进行布尔索引
             # 创建掩码
             mask = gt[j:j+1, :, :] == 1
-            # print(f"mask.shape: {mask.shape}")
-            
-            # 调整掩码大小以匹配 gt_i
-            if mask.shape[1:] != gt_i.shape[1:]:
+            # 调整掩码大小以匹配预测
+            if mask.shape[1:] != (h, w):
                 from scipy.ndimage import zoom
                 # 计算缩放比例
-                zoom_factors = (1, gt_i.shape[1]/mask.shape[1], gt_i.shape[2]/mask.shape[2])
-                print(f"调整掩码尺寸: {mask.shape} -> {gt_i.shape}, 缩放因子: {zoom_factors}")
+                zoom_factors = (1, h/mask.shape[1], w/mask.shape[2])
+                print(f"调整掩码尺寸: {mask.shape} -> {(1, h, w)}, 缩放因子: {zoom_factors}")
                 # 使用最近邻插值调整掩码大小（保持二值特性）
                 mask = zoom(mask.astype(np.uint8), zoom_factors, order=0).astype(bool)
-            
-            # 应用调整后的掩码
-            gt_i[mask] = 255
-            dice_i = metrics.dice_coefficient(pred_i, gt_i)
-            #print("name:", name[j], "coord:", coords_torch[j], "dice:", dice_i)
-            dices[eval_number+j, 1] += dice_i
-            iou, acc, se, sp = metrics.sespiou_coefficient2(pred_i, gt_i, all=False)
-            ious[eval_number+j, 1] += iou
-            accs[eval_number+j, 1] += acc
-            ses[eval_number+j, 1] += se
-            sps[eval_number+j, 1] += sp
-            hds[eval_number+j, 1] += hausdorff_distance(pred_i[0, :, :], gt_i[0, :, :], distance="manhattan")
-            # # 保存图片
-            visual_compare(image_filename[j],pred_i,gt_i,opt,epoch)
-            del pred_i, gt_i
+            gt_masks.append(mask[0])
+        gt_masks = np.stack(gt_masks)
+        batch_metrics = metrics.batch_metrics(seg, gt_masks)
+        dices.update(batch_metrics['dice'])
+        ious.update(batch_metrics['iou'])
+        accs.update(batch_metrics['acc'])
+        ses.update(batch_metrics['se'])
+        sps.update(batch_metrics['sp'])
+        for j in range(0, b):
+            # 保存图片（后台进程）
+            writer.submit(image_filename[j], seg[j], gt_masks[j], batch_metrics['dice'][j])
             if opt.visual:
                 visual_segmentation_sets(seg[j:j+1, :, :], image_filename[j], opt)
+        hds.update(metrics.hausdorff_metrics(seg, gt_masks, device=opt.device)[0])
         eval_number = eval_number + b
-    dices = dices[:eval_number, :] 
-    hds = hds[:eval_number, :] 
-    ious, accs, ses, sps = ious[:eval_number, :], accs[:eval_number, :], ses[:eval_number, :], sps[:eval_number, :]
+    writer.close()
     val_losses = val_losses / (batch_idx + 1)
 
-    dice_mean = np.mean(dices, axis=0)
-    dices_std = np.std(dices, axis=0)
-    hd_mean = np.mean(hds, axis=0)
-    hd_std = np.std(hds, axis=0)
-
-    mean_dice = np.mean(dice_mean[1:])
-    mean_hdis = np.mean(hd_mean[1:])
+    mean_dice = np.mean(dices.mean()[1:])
+    mean_hdis = np.mean(hds.mean()[1:])
     print("test speed", eval_number/sum_time)
     if opt.mode == "train":
-        return dices, mean_dice, mean_hdis, val_losses
+        return dices.mean(), mean_dice, mean_hdis, val_losses
     else:
-        # data = pd.DataFrame(dices*100)
-        # writer = pd.ExcelWriter('./result/' + args.task + '/PT10-' + opt.modelname + '.xlsx')
-        # data.to_excel(writer, 'page_1', float_format='%.2f')
-        # writer._save()
-
-        dice_mean = np.mean(dices*100, axis=0)
-        dices_std = np.std(dices*100, axis=0)
-        hd_mean = np.mean(hds, axis=0)
-        hd_std = np.std(hds, axis=0)
-        iou_mean = np.mean(ious*100, axis=0)
-        iou_std = np.std(ious*100, axis=0)
-        acc_mean = np.mean(accs*100, axis=0)
-        acc_std = np.std(accs*100, axis=0)
-        se_mean = np.mean(ses*100, axis=0)
-        se_std = np.std(ses*100, axis=0)
-        sp_mean = np.mean(sps*100, axis=0)
-        sp_std = np.std(sps*100, axis=0)
+        dice_mean, dices_std = dices.mean()*100, dices.std()*100
+        hd_mean, hd_std = hds.mean(), hds.std()
+        iou_mean, iou_std = ious.mean()*100, ious.std()*100
+        acc_mean, acc_std = accs.mean()*100, accs.std()*100
+        se_mean, se_std = ses.mean()*100, ses.std()*100
+        sp_mean, sp_std = sps.mean()*100, sps.std()*100
         return dice_mean, hd_mean, iou_mean, acc_mean, se_mean, sp_mean, dices_std, hd_std, iou_std, acc_std, se_std, sp_std
 
 def eval_F_score(valloader, model, criterion, opt, args):
@@ -273,11 +253,8 @@ def eval_camus_patient(valloader, model, criterion, opt, args):
     model.eval()
     val_losses, mean_dice = 0, 0
     dices = np.zeros(opt.classes)
-    patientnumber = 6000  # maxnum patient number
-    flag = np.zeros(patientnumber)  # record the patients
-    tps, fps = np.zeros((patientnumber, opt.classes)), np.zeros((patientnumber, opt.classes))
-    tns, fns = np.zeros((patientnumber, opt.classes)), np.zeros((patientnumber, opt.classes))
-    hds = np.zeros((patientnumber, opt.classes))
+    # per-patient sums keyed by the patient identifiers parsed from the image names
+    patients = PatientAccumulator(opt.classes)
     for batch_idx, (datapack) in enumerate(valloader):
         imgs = Variable(datapack['image'].to(dtype = torch.float32, device=opt.device))
         masks = Variable(datapack['low_mask'].to(dtype = torch.float32, device=opt.device))
@@ -304,39 +281,20 @@ def eval_camus_patient(valloader, model, criterion, opt, args):
         # predict = predict.detach().cpu().numpy()  # (b, c, h, w)
         # seg = predict[:, 0, :, :] > 0.5  # (b, h, w)
 
-        predict = F.softmax(pred['masks'], dim=1)
+        predict = F.softmax(mask_logits(pred, gt.shape[-2:]), dim=1)
         pred = predict.detach().cpu().numpy()  # (b, c, h, w)
         seg = np.argmax(pred, axis=1)
 
         b, h, w = seg.shape
-        for j in range(0, b):
-            patient_number = int(image_filename[j][:4]) # xxxx_2CH_xxx
-            antrum = int(image_filename[j][5])
-            if antrum == 2:
-                patientid = patient_number
-            elif antrum == 3:
-                patientid = 2000 + patient_number
-            else:
-                patientid = 4000 + patient_number
-            flag[patientid] = flag[patientid] + 1
-            pred_i = np.zeros((1, h, w))
-            pred_i[seg[j:j+1, :, :] == 1] = 255
-            gt_i = np.zeros((1, h, w))
-            gt_i[gt[j:j+1, :, :] == 1] = 255
-            tp, fp, tn, fn = metrics.get_matrix(pred_i, gt_i)
-            hd = hausdorff_distance(pred_i[0, :, :], gt_i[0, :, :], distance="manhattan")
-            hds[patientid, class_id[j]] += hd
-            tps[patientid, class_id[j]] += tp
-            fps[patientid, class_id[j]] += fp
-            tns[patientid, class_id[j]] += tn
-            fns[patientid, class_id[j]] += fn
-            if opt.visual:
+        hd_batch = metrics.hausdorff_metrics(seg == 1, gt == 1, device=opt.device)[0]
+        tp_batch, fp_batch, tn_batch, fn_batch = metrics.confusion_matrix_batch(seg == 1, gt == 1)
+        patients.update([patient_key(name, opt.patient_pattern) for name in image_filename], class_id,
+                        tp_batch, fp_batch, tn_batch, fn_batch, hd_batch)
+        if opt.visual:
+            for j in range(0, b):
                 visual_segmentation(seg[j:j+1, :, :], image_filename[j], opt)
-    tps = tps[flag > 0, :]
-    fps = fps[flag > 0, :]
-    tns = tns[flag > 0, :]
-    fns = fns[flag > 0, :]
-    hds = hds[flag > 0, :] / (flag[flag>0][:, None]/(opt.classes-1))
+    tps, fps, tns, fns = patients.counts()
+    hds = patients.hausdorff(opt.classes-1)
     patient_dices = (2 * tps + 1e-5) / (2 * tps + fps + fns + 1e-5)  # p c
     dices = np.mean(patient_dices, axis=0)  # c
     hdis = np.mean(hds, axis=0)
@@ -371,11 +329,8 @@ def eval_patient(valloader, model, criterion, opt, args):
     model.eval()
     val_losses, mean_dice = 0, 0
     dices = np.zeros(opt.classes)
-    patientnumber = 5000  # maxnum patient number
-    flag = np.zeros(patientnumber)  # record the patients
-    tps, fps = np.zeros((patientnumber, opt.classes)), np.zeros((patientnumber, opt.classes))
-    tns, fns = np.zeros((patientnumber, opt.classes)), np.zeros((patientnumber, opt.classes))
-    hds = np.zeros((patientnumber, opt.classes))
+    # per-patient sums keyed by the patient identifiers parsed from the image names
+    patients = PatientAccumulator(opt.classes)
     for batch_idx, (datapack) in enumerate(valloader):
         imgs = Variable(datapack['image'].to(dtype = torch.float32, device=opt.device))
         masks = Variable(datapack['low_mask'].to(dtype = torch.float32, device=opt.device))
@@ -398,7 +353,7 @@ def eval_patient(valloader, model, criterion, opt, args):
             gt = label.detach().cpu().numpy()
         gt = gt[:, 0, :, :]
 
-        predict = torch.sigmoid(pred['masks'])
+        predict = torch.sigmoid(mask_logits(pred, gt.shape[-2:]))
         predict = predict.detach().cpu().numpy()  # (b, c, h, w)
         seg = predict[:, 0, :, :] > 0.5  # (b, h, w)
         
@@ -408,27 +363,15 @@ def eval_patient(valloader, model, criterion, opt, args):
         # seg = np.argmax(pred, axis=1)
 
         b, h, w = seg.shape
-        for j in range(0, b):
-            patientid = int(obtain_patien_id(image_filename[j]))
-            flag[patientid] = flag[patientid] + 1
-            pred_i = np.zeros((1, h, w))
-            pred_i[seg[j:j+1, :, :] == 1] = 255
-            gt_i = np.zeros((1, h, w))
-            gt_i[gt[j:j+1, :, :] == 1] = 255
-            tp, fp, tn, fn = metrics.get_matrix(pred_i, gt_i)
-            hd = hausdorff_distance(pred_i[0, :, :], gt_i[0, :, :], distance="manhattan")
-            hds[patientid, class_id[j]] += hd
-            tps[patientid, class_id[j]] += tp
-            fps[patientid, class_id[j]] += fp
-            tns[patientid, class_id[j]] += tn
-            fns[patientid, class_id[j]] += fn
-            if opt.visual:
+        hd_batch = metrics.hausdorff_metrics(seg == 1, gt == 1, device=opt.device)[0]
+        tp_batch, fp_batch, tn_batch, fn_batch = metrics.confusion_matrix_batch(seg == 1, gt == 1)
+        patients.update([patient_key(name, opt.patient_pattern) for name in image_filename], class_id,
+                        tp_batch, fp_batch, tn_batch, fn_batch, hd_batch)
+        if opt.visual:
+            for j in range(0, b):
                 visual_segmentation(seg[j:j+1, :, :], image_filename[j], opt)
-    tps = tps[flag > 0, :]
-    fps = fps[flag > 0, :]
-    tns = tns[flag > 0, :]
-    fns = fns[flag > 0, :]
-    hds = hds[flag > 0, :] / (flag[flag>0][:, None]/(opt.classes-1))
+    tps, fps, tns, fns = patients.counts()
+    hds = patients.hausdorff(opt.classes-1)
     patient_dices = (2 * tps + 1e-5) / (2 * tps + fps + fns + 1e-5)  # p c
     dices = np.mean(patient_dices, axis=0)  # c
     hdis = np.mean(hds, axis=0)
@@ -462,10 +405,9 @@ def eval_patient(valloader, model, criterion, opt, args):
 def eval_slice(valloader, model, criterion, opt, args):
     model.eval()
     val_losses, mean_dice = 0, 0
-    max_slice_number = opt.batch_size * (len(valloader) + 1)
-    dices = np.zeros((max_slice_number, opt.classes))
-    hds = np.zeros((max_slice_number, opt.classes))
-    ious, accs, ses, sps = np.zeros((max_slice_number, opt.classes)), np.zeros((max_slice_number, opt.classes)), np.zeros((max_slice_number, opt.classes)), np.zeros((max_slice_number, opt.classes))
+    # per-slice metrics are streamed into O(classes) mean/std accumulators
+    dices, hds = WelfordAccumulator(opt.classes), WelfordAccumulator(opt.classes)
+    ious, accs, ses, sps = [WelfordAccumulator(opt.classes) for _ in range(4)]
     eval_number = 0
     sum_time = 0
     for batch_idx, (datapack) in enumerate(valloader):
@@ -488,60 +430,36 @@ def eval_slice(valloader, model, criterion, opt, args):
         else:
             gt = label.detach().cpu().numpy()
         gt = gt[:, 0, :, :]
-        predict_masks = pred['masks']
+        predict_masks = mask_logits(pred, gt.shape[-2:])
         predict_masks = torch.softmax(predict_masks, dim=1)
         pred = predict_masks.detach().cpu().numpy()  # (b, c, h, w)
         seg = np.argmax(pred, axis=1)  # (b, h, w)
         b, h, w = seg.shape
-        for j in range(0, b):
-            pred_i = np.zeros((1, h, w))
-            pred_i[seg[j:j+1, :, :] == 1] = 255
-            gt_i = np.zeros((1, h, w))
-            gt_i[gt[j:j+1, :, :] == 1] = 255
-            dices[eval_number+j, 1] += metrics.dice_coefficient(pred_i, gt_i)
-            iou, acc, se, sp = metrics.sespiou_coefficient2(pred_i, gt_i, all=False)
-            ious[eval_number+j, 1] += iou
-            accs[eval_number+j, 1] += acc
-            ses[eval_number+j, 1] += se
-            sps[eval_number+j, 1] += sp
-            hds[eval_number+j, 1] += hausdorff_distance(pred_i[0, :, :], gt_i[0, :, :], distance="manhattan")
-            del pred_i, gt_i
-            if opt.visual:
+        batch_metrics = metrics.batch_metrics(seg == 1, gt == 1)
+        dices.update(batch_metrics['dice'])
+        ious.update(batch_metrics['iou'])
+        accs.update(batch_metrics['acc'])
+        ses.update(batch_metrics['se'])
+        sps.update(batch_metrics['sp'])
+        if opt.visual:
+            for j in range(0, b):
                 visual_segmentation_sets_with_pt(seg[j:j+1, :, :], image_filename[j], opt, pt[0][j, :, :])
+        hds.update(metrics.hausdorff_metrics(seg == 1, gt == 1, device=opt.device)[0])
         eval_number = eval_number + b
-    dices = dices[:eval_number, :] 
-    hds = hds[:eval_number, :] 
-    ious, accs, ses, sps = ious[:eval_number, :], accs[:eval_number, :], ses[:eval_number, :], sps[:eval_number, :]
     val_losses = val_losses / (batch_idx + 1)
 
-    dice_mean = np.mean(dices, axis=0)
-    dices_std = np.std(dices, axis=0)
-    hd_mean = np.mean(hds, axis=0)
-    hd_std = np.std(hds, axis=0)
-
-    mean_dice = np.mean(dice_mean[1:])
-    mean_hdis = np.mean(hd_mean[1:])
+    mean_dice = np.mean(dices.mean()[1:])
+    mean_hdis = np.mean(hds.mean()[1:])
     print("test speed", eval_number/sum_time)
     if opt.mode == "train":
-        return dices, mean_dice, mean_hdis, val_losses
+        return dices.mean(), mean_dice, mean_hdis, val_losses
     else:
-        # data = pd.DataFrame(dices*100)
-        # writer = pd.ExcelWriter('./result/' + args.task + '/PT10-' + opt.modelname + '.xlsx')
-        # data.to_excel(writer, 'page_1', float_format='%.2f')
-        # writer._save()
-
-        dice_mean = np.mean(dices*100, axis=0)
-        dices_std = np.std(dices*100, axis=0)
-        hd_mean = np.mean(hds, axis=0)
-        hd_std = np.std(hds, axis=0)
-        iou_mean = np.mean(ious*100, axis=0)
-        iou_std = np.std(ious*100, axis=0)
-        acc_mean = np.mean(accs*100, axis=0)
-        acc_std = np.std(accs*100, axis=0)
-        se_mean = np.mean(ses*100, axis=0)
-        se_std = np.std(ses*100, axis=0)
-        sp_mean = np.mean(sps*100, axis=0)
-        sp_std = np.std(sps*100, axis=0)
+        dice_mean, dices_std = dices.mean()*100, dices.std()*100
+        hd_mean, hd_std = hds.mean(), hds.std()
+        iou_mean, iou_std = ious.mean()*100, ious.std()*100
+        acc_mean, acc_std = accs.mean()*100, accs.std()*100
+        se_mean, se_std = ses.mean()*100, ses.std()*100
+        sp_mean, sp_std = sps.mean()*100, sps.std()*100
         return dice_mean, hd_mean, iou_mean, acc_mean, se_mean, sp_mean, dices_std, hd_std, iou_std, acc_std, se_std, sp_std
 
 
@@ -550,11 +468,8 @@ def eval_camus_samed(valloader, model, criterion, opt, args):
     val_losses, mean_dice = 0, 0
     classes = 4
     dices = np.zeros(classes)
-    patientnumber = 6000  # maxnum patient number
-    flag = np.zeros(patientnumber)  # record the patients
-    tps, fps = np.zeros((patientnumber, classes)), np.zeros((patientnumber, classes))
-    tns, fns = np.zeros((patientnumber, classes)), np.zeros((patientnumber, classes))
-    hds = np.zeros((patientnumber, classes))
+    # per-patient sums keyed by the patient identifiers parsed from the image names
+    patients = PatientAccumulator(classes)
     eval_number = 0
     sum_time = 0
     for batch_idx, (datapack) in enumerate(valloader):
@@ -580,40 +495,21 @@ def eval_camus_samed(valloader, model, criterion, opt, args):
         else:
             gt = label.detach().cpu().numpy()
         gt = gt[:, 0, :, :]
-        predict_masks = pred['masks']
+        predict_masks = mask_logits(pred, gt.shape[-2:])
         predict_masks = torch.softmax(predict_masks, dim=1)
         pred = predict_masks.detach().cpu().numpy()  # (b, c, h, w)
         seg = np.argmax(pred, axis=1)  # (b, h, w)
         b, h, w = seg.shape
-        for j in range(0, b):
-            patient_number = int(image_filename[j][:4]) # xxxx_2CH_xxx
-            antrum = int(image_filename[j][5])
-            if antrum == 2:
-                patientid = patient_number
-            elif antrum ==3:
-                patientid = 2000 + patient_number
-            else:
-                patientid = 4000 + patient_number
-            flag[patientid] = flag[patientid] + 1
-            pred_i = np.zeros((1, h, w))
-            pred_i[seg[j:j+1, :, :] == 1] = 255
-            gt_i = np.zeros((1, h, w))
-            gt_i[gt[j:j+1, :, :] == 1] = 255
-            tp, fp, tn, fn = metrics.get_matrix(pred_i, gt_i)
-            hd = hausdorff_distance(pred_i[0, :, :], gt_i[0, :, :], distance="manhattan")
-            hds[patientid, class_id[j]] += hd
-            tps[patientid, class_id[j]] += tp
-            fps[patientid, class_id[j]] += fp
-            tns[patientid, class_id[j]] += tn
-            fns[patientid, class_id[j]] += fn
-            if opt.visual:
+        hd_batch = metrics.hausdorff_metrics(seg == 1, gt == 1, device=opt.device)[0]
+        tp_batch, fp_batch, tn_batch, fn_batch = metrics.confusion_matrix_batch(seg == 1, gt == 1)
+        patients.update([patient_key(name, opt.patient_pattern) for name in image_filename], class_id,
+                        tp_batch, fp_batch, tn_batch, fn_batch, hd_batch)
+        if opt.visual:
+            for j in range(0, b):
                 visual_segmentation(seg[j:j+1, :, :], image_filename[j], opt)
         eval_number = eval_number + b
-    tps = tps[flag > 0, :]
-    fps = fps[flag > 0, :]
-    tns = tns[flag > 0, :]
-    fns = fns[flag > 0, :]
-    hds = hds[flag > 0, :] / (flag[flag>0][:, None]/(opt.classes-1))
+    tps, fps, tns, fns = patients.counts()
+    hds = patients.hausdorff(opt.classes-1)
     patient_dices = (2 * tps + 1e-5) / (2 * tps + fps + fns + 1e-5)  # p c
     dices = np.mean(patient_dices, axis=0)  # c
     hdis = np.mean(hds, axis=0)
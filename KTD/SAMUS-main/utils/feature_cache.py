@@ -0,0 +1,152 @@
+# frozen-prefix feature cache: the activations of ImageEncoderViT.forward_prefix are computed
+# once per (training image, augmentation seed), stored as fp16 .npy files and read back
+# memory-mapped, so runs that only train what comes after the prefix skip the ViT forward
+import hashlib
+import json
+import os
+import random
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset, Subset
+
+
+def prefix_fingerprint(image_encoder, num_blocks):
+    """sha256 (16 hex) of the weights forward_prefix(x, num_blocks) depends on."""
+    sha = hashlib.sha256(str((num_blocks, image_encoder.token_size, image_encoder.patch_stride)).encode())
+    names = ('cnn_embed.', 'patch_embed.', 'input_Adapter.', 'pos_embed', 'post_pos_embed.')
+    names += tuple('blocks.%d.' % i for i in range(num_blocks))
+    for name, tensor in image_encoder.state_dict().items():
+        if name.startswith(names):
+            sha.update(name.encode())
+            sha.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return sha.hexdigest()[:16]
+
+
+class SeededAugmentation(Dataset):
+    """ replays the random augmentation of `dataset` per (sample, augmentation seed):
+        index j is sample j % len(dataset) under seed j // len(dataset), with the python,
+        numpy and torch RNGs seeded from j, so an index gives the same image, mask and
+        prompts whenever and in whichever dataloader worker it is loaded
+    """
+    def __init__(self, dataset, num_seeds=1, base_seed=1234):
+        self.dataset = dataset
+        self.num_seeds = num_seeds
+        self.base_seed = base_seed
+
+    def __len__(self):
+        return len(self.dataset) * self.num_seeds
+
+    def __getitem__(self, j):
+        states = random.getstate(), np.random.get_state(), torch.get_rng_state()
+        seed = (self.base_seed + j) % 2**32
+        random.seed(seed)
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        try:
+            return self.dataset[j % len(self.dataset)]
+        finally:
+            random.setstate(states[0])
+            np.random.set_state(states[1])
+            torch.set_rng_state(states[2])
+
+
+class FeatureCache:
+    """ fp16 forward_prefix activations of every index of a SeededAugmentation.
+        layout: <cache_dir>/<key>/{meta.json, x.npy, cnnx.npy, done.npy}, key hashing the
+        prefix weights and `meta` (split, input size, seeds, ...); x.npy and cnnx.npy are
+        [N, h, w, c] and done.npy flags the rows already written, so an interrupted build resumes
+    """
+    def __init__(self, cache_dir, image_encoder, num_blocks, seeded, meta=None):
+        self.num_blocks = num_blocks
+        self.seeded = seeded
+        self.meta = dict(meta or {}, num_blocks=num_blocks, num_samples=len(seeded.dataset),
+                         num_seeds=seeded.num_seeds, base_seed=seeded.base_seed,
+                         prefix=prefix_fingerprint(image_encoder, num_blocks))
+        key = hashlib.sha256(json.dumps(self.meta, sort_keys=True).encode()).hexdigest()[:16]
+        self.path = os.path.join(cache_dir, key)
+        self._arrays = None
+
+    def __getstate__(self):
+        # dataloader workers reopen the memmaps instead of pickling them
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    def _file(self, name):
+        return os.path.join(self.path, name + '.npy')
+
+    @property
+    def done(self):
+        if not os.path.exists(self._file('done')):
+            return np.zeros(len(self.seeded), dtype=bool)
+        return np.load(self._file('done'))
+
+    def _open(self, mode, shape=None):
+        if mode == 'w+' and not os.path.exists(self._file('x')):
+            os.makedirs(self.path, exist_ok=True)
+            with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+                json.dump(self.meta, f, indent=2)
+            return tuple(np.lib.format.open_memmap(self._file(name), mode='w+', dtype=np.float16, shape=shape)
+                         for name in ('x', 'cnnx'))
+        return tuple(np.load(self._file(name), mmap_mode='r+' if mode == 'w+' else 'r') for name in ('x', 'cnnx'))
+
+    @torch.no_grad()
+    def build(self, image_encoder, device, batch_size=8, num_workers=8):
+        """run forward_prefix over the missing rows (eval mode, fp16 on disk)."""
+        done = self.done
+        missing = np.flatnonzero(~done)
+        if len(missing) == 0:
+            return self
+        loader = DataLoader(Subset(self.seeded, missing.tolist()), batch_size=batch_size, shuffle=False,
+                            num_workers=num_workers, pin_memory=True)
+        training = image_encoder.training
+        image_encoder.eval()
+        arrays, start = None, 0
+        for batch_idx, datapack in enumerate(loader):
+            imgs = datapack['image'].to(dtype=torch.float32, device=device)
+            x, cnnx = image_encoder.forward_prefix(imgs, self.num_blocks)
+            if arrays is None:
+                arrays = self._open('w+', (len(self.seeded),) + tuple(x.shape[1:]))
+                print("prefix cache: {} rows x {} ({:.1f} GB) at {}".format(
+                    len(self.seeded), tuple(x.shape[1:]), 4 * x[0].numel() * len(self.seeded) / 2**30, self.path))
+            rows = missing[start:start + x.shape[0]]
+            arrays[0][rows] = x.half().cpu().numpy()
+            arrays[1][rows] = cnnx.half().cpu().numpy()
+            start += x.shape[0]
+            print('prefix cache [{}/{}]'.format(start, len(missing)))
+            if (batch_idx + 1) % 50 == 0 or start == len(missing):
+                for array in arrays:
+                    array.flush()
+                done[missing[:start]] = True
+                np.save(self._file('done'), done)
+        image_encoder.train(training)
+        return self
+
+    def __getitem__(self, j):
+        if self._arrays is None:
+            self._arrays = self._open('r')
+        return torch.from_numpy(np.array(self._arrays[0][j])), torch.from_numpy(np.array(self._arrays[1][j]))
+
+
+class CachedPrefixDataset(Dataset):
+    """ training samples with their cached prefix activations ('prefix_x', 'prefix_cnnx', fp16)
+        instead of 'image'; epoch e uses augmentation seed e % num_seeds (call set_epoch)
+    """
+    def __init__(self, cache):
+        self.cache = cache
+        self.seeded = cache.seeded
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.seeded.dataset)
+
+    def __getitem__(self, i):
+        j = (self.epoch % self.seeded.num_seeds) * len(self.seeded.dataset) + i
+        datapack = self.seeded[j]
+        datapack.pop('image')
+        datapack['prefix_x'], datapack['prefix_cnnx'] = self.cache[j]
+        return datapack
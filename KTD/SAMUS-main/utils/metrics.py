@@ -1,22 +1,55 @@
 import numpy as np
 import torch
-from hausdorff import hausdorff_distance
+import torch.nn.functional as F
+from scipy import ndimage
+
+def _as_mask(x):
+    """ boolean torch view of a mask (torch or numpy, nonzero = foreground), kept on its device """
+    x = x if torch.is_tensor(x) else torch.from_numpy(np.asarray(x))
+    return x if x.dtype == torch.bool else x != 0
+
+
+def confusion_matrix_batch(pred, gt, spatial_dims=2):
+    """ TP/FP/TN/FN pixel counts of binary masks in a single pass, without touching the inputs.
+        pred, gt: [..., H, W] bool/uint8/float masks (torch or numpy, nonzero = foreground), e.g.
+        [B, H, W] -> counts of shape [B], [B, C, H, W] -> [B, C]; the trailing `spatial_dims`
+        axes are reduced. Returns four int64 numpy arrays.
+    """
+    pred, gt = _as_mask(pred), _as_mask(gt).to(_as_mask(pred).device)
+    dims = tuple(range(-spatial_dims, 0))
+    total = int(np.prod(pred.shape[-spatial_dims:]))
+    TP = torch.count_nonzero(pred & gt, dim=dims)
+    FP = torch.count_nonzero(pred, dim=dims) - TP
+    FN = torch.count_nonzero(gt, dim=dims) - TP
+    TN = total - TP - FP - FN
+    return tuple(x.cpu().numpy().astype(np.int64) for x in (TP, FP, TN, FN))
+
+
+def batch_metrics(pred, gt, smooth=1e-5, spatial_dims=2):
+    """ per-sample Dice, IoU, Acc, SE, SP, Precision, Recall and F1 of binary masks,
+        same formulas (and smoothing) as dice_coefficient / sespiou_coefficient2.
+        Shapes as in confusion_matrix_batch; returns a dict of float64 numpy arrays.
+    """
+    TP, FP, TN, FN = [x.astype(np.float64) for x in confusion_matrix_batch(pred, gt, spatial_dims)]
+    precision = (TP + smooth) / (TP + FP + smooth)
+    recall = (TP + smooth) / (TP + FN + smooth)
+    return {
+        'dice': (2 * TP + smooth) / (2 * TP + FP + FN + smooth),
+        'iou': (TP + smooth) / (FP + TP + FN + smooth),
+        'acc': (TP + TN + smooth) / (TP + FP + FN + TN + smooth),
+        'se': recall,
+        'sp': (TN + smooth) / (FP + TN + smooth),
+        'precision': precision,
+        'recall': recall,
+        'f1': 2 * precision * recall / (recall + precision + smooth),
+    }
+
 
 def dice_coefficient(pred, gt, smooth=1e-5):
     """ computational formula：
         dice = 2TP/(FP + 2TP + FN)
     """
-    N = gt.shape[0]
-    pred[pred >= 1] = 1
-    gt[gt >= 1] = 1
-    pred_flat = pred.reshape(N, -1)
-    gt_flat = gt.reshape(N, -1)
-    # if (pred.sum() + gt.sum()) == 0:
-    #     return 1
-    intersection = (pred_flat * gt_flat).sum(1)
-    unionset = pred_flat.sum(1) + gt_flat.sum(1)
-    dice = (2 * intersection + smooth) / (unionset + smooth)
-    return dice.sum() / N
+    return batch_metrics(pred, gt, smooth, spatial_dims=gt.ndim - 1)['dice'].mean()
 
 def sespiou_coefficient(pred, gt, smooth=1e-5):
     """ computational formula:
@@ -24,23 +57,8 @@ def sespiou_coefficient(pred, gt, smooth=1e-5):
         specificity = TN/(FP+TN)
         iou = TP/(FP+TP+FN)
     """
-    N = gt.shape[0]
-    pred[pred >= 1] = 1
-    gt[gt >= 1] = 1
-    pred_flat = pred.reshape(N, -1)
-    gt_flat = gt.reshape(N, -1)
-    #pred_flat = pred.view(N, -1)
-    #gt_flat = gt.view(N, -1)
-    TP = (pred_flat * gt_flat).sum(1)
-    FN = gt_flat.sum(1) - TP
-    pred_flat_no = (pred_flat + 1) % 2
-    gt_flat_no = (gt_flat + 1) % 2
-    TN = (pred_flat_no * gt_flat_no).sum(1)
-    FP = pred_flat.sum(1) - TP
-    SE = (TP + smooth) / (TP + FN + smooth)
-    SP = (TN + smooth) / (FP + TN + smooth)
-    IOU = (TP + smooth) / (FP + TP + FN + smooth)
-    return SE.sum() / N, SP.sum() / N, IOU.sum() / N
+    m = batch_metrics(pred, gt, smooth, spatial_dims=gt.ndim - 1)
+    return m['se'].mean(), m['sp'].mean(), m['iou'].mean()
 
 def sespiou_coefficient2(pred, gt, all=False, smooth=1e-5):
     """ computational formula:
@@ -48,46 +66,84 @@ def sespiou_coefficient2(pred, gt, all=False, smooth=1e-5):
         specificity = TN/(FP+TN)
         iou = TP/(FP+TP+FN)
     """
-    N = gt.shape[0]
-    pred[pred >= 1] = 1
-    gt[gt >= 1] = 1
-    pred_flat = pred.reshape(N, -1)
-    gt_flat = gt.reshape(N, -1)
-    #pred_flat = pred.view(N, -1)
-    #gt_flat = gt.view(N, -1)
-    TP = (pred_flat * gt_flat).sum(1)
-    FN = gt_flat.sum(1) - TP
-    pred_flat_no = (pred_flat + 1) % 2
-    gt_flat_no = (gt_flat + 1) % 2
-    TN = (pred_flat_no * gt_flat_no).sum(1)
-    FP = pred_flat.sum(1) - TP
-    SE = (TP + smooth) / (TP + FN + smooth)
-    SP = (TN + smooth) / (FP + TN + smooth)
-    IOU = (TP + smooth) / (FP + TP + FN + smooth)
-    Acc = (TP + TN + smooth)/(TP + FP + FN + TN + smooth)
-    Precision = (TP + smooth) / (TP + FP + smooth)
-    Recall = (TP + smooth) / (TP + FN + smooth)
-    F1 = 2*Precision*Recall/(Recall + Precision +smooth)
+    m = batch_metrics(pred, gt, smooth, spatial_dims=gt.ndim - 1)
     if all:
-        return SE.sum() / N, SP.sum() / N, IOU.sum() / N, Acc.sum()/N, F1.sum()/N, Precision.sum()/N, Recall.sum()/N
+        return m['se'].mean(), m['sp'].mean(), m['iou'].mean(), m['acc'].mean(), m['f1'].mean(), m['precision'].mean(), m['recall'].mean()
     else:
-        return IOU.sum() / N, Acc.sum()/N, SE.sum() / N, SP.sum() / N
+        return m['iou'].mean(), m['acc'].mean(), m['se'].mean(), m['sp'].mean()
 
 def get_matrix(pred, gt, smooth=1e-5):
-    """ computational formula:
-        sensitivity = TP/(TP+FN)
-        specificity = TN/(FP+TN)
-        iou = TP/(FP+TP+FN)
+    """ per-sample TP, FP, TN, FN of binary masks [N, ...] (nonzero = foreground) """
+    return confusion_matrix_batch(pred, gt, spatial_dims=gt.ndim - 1)
+
+
+def mask_boundary(mask):
+    """ boundary pixels of binary masks [B, H, W] (torch): foreground pixels with a 4-neighbour
+        in the background, pixels outside the image count as background
+    """
+    background = F.pad((~mask).float()[:, None], (1, 1, 1, 1), value=1)
+    cross = torch.tensor([[0, 1, 0], [1, 1, 1], [0, 1, 0]], dtype=background.dtype, device=background.device)
+    touches_background = F.conv2d(background, cross[None, None]) > 0
+    return mask & touches_background[:, 0]
+
+
+def _edt_gpu(feature):
+    """ exact Euclidean distance transform to the nearest True pixel of feature [B, H, W] (torch),
+        separable (column pass, then row pass) with the minima computed by broadcasting
+    """
+    B, H, W = feature.shape
+    inf = float(H * H + W * W)
+    rows = torch.arange(H, device=feature.device, dtype=torch.float32)
+    cols = torch.arange(W, device=feature.device, dtype=torch.float32)
+    # squared distance to the nearest feature pixel in the same column: [B, H(i), W]
+    column_sq = (rows[:, None] - rows[None, :]) ** 2  # [H(i), H(k)]
+    g = torch.where(feature[:, None, :, :], column_sq[None, :, :, None], torch.full_like(column_sq[None, :, :, None], inf))
+    g = g.min(dim=2).values
+    # combine along rows: d(i, j)^2 = min_k g(i, k) + (j - k)^2
+    row_sq = (cols[:, None] - cols[None, :]) ** 2  # [W(j), W(k)]
+    d = (g[:, :, None, :] + row_sq[None, None]).min(dim=3).values
+    return d.sqrt()
+
+
+def _edt_cpu(feature):
+    feature = feature.cpu().numpy()
+    return torch.from_numpy(np.stack([ndimage.distance_transform_edt(~f) for f in feature]).astype(np.float32))
+
+
+def hausdorff_metrics(pred, gt, percentile=95, device=None):
+    """ Hausdorff distance, HD95 and ASSD (in pixels) between binary masks pred, gt [B, H, W]
+        (torch or numpy, nonzero = foreground), from their boundaries and distance transforms.
+        Runs batched on `device` (default: the tensor's device); on CPU scipy's EDT is used.
+        Pairs with both masks empty score 0, pairs with exactly one empty mask score the image
+        diagonal. Returns three numpy arrays of shape [B].
     """
-    N = gt.shape[0]
-    pred[pred >= 1] = 1
-    gt[gt >= 1] = 1
-    pred_flat = pred.reshape(N, -1)
-    gt_flat = gt.reshape(N, -1)
-    TP = (pred_flat * gt_flat).sum(1)
-    FN = gt_flat.sum(1) - TP
-    pred_flat_no = (pred_flat + 1) % 2
-    gt_flat_no = (gt_flat + 1) % 2
-    TN = (pred_flat_no * gt_flat_no).sum(1)
-    FP = pred_flat.sum(1) - TP
-    return TP, FP, TN, FN
\ No newline at end of file
+    pred, gt = _as_mask(pred), _as_mask(gt)
+    if device is not None:
+        pred, gt = pred.to(device), gt.to(device)
+    gt = gt.to(pred.device)
+    B, H, W = pred.shape
+    pred_border, gt_border = mask_boundary(pred), mask_boundary(gt)
+
+    edt = _edt_gpu if pred.is_cuda else _edt_cpu
+    hd, hd95, assd = [], [], []
+    chunk = 8 if pred.is_cuda else B  # the GPU EDT holds a [chunk, H, H, W] intermediate
+    for start in range(0, B, chunk):
+        pred_b, gt_b = pred_border[start:start + chunk], gt_border[start:start + chunk]
+        # directed distances on the boundary pixels, nan elsewhere
+        d_pred_gt = torch.where(pred_b, edt(gt_b).to(pred.device), torch.tensor(float('nan'), device=pred.device)).flatten(1)
+        d_gt_pred = torch.where(gt_b, edt(pred_b).to(pred.device), torch.tensor(float('nan'), device=pred.device)).flatten(1)
+        # symmetric: statistics over the union of both directed distance sets (as medpy's hd95/assd)
+        distances = torch.cat([d_pred_gt, d_gt_pred], dim=1)
+        hd.append(distances.nan_to_num(-1).max(1).values)
+        hd95.append(torch.nanquantile(distances, percentile / 100, dim=1))
+        assd.append(torch.nanmean(distances, dim=1))
+    hd, hd95, assd = [torch.cat(metric) for metric in (hd, hd95, assd)]
+
+    has_pred, has_gt = pred_border.flatten(1).any(1), gt_border.flatten(1).any(1)
+    diagonal = float(np.sqrt(H * H + W * W))
+    result = []
+    for metric in (hd, hd95, assd):
+        metric = torch.where(has_pred & has_gt, metric, torch.full_like(metric, diagonal))
+        metric = torch.where(~has_pred & ~has_gt, torch.zeros_like(metric), metric)
+        result.append(metric.cpu().numpy().astype(np.float64))
+    return tuple(result)
@@ -0,0 +1,208 @@
+# streaming metric accumulators: constant memory in the number of evaluated samples,
+# updated per batch and mergeable across dataloader workers / DDP ranks
+import numpy as np
+import torch
+import torch.distributed as dist
+from sklearn.metrics import roc_auc_score
+
+
+def _to_numpy(x):
+    if isinstance(x, torch.Tensor):
+        return x.detach().cpu().numpy()
+    return np.asarray(x)
+
+
+class ConfusionAccumulator:
+    """ per-class TP/FP/TN/FN pixel counts, summed over all updates.
+        dice = 2TP/(FP + 2TP + FN), iou = TP/(FP+TP+FN), acc = (TP+TN)/all,
+        sensitivity = TP/(TP+FN), specificity = TN/(FP+TN)
+    """
+    def __init__(self, classes):
+        self.tp = np.zeros(classes, dtype=np.int64)
+        self.fp = np.zeros(classes, dtype=np.int64)
+        self.tn = np.zeros(classes, dtype=np.int64)
+        self.fn = np.zeros(classes, dtype=np.int64)
+
+    def update(self, pred, gt, class_id=1):
+        # pred, gt: binary masks of any shape (nonzero = foreground), numpy or torch
+        pred, gt = _to_numpy(pred) > 0, _to_numpy(gt) > 0
+        tp = np.count_nonzero(pred & gt)
+        fp = np.count_nonzero(pred) - tp
+        fn = np.count_nonzero(gt) - tp
+        self.update_counts(tp, fp, pred.size - tp - fp - fn, fn, class_id)
+
+    def update_counts(self, tp, fp, tn, fn, class_id=1):
+        self.tp[class_id] += int(tp)
+        self.fp[class_id] += int(fp)
+        self.tn[class_id] += int(tn)
+        self.fn[class_id] += int(fn)
+
+    def merge(self, other):
+        self.tp += other.tp
+        self.fp += other.fp
+        self.tn += other.tn
+        self.fn += other.fn
+        return self
+
+    def dice(self, smooth=1e-5):
+        return (2 * self.tp + smooth) / (2 * self.tp + self.fp + self.fn + smooth)
+
+    def iou(self, smooth=1e-5):
+        return (self.tp + smooth) / (self.fp + self.tp + self.fn + smooth)
+
+    def acc(self, smooth=1e-5):
+        return (self.tp + self.tn + smooth) / (self.tp + self.fp + self.fn + self.tn + smooth)
+
+    def se(self, smooth=1e-5):
+        return (self.tp + smooth) / (self.tp + self.fn + smooth)
+
+    def sp(self, smooth=1e-5):
+        return (self.tn + smooth) / (self.fp + self.tn + smooth)
+
+
+class WelfordAccumulator:
+    """ per-class running mean / std (population std, same as np.std) of a per-sample metric,
+        using Welford's update and Chan's parallel merge. Classes without samples report 0.
+    """
+    def __init__(self, classes):
+        self.count = np.zeros(classes, dtype=np.int64)
+        self._mean = np.zeros(classes)
+        self._m2 = np.zeros(classes)
+
+    def update(self, values, class_id=1):
+        # values: scalar or 1-D batch of per-sample metric values for one class
+        values = _to_numpy(values).astype(np.float64).ravel()
+        if values.size == 0:
+            return
+        self._merge_stats(class_id, values.size, values.mean(), ((values - values.mean()) ** 2).sum())
+
+    def _merge_stats(self, class_id, count, mean, m2):
+        total = self.count[class_id] + count
+        delta = mean - self._mean[class_id]
+        self._mean[class_id] += delta * count / total
+        self._m2[class_id] += m2 + delta ** 2 * self.count[class_id] * count / total
+        self.count[class_id] = total
+
+    def merge(self, other):
+        for class_id in np.nonzero(other.count)[0]:
+            self._merge_stats(class_id, other.count[class_id], other._mean[class_id], other._m2[class_id])
+        return self
+
+    def mean(self):
+        return self._mean.copy()
+
+    def std(self):
+        return np.sqrt(self._m2 / np.maximum(self.count, 1))
+
+
+class RocAucAccumulator:
+    """ binary ROC AUC from streamed (score, label) pairs.
+        By default scores in [0, 1] are counted in `bins` fixed-width histogram bins per label,
+        so memory is O(bins); pairs falling in the same bin count as ties (error <= 1/bins).
+        exact=True keeps every pair and defers to sklearn's roc_auc_score (O(samples) memory).
+        For multi-class problems keep one accumulator per class (one-vs-rest).
+    """
+    def __init__(self, bins=1000, exact=False):
+        self.bins = bins
+        self.exact = exact
+        self.pos_hist = np.zeros(bins, dtype=np.int64)
+        self.neg_hist = np.zeros(bins, dtype=np.int64)
+        self._scores, self._labels = [], []
+
+    def update(self, scores, labels):
+        scores = _to_numpy(scores).astype(np.float64).ravel()
+        labels = _to_numpy(labels).ravel() > 0
+        if self.exact:
+            self._scores.append(scores)
+            self._labels.append(labels)
+            return
+        index = np.clip((scores * self.bins).astype(np.int64), 0, self.bins - 1)
+        self.pos_hist += np.bincount(index[labels], minlength=self.bins)
+        self.neg_hist += np.bincount(index[~labels], minlength=self.bins)
+
+    def merge(self, other):
+        assert self.exact == other.exact and self.bins == other.bins, "can only merge alike accumulators"
+        self.pos_hist += other.pos_hist
+        self.neg_hist += other.neg_hist
+        self._scores.extend(other._scores)
+        self._labels.extend(other._labels)
+        return self
+
+    def auc(self):
+        if self.exact:
+            return roc_auc_score(np.concatenate(self._labels), np.concatenate(self._scores))
+        n_pos, n_neg = self.pos_hist.sum(), self.neg_hist.sum()
+        if n_pos == 0 or n_neg == 0:
+            raise ValueError("ROC AUC needs both positive and negative samples")
+        # P(score_pos > score_neg) + 0.5 P(tie), ties = same bin
+        neg_below = np.cumsum(self.neg_hist) - self.neg_hist
+        return float((self.pos_hist * (neg_below + 0.5 * self.neg_hist)).sum() / (n_pos * n_neg))
+
+
+class PatientAccumulator:
+    """ per-patient, per-class TP/FP/TN/FN and Hausdorff sums keyed by arbitrary hashable patient
+        identifiers (e.g. (patient, view) tuples). Rows are allocated the first time a key is seen
+        and storage grows geometrically, so memory follows the number of patients actually
+        evaluated instead of a fixed maximum patient number.
+    """
+    _fields = ('slices', 'tp', 'fp', 'tn', 'fn', 'hd')
+
+    def __init__(self, classes, capacity=64):
+        self.classes = classes
+        self.rows = {}  # patient key -> row, in insertion order
+        self.slices = np.zeros(capacity, dtype=np.int64)
+        self.tp = np.zeros((capacity, classes), dtype=np.int64)
+        self.fp = np.zeros((capacity, classes), dtype=np.int64)
+        self.tn = np.zeros((capacity, classes), dtype=np.int64)
+        self.fn = np.zeros((capacity, classes), dtype=np.int64)
+        self.hd = np.zeros((capacity, classes))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _lookup(self, keys):
+        rows = np.array([self.rows.setdefault(key, len(self.rows)) for key in keys], dtype=np.int64)
+        if len(self.rows) > len(self.slices):
+            capacity = max(len(self.rows), 2 * len(self.slices))
+            for name in self._fields:
+                old = getattr(self, name)
+                new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+                new[:len(old)] = old
+                setattr(self, name, new)
+        return rows
+
+    def update(self, keys, class_ids, tp, fp, tn, fn, hd):
+        # one batch: keys is a sequence of B patient keys, the rest are length-B arrays
+        rows = self._lookup(keys)
+        index = (rows, _to_numpy(class_ids).astype(np.int64).ravel())
+        np.add.at(self.slices, rows, 1)
+        for name, values in zip(self._fields[1:], (tp, fp, tn, fn, hd)):
+            np.add.at(getattr(self, name), index, _to_numpy(values).ravel())
+
+    def merge(self, other):
+        rows = self._lookup(list(other.rows))  # other's rows are 0..len(other)-1 in key order
+        for name in self._fields:
+            getattr(self, name)[rows] += getattr(other, name)[:len(other)]
+        return self
+
+    def counts(self):
+        """ TP, FP, TN, FN of shape [patients, classes] """
+        n = len(self)
+        return self.tp[:n], self.fp[:n], self.tn[:n], self.fn[:n]
+
+    def hausdorff(self, foreground_classes):
+        """ per-patient HD [patients, classes]: class sums divided by slices / foreground_classes """
+        n = len(self)
+        return self.hd[:n] / (self.slices[:n, None] / foreground_classes)
+
+
+def merge_across_ranks(accumulator):
+    """ merge an accumulator over all torch.distributed ranks; every rank gets the merged result """
+    if not (dist.is_available() and dist.is_initialized()) or dist.get_world_size() == 1:
+        return accumulator
+    gathered = [None] * dist.get_world_size()
+    dist.all_gather_object(gathered, accumulator)
+    merged = gathered[0]
+    for other in gathered[1:]:
+        merged.merge(other)
+    return merged
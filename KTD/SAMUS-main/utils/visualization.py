@@ -1,13 +1,12 @@
 import torchvision
 import os
+import heapq
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import torch
 import cv2
 import numpy as np
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 from utils.imgname import read_img_name
-import seaborn as sns
 
 
 def visual_segmentation(seg, image_filename, opt):
@@ -117,99 +116,100 @@ def visual_segmentation_sets_with_pt(seg, image_filename, opt, pt):
         os.makedirs(fulldir)
     cv2.imwrite(fulldir + image_filename, img)
 
+def compare_output_dir(opt, epoch):
+    if 'KTD' in opt.data_path:
+        return opt.result_path + "/Merge-" + opt.modelname + "/KTD" + "/" + str(epoch) + "/"
+    return opt.result_path + "/Merge-" + opt.modelname + "/" + str(epoch) + "/"
+
+
+def compare_panels(img_ori, pred, gt):
+    """ ori_image | gt_mask | pred_mask | crop_pic strip composited with OpenCV,
+        pred / gt: (h, w) masks (nonzero = foreground), img_ori: BGR image resized to (h, w)
+    """
+    h, w = pred.shape
+    gt_pic = cv2.cvtColor(np.where(gt > 0, 255, 0).astype(np.uint8), cv2.COLOR_GRAY2BGR)
+    pred_pic = cv2.cvtColor(np.where(pred > 0, 255, 0).astype(np.uint8), cv2.COLOR_GRAY2BGR)
+    crop_pic = np.where((pred > 0)[:, :, None], img_ori, 0).astype(np.uint8)
+    crop_pic = cv2.addWeighted(crop_pic, 0.8, np.zeros_like(crop_pic), 0.2, 0)
+    panels = []
+    for title, panel in [('ori_image', img_ori), ('gt_mask', gt_pic), ('pred_mask', pred_pic), ('crop_pic', crop_pic)]:
+        header = np.full((20, w, 3), 255, dtype=np.uint8)
+        cv2.putText(header, title, (4, 15), cv2.FONT_HERSHEY_SIMPLEX, 0.45, (0, 0, 0), 1, cv2.LINE_AA)
+        panels.append(np.concatenate([header, panel], axis=0))
+    return np.concatenate(panels, axis=1)
+
+
+def write_compare(image_path, pred, gt, save_path):
+    """ render one comparison strip to save_path (module level so it can run in a worker process) """
+    h, w = pred.shape
+    img_ori = cv2.imread(image_path)
+    img_ori = cv2.resize(img_ori, dsize=(w, h))
+    if gt.shape != pred.shape:
+        gt = cv2.resize(gt.astype(np.uint8), dsize=(w, h), interpolation=cv2.INTER_NEAREST)
+    cv2.imwrite(save_path, compare_panels(img_ori, pred, gt))
+
+
 def visual_compare(image_filename,pred,gt,opt,epoch):
-    # 原始图片
-    img_ori = cv2.imread(os.path.join(opt.data_subpath + 'imgs', image_filename))
-    img_ori = cv2.resize(img_ori, dsize=(224, 224))
-    gt_pic = gt[0,:,:]
-    pred_pic = pred[0,:,:]
-    
-    # 打印调试信息
-    # print(f"GT掩码值范围: {gt_pic.min():.3f} 到 {gt_pic.max():.3f}")
-    # print(f"预测掩码值范围: {pred_pic.min():.3f} 到 {pred_pic.max():.3f}")
-    
+    # pred, gt: (1, h, w) masks, written synchronously; see VisualWriter for the pooled version
+    output_dir = compare_output_dir(opt, epoch)
+    os.makedirs(output_dir, exist_ok=True)
+    write_compare(os.path.join(opt.data_subpath + 'imgs', image_filename), pred[0] > 0, gt[0] > 0,
+                  os.path.join(output_dir, image_filename))
 
-    # np.where 返回的是满足条件的像素索引 (row, col)
-    # crop_pic = np.zeros_like(img_ori)
-    crop_pic = np.zeros_like(img_ori)
-    mask = (pred_pic > 0.5)  # 或使用合适的阈值，比如 > 0
-    # print(f"掩码包含 {mask.sum()} 个True像素（总共 {mask.size} 像素）")
-    
-    
-    # #
-    # # # 2. 将掩码图中为 255 的位置的原图像素值复制到 modified_img 中
-    # for row in range(crop_pic.shape[0]):
-    #     for col in range(crop_pic.shape[1]):
-    #         if pred_pic[row,col]==1.0:
-    #             crop_pic[:, row,col] = img_ori[:, row,col]
-    crop_pic[mask,:] = img_ori[mask,:]
-    
-    # 创建彩色掩码叠加
-    colored_mask = np.zeros_like(img_ori)
-    # colored_mask[mask] = [0, 0, 255]  # 红色掩码
-    crop_pic_with_boundary = cv2.addWeighted(crop_pic, 0.8, colored_mask, 0.2, 0)
-    
-    
-    print(image_filename)
-    # 创建一个图形窗口
-    plt.figure(figsize=(12, 3))
-    # 显示第一个掩码图
-    plt.subplot(1, 4, 1)
-    plt.imshow(img_ori)
-    plt.title('ori_image')
-    plt.axis('off')
-
-    # # 显示第二个掩码图
-    # plt.subplot(1, 4, 2)
-    # plt.imshow(gt_pic,cmap='gray')
-    # plt.title('gt_mask')
-    # plt.axis('off')
-
-    # # 显示第三个掩码图
-    # plt.subplot(1, 4, 3)
-    # plt.imshow(pred_pic,cmap='gray')
-    # plt.title('pred_mask')
-    # plt.axis('off')
-
-    # # 显示第四个掩码图
-    # plt.subplot(1, 4, 4)
-    # plt.imshow(crop_pic)
-    # plt.title('crop_pic')
-    # plt.axis('off')
-    plt.subplot(1, 4, 2)
-    plt.imshow((gt_pic - gt_pic.min()) / (gt_pic.max() - gt_pic.min() + 1e-8), cmap='gray')
-    plt.title('gt_mask')
-    plt.axis('off')
-    
-    plt.subplot(1, 4, 3)
-    plt.imshow((pred_pic - pred_pic.min()) / (pred_pic.max() - pred_pic.min() + 1e-8), cmap='gray')
-    plt.title('pred_mask')
-    plt.axis('off')
-    
-    plt.subplot(1, 4, 4)
-    plt.imshow(crop_pic_with_boundary)
-    plt.title('crop_pic')
-    plt.axis('off')
-    # 显示图像
-    # plt.tight_layout()
-    # plt.show()
-    # 指定保存目录和文件名
-    if 'KTD' in opt.data_path:
-        output_dir = opt.result_path + "/Merge-" + opt.modelname +"/KTD"+ "/" + str(epoch) + "/"  # 指定目录
-    else:
-        output_dir = opt.result_path + "/Merge-" + opt.modelname + "/"+str(epoch)+"/"  # 指定目录
 
-    output_file = image_filename  # 指定文件名
-    # fulldir = opt.result_path + "/PT3-" + "img" + "/"
-    # 创建目录（如果目录不存在）
-    if not os.path.isdir(output_dir):
-        os.makedirs(output_dir)
+class VisualWriter:
+    """ writes visual_compare strips from a bounded pool of background processes so rendering
+        stays off the evaluation loop.
+        num_samples: slices written per evaluation, -1 for all of them, 0 disables the writer
+        mode: "first" writes the first num_samples slices as they come,
+              "worst" keeps the num_samples lowest-Dice slices and writes them on close()
+        max_pending: submitted-but-unfinished jobs before submit() blocks, bounds the queued masks
+    """
+    def __init__(self, opt, epoch, num_samples=8, mode="first", workers=2, max_pending=32):
+        self.opt = opt
+        self.num_samples = num_samples
+        self.mode = mode
+        self.max_pending = max_pending
+        self.output_dir = compare_output_dir(opt, epoch)
+        self.seen = 0
+        self.worst = []  # max-heap on dice of (-dice, order, filename, pred, gt)
+        self.pending = deque()
+        self.pool = ProcessPoolExecutor(max_workers=workers) if num_samples != 0 else None
+        if self.pool is not None:
+            os.makedirs(self.output_dir, exist_ok=True)
+
+    def submit(self, image_filename, pred, gt, dice=None):
+        # pred, gt: (h, w) masks of one slice, dice is needed for mode="worst"
+        if self.pool is None:
+            return
+        pred, gt = np.asarray(pred) > 0, np.asarray(gt) > 0
+        self.seen += 1
+        if self.mode == "worst" and self.num_samples > 0:
+            item = (-float(dice), self.seen, image_filename, pred, gt)
+            if len(self.worst) < self.num_samples:
+                heapq.heappush(self.worst, item)
+            elif item[0] > self.worst[0][0]:
+                heapq.heapreplace(self.worst, item)
+        elif self.num_samples < 0 or self.seen <= self.num_samples:
+            self._write(image_filename, pred, gt)
+
+    def _write(self, image_filename, pred, gt):
+        while len(self.pending) >= self.max_pending:
+            self.pending.popleft().result()
+        self.pending.append(self.pool.submit(write_compare, os.path.join(self.opt.data_subpath + 'imgs', image_filename),
+                                             pred, gt, os.path.join(self.output_dir, image_filename)))
 
+    def close(self):
+        if self.pool is None:
+            return
+        for _, _, image_filename, pred, gt in sorted(self.worst, reverse=True):
+            self._write(image_filename, pred, gt)
+        self.worst = []
+        while self.pending:
+            self.pending.popleft().result()
+        self.pool.shutdown()
+        self.pool = None
 
-    # 保存图像到指定目录
-    save_path = os.path.join(output_dir, output_file)
-    plt.savefig(save_path)
-    plt.close()
 
 def visual_segmentation_binary(seg, image_filename, opt):
     img_ori = cv2.imread(os.path.join(opt.data_path + '/img', image_filename))
@@ -125,6 +125,26 @@ class CenterCropGenerator(object):
         return sample
 
 
+class ShortSideResizeGenerator(object):
+    """CenterCropGenerator without the crop: resize by the short side, keep the full frame (for tiled inference)."""
+    def __init__(self, output_size):
+        self.output_size = output_size
+
+    def __call__(self, sample):
+        image, label = sample['image'], sample['label']
+        x, y, _ = image.shape
+        scale = self.output_size[0] / min(x, y)
+        image = zoom(image, (scale, scale, 1), order=1)
+        label = zoom(label, (scale, scale), order=0)
+
+        image = torch.from_numpy(image.astype(np.float32)).unsqueeze(0)
+        label = torch.from_numpy(label.astype(np.float32))
+        sample_out = {'image': image, 'label': label.long()}
+        if 'type_prompt' in sample:
+            sample_out['type_prompt'] = sample['type_prompt']
+        return sample_out
+
+
 class USdatasetSeg(Dataset):
     def __init__(self, base_dir, list_dir, split, transform=None, prompt=False):
         self.transform = transform
@@ -74,6 +74,33 @@ available_type_prompt_list = [
     "private_Thyroid",
 ]
 
+# evaluation sets, shared by omni_test and the deployment tools
+seg_test_set = [
+    "BUS-BRA",
+    "BUSIS",
+    "BUSI",
+    "CAMUS",
+    "DDTI",
+    "Fetal_HC",
+    "KidneyUS",
+    "private_Thyroid",
+    "private_Kidney",
+    "private_Fetal_Head",
+    "private_Cardiac",
+    "private_Breast_luminal",
+    "private_Breast",
+]
+cls_test_set = [
+    "Appendix",
+    "BUS-BRA",
+    "BUSI",
+    "Fatty-Liver",
+    "private_Liver",
+    "private_Breast_luminal",
+    "private_Breast",
+    "private_Appendix",
+]
+
 # prompt one-hot
 # organ prompt
 position_prompt_one_hot_dict = {
@@ -164,6 +191,32 @@ class WeightedRandomSamplerDDP(DistributedSampler):
         return self.num_samples
 
 
+class DistributedEvalSampler(DistributedSampler):
+    r"""Shards ``[0,..,len(data_set)-1]`` across ranks in order, without padding.
+
+    Unlike :class:`DistributedSampler` no index is duplicated to even out the shards, so the
+    union over ranks is exactly the dataset and gathered metrics are exact. Ranks may get
+    one sample more than others.
+
+    Args:
+        data_set: Dataset to shard.
+        num_replicas (int): Number of processes participating in evaluation.
+        rank (int): Rank of the current process within :attr:`num_replicas`.
+    """
+
+    def __init__(self, data_set, num_replicas: int, rank: int) -> None:
+        super(DistributedEvalSampler, self).__init__(data_set, num_replicas, rank, shuffle=False)
+        self.indices = list(range(len(data_set)))[self.rank::self.num_replicas]
+        self.num_samples = len(self.indices)
+        self.total_size = len(data_set)
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return self.num_samples
+
+
 class USdatasetOmni_seg(Dataset):
     def __init__(self, base_dir, split, transform=None, prompt=False):
         self.transform = transform
@@ -0,0 +1,106 @@
+import argparse
+import logging
+import os
+import sys
+
+import torch
+
+from config import get_config
+from networks.omni_vision_transformer import OmniVisionTransformer as ViT_omni
+from networks.omni_export import load_omni_checkpoint, export_torchscript, load_exported
+from networks.omni_export import export_onnx, OnnxOmni, check_parity
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--output_dir', type=str, help='experiment dir holding best_model.pth')
+parser.add_argument('--snapshot', type=str, default=None, help='checkpoint to export, default <output_dir>/best_model.pth')
+parser.add_argument('--save_path', type=str, default=None,
+                    help='artifact path, default <output_dir>/omni_scripted.pt or <output_dir>/omni.onnx')
+parser.add_argument('--format', type=str, default='torchscript', choices=['torchscript', 'onnx'],
+                    help='artifact format')
+parser.add_argument('--check_parity', action='store_true',
+                    help='compare the artifact against the torch model on the data_demo samples')
+parser.add_argument('--demo_root', type=str, default='data_demo/', help='root dir of the parity samples')
+parser.add_argument('--img_size', type=int, default=224, help='input patch size of network input')
+parser.add_argument('--batch_size', type=int, default=1, help='batch size of the example input used for tracing (the graph accepts any batch size)')
+parser.add_argument('--cfg', type=str, default="configs/swin_tiny_patch4_window7_224_lite.yaml",
+                    metavar="FILE", help='path to config file', )
+parser.add_argument(
+    "--opts",
+    help="Modify config options by adding 'KEY VALUE' pairs. ",
+    default=None,
+    nargs='+',
+)
+parser.add_argument('--zip', action='store_true', help='use zipped dataset instead of folder dataset')
+parser.add_argument('--cache-mode', type=str, default='part', choices=['no', 'full', 'part'],
+                    help='no: no cache, '
+                    'full: cache all data, '
+                    'part: sharding the dataset into nonoverlapping pieces and only cache one piece')
+parser.add_argument('--resume', help='resume from checkpoint')
+parser.add_argument('--accumulation-steps', type=int, help="gradient accumulation steps")
+parser.add_argument('--use-checkpoint', action='store_true',
+                    help="whether to use gradient checkpointing to save memory")
+parser.add_argument('--amp-opt-level', type=str, default='O1', choices=['O0', 'O1', 'O2'],
+                    help='mixed precision opt level, if O0, no amp is used')
+parser.add_argument('--tag', help='tag of experiment')
+parser.add_argument('--eval', action='store_true', help='Perform evaluation only')
+parser.add_argument('--throughput', action='store_true', help='Test throughput only')
+
+parser.add_argument('--prompt', action='store_true', help='using prompt')
+parser.add_argument('--fold_task', type=str, default=None, choices=['segmentation', 'classification'],
+                    help='fold the prompt path for this task (requires --fold_position)')
+parser.add_argument('--fold_position', type=str, default=None, help='position prompt to fold, e.g. breast')
+parser.add_argument('--fold_nature', type=str, default='organ', help='nature prompt to fold')
+parser.add_argument('--fold_type', type=str, default='whole', help='type prompt to fold')
+
+args = parser.parse_args()
+config = get_config(args)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO,
+                        format='[%(asctime)s.%(msecs)03d] %(message)s', datefmt='%H:%M:%S')
+
+    net = ViT_omni(
+        config,
+        prompt=args.prompt,
+    )
+
+    snapshot = args.snapshot or os.path.join(args.output_dir, 'best_model.pth')
+    msg = load_omni_checkpoint(net, snapshot, map_location='cpu')
+    logging.info("load %s: %s", snapshot, msg)
+
+    fold_prompt = None
+    if args.fold_task is not None:
+        assert args.prompt and args.fold_position is not None, "--fold_task needs --prompt and --fold_position"
+        fold_prompt = {'position': args.fold_position, 'task': args.fold_task,
+                       'type': args.fold_type, 'nature': args.fold_nature}
+
+    if args.format == 'onnx':
+        assert fold_prompt is None, "prompt folding is only supported for torchscript"
+
+    if args.save_path is not None:
+        save_path = args.save_path
+    elif args.format == 'onnx':
+        save_path = os.path.join(args.output_dir, 'omni.onnx')
+    elif fold_prompt is not None:
+        save_path = os.path.join(args.output_dir, 'omni_folded_{}_{}_{}_{}.pt'.format(
+            args.fold_task, args.fold_position, args.fold_nature, args.fold_type))
+    else:
+        save_path = os.path.join(args.output_dir, 'omni_scripted.pt')
+
+    torch.set_grad_enabled(False)
+    if args.format == 'onnx':
+        meta = export_onnx(net, save_path, img_size=args.img_size)
+    else:
+        meta = export_torchscript(net, save_path, img_size=args.img_size, batch_size=args.batch_size,
+                                  fold_prompt=fold_prompt)
+    logging.info("exported %s %s", save_path, meta)
+
+    if args.check_parity:
+        assert fold_prompt is None, "parity check needs the prompt as input"
+        if args.format == 'onnx':
+            backend = OnnxOmni(save_path)
+        else:
+            backend, _ = load_exported(save_path)
+        check_parity(net, backend, args.demo_root, img_size=args.img_size)
+        logging.info("parity check passed")
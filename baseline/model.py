@@ -2,6 +2,7 @@
 
 import os
 import cv2
+import glob
 import json
 from PIL import Image
 import numpy as np
@@ -11,7 +12,10 @@ from tqdm import tqdm
 import torch
 from config import get_config
 from networks.omni_vision_transformer import OmniVisionTransformer as ViT_omni
-from datasets.dataset import CenterCropGenerator
+from networks.omni_export import load_omni_checkpoint, load_exported, OnnxOmni
+from networks.omni_tta import OmniTTA, TTA_PRESETS
+from networks.omni_tiling import sliding_window_seg
+from datasets.dataset import CenterCropGenerator, ShortSideResizeGenerator
 
 
 organ_to_position_map = {
@@ -75,6 +79,13 @@ class Model:
             cfg = 'configs/swin_tiny_patch4_window7_224_lite.yaml' # 你的配置文件名
             img_size = 224
             prompt = True
+            backend = 'torch'  # 'torch', 'onnx' (ONNX Runtime CPU, see export.py --format onnx) or 'int8' (see quantize.py)
+            num_threads = 0  # intra-op threads for the onnx/int8 backends, 0 keeps the default
+            tta = 'none'  # test-time augmentation: 'none', 'flip', 'light' or 'full' (see networks/omni_tta.py)
+            tta_max_views = None  # latency budget, cap on the number of views per image
+            tiled = False  # segment the full short-side resized frame with overlapping img_size windows (see networks/omni_tiling.py)
+            tile_overlap = 0.5
+            tile_batch_size = 8  # windows per forward
 
             opts = None
             batch_size = None
@@ -92,44 +103,54 @@ class Model:
         self.args = args
         config = get_config(args)
 
-        self.network = ViT_omni(config, prompt=args.prompt).to(self.device)
-
+        # TorchScript artifacts written by export.py take precedence over the eager model
+        exported_path = 'exp_out/trial_2/omni_scripted.pt'
+        onnx_path = 'exp_out/trial_2/omni.onnx'
+        int8_path = 'exp_out/trial_2/omni_int8.pt'
+        self.folded_networks = {}
+        if args.backend == 'onnx':
+            self.device = torch.device("cpu")
+            self.network = OnnxOmni(onnx_path, num_threads=args.num_threads)
+        elif args.backend == 'int8':
+            # quantized kernels are CPU only
+            self.device = torch.device("cpu")
+            if args.num_threads > 0:
+                torch.set_num_threads(args.num_threads)
+            self.network, _ = load_exported(int8_path, self.device)
+        elif os.path.exists(exported_path):
+            self.network, _ = load_exported(exported_path, self.device)
+            for folded_path in glob.glob(os.path.join(os.path.dirname(exported_path), 'omni_folded_*.pt')):
+                folded_network, meta = load_exported(folded_path, self.device)
+                fold_prompt = meta['fold_prompt']
+                prompt_key = (fold_prompt['task'], fold_prompt['position'], fold_prompt['nature'], fold_prompt['type'])
+                self.folded_networks[prompt_key] = folded_network
+        else:
+            self.network = ViT_omni(config, prompt=args.prompt).to(self.device)
 
-        snapshot_path = 'exp_out/trial_2/best_model.pth'
-        pretrained_dict = torch.load(snapshot_path, map_location=self.device)
-        
+            snapshot_path = 'exp_out/trial_2/best_model.pth'
+            load_omni_checkpoint(self.network, snapshot_path, map_location=self.device)
 
-        if "module.swin.layers_task_cls_head_4cls.0.weight" in pretrained_dict:
-            # DDP v2 (state_dict in a dict)
-            if 'model' in pretrained_dict:
-                pretrained_dict = pretrained_dict['model']
-
-            new_state_dict = {}
-            for k, v in pretrained_dict.items():
-                if k.startswith('module.'):
-                    new_state_dict[k[7:]] = v  # remove `module.`
-                else:
-                    new_state_dict[k] = v
-            self.network.load_state_dict(new_state_dict)
-        elif "swin.layers_task_cls_head_4cls.0.weight" in pretrained_dict:
-            # DDP v1
-            self.network.load_state_dict(pretrained_dict)
-        else:
-            # load from self (omni_test.py)
-            import copy
-            full_dict = copy.deepcopy(pretrained_dict)
-            for k, v in pretrained_dict.items():
-                if "module." not in k:
-                    full_dict["module."+k] = v
-                    del full_dict[k]
-            self.network.load_state_dict(full_dict)
+        if args.tta != 'none':
+            # all views of an image go through one batched forward of the selected backend
+            tta_kwargs = dict(max_views=args.tta_max_views, **TTA_PRESETS[args.tta])
+            self.network = OmniTTA(self.network, **tta_kwargs)
+            self.folded_networks = {key: OmniTTA(net, **tta_kwargs) for key, net in self.folded_networks.items()}
 
         self.network.eval()
         
         self.transform = CenterCropGenerator(output_size=[args.img_size, args.img_size])
+        self.tiled_transform = ShortSideResizeGenerator(output_size=[args.img_size, args.img_size])
+        self.tiling = dict(tile_size=args.img_size, overlap=args.tile_overlap, tile_batch_size=args.tile_batch_size)
 
         print("Model initialized.")
 
+    def _forward(self, network, model_input, tiled=False):
+        if not tiled:
+            return network(model_input)
+        if isinstance(model_input, tuple):
+            return (sliding_window_seg(network, model_input[0], model_input[1:], **self.tiling),)
+        return (sliding_window_seg(network, model_input, **self.tiling),)
+
     def predict_segmentation_and_classification(self, data_list, input_dir, output_dir):
         class_predictions = {}
 
@@ -143,8 +164,9 @@ class Model:
             original_size = img.size # (width, height)
             img_np = np.array(img)
             
+            tiled = self.args.tiled and task == 'segmentation'
             sample = {'image': img_np / 255.0, 'label': np.zeros(img_np.shape[:2])}
-            processed_sample = self.transform(sample)
+            processed_sample = (self.tiled_transform if tiled else self.transform)(sample)
             image_tensor = processed_sample['image'].to(self.device) # shape: [1, H, W, C]
 
             with torch.no_grad():
@@ -163,10 +185,14 @@ class Model:
                     type_p_vec = type_prompt_one_hot_dict["whole"]
                     type_prompt = torch.tensor(type_p_vec, dtype=torch.float).unsqueeze(0).to(self.device)
 
-                    model_input = (image_tensor, position_prompt, task_prompt, type_prompt, nature_prompt)
-                    outputs_tuple = self.network(model_input)
+                    prompt_key = (task, position_key, nature_key, "whole")
+                    if prompt_key in self.folded_networks:
+                        outputs_tuple = self._forward(self.folded_networks[prompt_key], image_tensor, tiled)
+                    else:
+                        model_input = (image_tensor, position_prompt, task_prompt, type_prompt, nature_prompt)
+                        outputs_tuple = self._forward(self.network, model_input, tiled)
                 else:
-                    outputs_tuple = self.network(image_tensor)
+                    outputs_tuple = self._forward(self.network, image_tensor, tiled)
 
             if task == 'classification':
                 if dataset_name == 'Breast_luminal':
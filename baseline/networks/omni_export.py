@@ -0,0 +1,265 @@
+import inspect
+import json
+import logging
+import os
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+logger = logging.getLogger(__name__)
+
+
+def strip_module_prefix(state_dict):
+    """
+    Normalize any checkpoint written by omni_train / omni_test to plain `swin.*` keys.
+
+    Handles the resume dict (`{'model': ..., 'optimizer': ..., 'epoch': ...}`) as well as
+    state dicts saved from a DistributedDataParallel wrapper (`module.swin.*`).
+    """
+    if 'model' in state_dict and isinstance(state_dict['model'], dict):
+        state_dict = state_dict['model']
+    new_state_dict = {}
+    for k, v in state_dict.items():
+        if k.startswith('module.'):
+            new_state_dict[k[7:]] = v  # remove `module.`
+        else:
+            new_state_dict[k] = v
+    return new_state_dict
+
+
+def load_omni_checkpoint(net, snapshot, map_location='cpu', strict=True):
+    """Load a trained checkpoint into a bare (non DDP) OmniVisionTransformer."""
+    pretrained_dict = torch.load(snapshot, map_location=map_location)
+    return net.load_state_dict(strip_module_prefix(pretrained_dict), strict=strict)
+
+
+def revert_sync_batchnorm(module):
+    """Inverse of `nn.SyncBatchNorm.convert_sync_batchnorm`, so the graph has no process group."""
+    module_output = module
+    if isinstance(module, nn.SyncBatchNorm):
+        module_output = nn.BatchNorm2d(module.num_features, module.eps, module.momentum,
+                                       module.affine, module.track_running_stats)
+        if module.affine:
+            with torch.no_grad():
+                module_output.weight = module.weight
+                module_output.bias = module.bias
+        module_output.running_mean = module.running_mean
+        module_output.running_var = module.running_var
+        module_output.num_batches_tracked = module.num_batches_tracked
+    for name, child in module.named_children():
+        module_output.add_module(name, revert_sync_batchnorm(child))
+    del module
+    return module_output
+
+
+class PromptFoldedOmni(nn.Module):
+    """
+    OmniVisionTransformer with the prompt MLPs evaluated once for a fixed prompt.
+
+    The four decoder prompt embeddings are stored as buffers, so the forward only takes
+    the image ([B, 1, H, W, C], same layout as OmniVisionTransformer) and returns
+    (seg, cls_2_way, cls_4_way).
+    """
+
+    def __init__(self, net, position_prompt, task_prompt, type_prompt, nature_prompt):
+        super().__init__()
+        assert net.prompt, "prompt folding needs a model trained with --prompt"
+        self.swin = net.swin
+        with torch.no_grad():
+            prompt_embeds = self.swin.forward_prompt(position_prompt, task_prompt, type_prompt, nature_prompt)
+        for i, embed in enumerate(prompt_embeds):
+            self.register_buffer('prompt_embed_{}'.format(i), embed.detach().clone())
+
+    def forward(self, x):
+        image = x.squeeze(1).permute(0, 3, 1, 2)  # [B, H, W, C] -> [B, C, H, W]
+        prompt_embeds = (self.prompt_embed_0, self.prompt_embed_1, self.prompt_embed_2, self.prompt_embed_3)
+        return self.swin.forward_prompted(image, prompt_embeds)
+
+
+def prompt_vectors(position, task, type_, nature, device='cpu'):
+    """One-hot prompt tensors ([1, N] each) from prompt names, in the model's input order."""
+    from datasets.omni_dataset import position_prompt_one_hot_dict
+    from datasets.omni_dataset import nature_prompt_one_hot_dict
+    from datasets.omni_dataset import type_prompt_one_hot_dict
+    from datasets.omni_dataset import task_prompt_one_hot_dict
+
+    def to_tensor(vec):
+        return torch.tensor(vec, dtype=torch.float).unsqueeze(0).to(device)
+
+    return (to_tensor(position_prompt_one_hot_dict[position]),
+            to_tensor(task_prompt_one_hot_dict[task]),
+            to_tensor(type_prompt_one_hot_dict[type_]),
+            to_tensor(nature_prompt_one_hot_dict[nature]))
+
+
+def export_torchscript(net, save_path, img_size=224, batch_size=1, fold_prompt=None):
+    """
+    Trace, freeze and save `net` as a TorchScript artifact.
+
+    Args:
+        net: OmniVisionTransformer with trained weights loaded (not DDP wrapped).
+        save_path: Output file.
+        img_size: Input resolution the graph is specialized for.
+        batch_size: Batch size of the example input (the traced graph accepts any batch size).
+        fold_prompt: Optional dict with `position`, `task`, `type` and `nature` prompt names.
+            When given the prompt path is folded and the artifact only takes the image.
+    """
+    net = revert_sync_batchnorm(net).cpu().eval()
+    image = torch.rand(batch_size, 1, img_size, img_size, 3)
+    meta = {'img_size': img_size, 'batch_size': batch_size, 'prompt': net.prompt, 'fold_prompt': fold_prompt}
+
+    with torch.no_grad():
+        if fold_prompt is not None:
+            prompts = prompt_vectors(fold_prompt['position'], fold_prompt['task'],
+                                     fold_prompt['type'], fold_prompt['nature'])
+            module = PromptFoldedOmni(net, *prompts).eval()
+            example_inputs = (image,)
+        elif net.prompt:
+            module = net
+            prompts = prompt_vectors('breast', 'segmentation', 'whole', 'tumor')
+            prompts = tuple(p.repeat(batch_size, 1) for p in prompts)
+            example_inputs = ((image,) + prompts,)
+        else:
+            module = net
+            example_inputs = (image,)
+
+        traced = torch.jit.trace(module, example_inputs)
+        traced = torch.jit.freeze(traced)
+
+        # sanity check that the frozen graph reproduces eager outputs
+        for ref, out in zip(module(*example_inputs), traced(*example_inputs)):
+            max_diff = (ref - out).abs().max().item()
+            logger.info("export max abs diff: %f", max_diff)
+
+    torch.jit.save(traced, save_path, _extra_files={'meta.json': json.dumps(meta)})
+    return meta
+
+
+def load_exported(path, device='cpu'):
+    """Load an artifact written by `export_torchscript`. Returns (module, meta)."""
+    extra_files = {'meta.json': ''}
+    module = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+    module.eval()
+    meta = json.loads(extra_files['meta.json']) if extra_files['meta.json'] else {}
+    return module, meta
+
+
+ONNX_INPUT_NAMES = ['image', 'position_prompt', 'task_prompt', 'type_prompt', 'nature_prompt']
+ONNX_OUTPUT_NAMES = ['seg', 'cls2', 'cls4']
+
+
+def export_onnx(net, save_path, img_size=224, opset_version=17):
+    """
+    Export `net` to ONNX with the prompt vectors as graph inputs.
+
+    Inputs are named as in ONNX_INPUT_NAMES (image in the [B, 1, H, W, C] layout of
+    OmniVisionTransformer), outputs are `seg`, `cls2` and `cls4`. The batch axis is dynamic.
+    """
+    net = revert_sync_batchnorm(net).cpu().eval()
+    image = torch.rand(1, 1, img_size, img_size, 3)
+    if net.prompt:
+        prompts = prompt_vectors('breast', 'segmentation', 'whole', 'tumor')
+        example_inputs = ((image,) + prompts,)
+        input_names = ONNX_INPUT_NAMES
+    else:
+        example_inputs = (image,)
+        input_names = ONNX_INPUT_NAMES[:1]
+    dynamic_axes = {name: {0: 'batch'} for name in input_names + ONNX_OUTPUT_NAMES}
+
+    export_kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        export_kwargs['dynamo'] = False  # keep the tracing exporter and its dynamic_axes
+    with torch.no_grad():
+        torch.onnx.export(net, example_inputs, save_path,
+                          input_names=input_names,
+                          output_names=ONNX_OUTPUT_NAMES,
+                          dynamic_axes=dynamic_axes,
+                          opset_version=opset_version,
+                          do_constant_folding=True,
+                          **export_kwargs)
+    return {'img_size': img_size, 'prompt': net.prompt, 'opset_version': opset_version}
+
+
+class OnnxOmni(object):
+    """
+    ONNX Runtime CPU backend with the call convention of OmniVisionTransformer.
+
+    Called with the same input as the torch model (image tensor, or the 5-tuple with prompts)
+    and returns the (seg, cls_2_way, cls_4_way) tuple as torch tensors. Inputs and outputs go
+    through IO binding so ONNX Runtime reads the numpy buffers in place.
+
+    Args:
+        path: ONNX file written by `export_onnx`.
+        num_threads: intra-op threads, 0 lets ONNX Runtime decide.
+        inter_op_num_threads: inter-op threads, 0 lets ONNX Runtime decide.
+    """
+
+    def __init__(self, path, num_threads=0, inter_op_num_threads=0):
+        import onnxruntime as ort
+
+        sess_options = ort.SessionOptions()
+        sess_options.intra_op_num_threads = num_threads
+        sess_options.inter_op_num_threads = inter_op_num_threads
+        sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(path, sess_options, providers=['CPUExecutionProvider'])
+        self.input_names = [node.name for node in self.session.get_inputs()]
+        self.output_names = [node.name for node in self.session.get_outputs()]
+
+    def eval(self):
+        return self
+
+    def __call__(self, x):
+        inputs = list(x) if isinstance(x, (tuple, list)) else [x]
+        if inputs[0].dim() == 4:
+            inputs[0] = inputs[0].unsqueeze(1)  # [B, H, W, C] as passed by model.py -> [B, 1, H, W, C]
+        io_binding = self.session.io_binding()
+        for name, tensor in zip(self.input_names, inputs):
+            array = np.ascontiguousarray(tensor.detach().cpu().numpy(), dtype=np.float32)
+            io_binding.bind_cpu_input(name, array)
+        for name in self.output_names:
+            io_binding.bind_output(name, 'cpu')
+        self.session.run_with_iobinding(io_binding)
+        return tuple(torch.from_numpy(out) for out in io_binding.copy_outputs_to_cpu())
+
+
+def check_parity(net, backend, data_root, img_size=224, atol=1e-3):
+    """
+    Compare `backend` (e.g. OnnxOmni or a TorchScript module) against the eager torch model
+    on the `data_demo` BUSIS segmentation and UDIAT classification samples.
+
+    Returns a list of (case_name, max_abs_diff, prediction_agreement) and raises AssertionError
+    when the logits differ by more than `atol` or predictions disagree (seg: >0.1% of pixels).
+    """
+    from datasets.dataset import CenterCropGenerator, USdatasetSeg, USdatasetCls
+
+    transform = CenterCropGenerator(output_size=[img_size, img_size])
+    # UDIAT is not in the training prompt dicts, both demo sets are breast tumor images
+    demo_sets = [
+        ('segmentation', 'BUSIS', USdatasetSeg),
+        ('classification', 'UDIAT', USdatasetCls),
+    ]
+    net = net.cpu().eval()
+    results = []
+    for task, dataset_name, dataset_cls in demo_sets:
+        dataset_dir = os.path.join(data_root, task, dataset_name)
+        db_test = dataset_cls(base_dir=dataset_dir, split="test", list_dir=dataset_dir, transform=transform)
+        prompts = prompt_vectors('breast', task, 'whole', 'tumor')
+        for sample in db_test:
+            image = sample['image'].unsqueeze(0)
+            model_input = (image,) + prompts if net.prompt else image
+            with torch.no_grad():
+                ref = net(model_input)
+                out = backend(model_input)
+            max_diff = max((r - o.to(r.device)).abs().max().item() for r, o in zip(ref, out))
+            if task == 'segmentation':
+                agreement = (ref[0].argmax(1) == out[0].argmax(1)).float().mean().item()
+            else:
+                agreement = float(ref[1].argmax(1).item() == out[1].argmax(1).item() and
+                                  ref[2].argmax(1).item() == out[2].argmax(1).item())
+            logger.info("%s/%s max abs diff %f, prediction agreement %f",
+                        dataset_name, sample['case_name'], max_diff, agreement)
+            results.append((sample['case_name'], max_diff, agreement))
+            assert max_diff <= atol, "{} differs by {}".format(sample['case_name'], max_diff)
+            assert agreement >= 0.999, "{} prediction changed".format(sample['case_name'])
+    return results
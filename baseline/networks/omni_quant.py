@@ -0,0 +1,70 @@
+import copy
+import logging
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import QuantWrapper, get_default_qconfig, prepare, convert, quantize_dynamic
+
+logger = logging.getLogger(__name__)
+
+
+def select_quantized_engine():
+    """Pick the best available int8 CPU kernel library (x86/fbgemm on Intel/AMD, qnnpack on ARM)."""
+    for engine in ['x86', 'fbgemm', 'qnnpack']:
+        if engine in torch.backends.quantized.supported_engines:
+            torch.backends.quantized.engine = engine
+            return engine
+    raise RuntimeError("no quantized engine available in this torch build")
+
+
+def quantize_dynamic_linear(net):
+    """
+    Dynamic int8 quantization of every nn.Linear (Mlp, WindowAttention.qkv/proj,
+    PatchMerging.reduction, PatchExpand.expand, layers_task_seg_skip, heads).
+
+    Weights are stored in int8, activations are quantized on the fly per batch, so no
+    calibration is needed. Returns a new module, `net` is left untouched.
+    """
+    net = copy.deepcopy(net).cpu().eval()
+    return quantize_dynamic(net, {nn.Linear}, dtype=torch.qint8)
+
+
+def _wrap_linear(module, qconfig):
+    for name, child in module.named_children():
+        if isinstance(child, nn.Linear):
+            wrapper = QuantWrapper(child)
+            wrapper.qconfig = qconfig
+            setattr(module, name, wrapper)
+        else:
+            _wrap_linear(child, qconfig)
+
+
+def quantize_static_linear(net, calib_loader, forward_fn, num_batches=None):
+    """
+    Calibrated static int8 quantization of every nn.Linear.
+
+    Each Linear is wrapped in a QuantStub/DeQuantStub pair, so LayerNorm, softmax, GELU and the
+    window shuffles stay in fp32 while the matmuls run with calibrated activation scales.
+
+    Args:
+        net: fp32 OmniVisionTransformer (not DDP wrapped).
+        calib_loader: iterable of batches used to collect activation ranges.
+        forward_fn: callable(model, batch) running one forward pass on a batch.
+        num_batches: stop calibration after this many batches.
+    """
+    net = copy.deepcopy(net).cpu().eval()
+    qconfig = get_default_qconfig(torch.backends.quantized.engine)
+    _wrap_linear(net, qconfig)
+    prepare(net, inplace=True)
+
+    seen_batches = 0
+    with torch.no_grad():
+        for batch in calib_loader:
+            if num_batches is not None and seen_batches >= num_batches:
+                break
+            forward_fn(net, batch)
+            seen_batches += 1
+    logger.info("calibrated static quantization on %d batches", seen_batches)
+
+    convert(net, inplace=True)
+    return net
@@ -0,0 +1,65 @@
+import math
+
+import torch
+import torch.nn.functional as F
+
+
+def gaussian_weight(tile_size, sigma_scale=0.125, device=None, dtype=torch.float32):
+    """[tile_size, tile_size] blending weights peaking at the tile center (sigma = sigma_scale * tile_size)."""
+    coords = torch.arange(tile_size, device=device, dtype=dtype) - (tile_size - 1) / 2
+    gauss = torch.exp(-coords ** 2 / (2 * (sigma_scale * tile_size) ** 2))
+    weight = gauss[:, None] * gauss[None, :]
+    return weight / weight.max()
+
+
+def tile_starts(length, tile_size, stride):
+    """Window offsets covering [0, length) with windows of tile_size, at most stride apart."""
+    if length <= tile_size:
+        return [0]
+    n = math.ceil((length - tile_size) / stride) + 1
+    return [round(i * (length - tile_size) / (n - 1)) for i in range(n)]
+
+
+def sliding_window_seg(net, image, prompts=(), tile_size=224, overlap=0.5, tile_batch_size=8, sigma_scale=0.125):
+    """
+    Segmentation logits of a full frame from overlapping tile_size windows.
+
+    The frame is covered with windows at the training scale (stride tile_size * (1 - overlap)),
+    the windows are run through `net` tile_batch_size at a time (this bounds the memory), and
+    the seg logits are blended with Gaussian weights, so every pixel is predicted mostly by
+    windows in which it is near the center.
+
+    Args:
+        net: model with the OmniVisionTransformer call convention.
+        image: [B, 1, H, W, C] or [B, H, W, C] frames, H and W may exceed tile_size.
+        prompts: (position, task, type, nature) [B, N] prompt tensors, empty without prompts.
+
+    Returns seg logits [B, num_classes, H, W].
+    """
+    image = image if image.dim() == 5 else image.unsqueeze(1)
+    B, _, H, W, _ = image.shape
+    pad_h, pad_w = max(tile_size - H, 0), max(tile_size - W, 0)
+    if pad_h or pad_w:
+        image = F.pad(image, (0, 0, 0, pad_w, 0, pad_h))
+    stride = max(int(tile_size * (1 - overlap)), 1)
+    positions = [(b, y, x) for b in range(B)
+                 for y in tile_starts(image.shape[2], tile_size, stride)
+                 for x in tile_starts(image.shape[3], tile_size, stride)]
+
+    weight = gaussian_weight(tile_size, sigma_scale, device=image.device, dtype=image.dtype)
+    logits = None
+    weights = torch.zeros(B, 1, image.shape[2], image.shape[3], device=image.device, dtype=image.dtype)
+    for start in range(0, len(positions), tile_batch_size):
+        chunk = positions[start:start + tile_batch_size]
+        tiles = torch.cat([image[b:b + 1, :, y:y + tile_size, x:x + tile_size] for b, y, x in chunk])
+        if prompts:
+            index = torch.tensor([b for b, _, _ in chunk], device=prompts[0].device)
+            seg = net((tiles,) + tuple(p[index] for p in prompts))[0]
+        else:
+            seg = net(tiles)[0]
+        if logits is None:
+            logits = torch.zeros(B, seg.shape[1], image.shape[2], image.shape[3], device=seg.device, dtype=seg.dtype)
+        for (b, y, x), seg_tile in zip(chunk, seg):
+            logits[b, :, y:y + tile_size, x:x + tile_size] += seg_tile * weight
+            weights[b, :, y:y + tile_size, x:x + tile_size] += weight
+    return (logits / weights)[:, :, :H, :W]
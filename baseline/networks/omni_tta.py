@@ -0,0 +1,126 @@
+import itertools
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+# view budgets, from the plain forward to 2 flips x 3 scales x 3 angles
+TTA_PRESETS = {
+    'none': dict(flips=(False,), scales=(1.0,), angles=(0.0,)),
+    'flip': dict(flips=(False, True), scales=(1.0,), angles=(0.0,)),
+    'light': dict(flips=(False, True), scales=(1.0, 0.875, 1.125), angles=(0.0,)),
+    'full': dict(flips=(False, True), scales=(1.0, 0.875, 1.125), angles=(0.0, -10.0, 10.0)),
+}
+
+
+def _view_matrix(flip, scale, angle):
+    """
+    2x3 affine_grid theta of one view: view(u) = image(theta @ u) in normalized coordinates,
+    i.e. the image is h-flipped, then rotated by `angle` degrees and zoomed by `scale`.
+    """
+    rad = math.radians(angle)
+    rotation = torch.tensor([[math.cos(rad), -math.sin(rad)], [math.sin(rad), math.cos(rad)]])
+    flip_matrix = torch.diag(torch.tensor([-1.0 if flip else 1.0, 1.0]))
+    linear = flip_matrix @ rotation / scale
+    return torch.cat([linear, torch.zeros(2, 1)], dim=1)
+
+
+def _inverse_matrix(theta):
+    return torch.inverse(torch.cat([theta, torch.tensor([[0.0, 0.0, 1.0]])]))[:2]
+
+
+def _warp(x, theta, mode='bilinear'):
+    grid = F.affine_grid(theta.to(x).expand(x.shape[0], 2, 3), list(x.shape), align_corners=False)
+    return F.grid_sample(x, grid, mode=mode, padding_mode='zeros', align_corners=False)
+
+
+class OmniTTA(nn.Module):
+    """
+    Test-time augmentation around a model with the OmniVisionTransformer call convention.
+
+    All views of a batch (h-flips x zooms around the input size x small rotations) are stacked
+    into one [V*B] batch and run through a single forward of `net`. Seg logits are warped back
+    onto the input grid (pixels a view does not cover are left out of its average), then
+    seg / cls_2_way / cls_4_way are merged over the views.
+
+    Args:
+        net: OmniVisionTransformer, or any callable taking the image (or the 5-tuple with
+            prompts) and returning (seg, cls_2_way, cls_4_way), e.g. a TorchScript artifact.
+        flips, scales, angles: view grid; the identity view comes first, then the h-flip.
+        max_views: keep only the first views of the grid, the latency budget.
+        reduction: 'mean' of logits, 'prob' (log of the mean softmax) or 'max' of logits.
+    """
+    def __init__(self, net, flips=(False, True), scales=(1.0,), angles=(0.0,), max_views=None, reduction='mean'):
+        super(OmniTTA, self).__init__()
+        assert reduction in ('mean', 'prob', 'max'), reduction
+        self.net = net
+        self.reduction = reduction
+        # cheapest / most reliable first: identity, h-flip, zooms, then rotations
+        views = sorted(itertools.product(flips, scales, angles),
+                       key=lambda view: (view[2] != 0.0, view[1] != 1.0, view[0]))
+        self.views = views[:max_views]
+
+    def _augment(self, image):
+        # image [B, C, H, W] -> [V*B, C, H, W]
+        views = []
+        for flip, scale, angle in self.views:
+            if scale == 1.0 and angle == 0.0:
+                views.append(torch.flip(image, dims=[3]) if flip else image)
+            else:
+                views.append(_warp(image, _view_matrix(flip, scale, angle)))
+        return torch.cat(views, dim=0)
+
+    def _deaugment(self, seg):
+        # seg [V, B, K, H, W] -> logits [V, B, K, H, W] on the input grid and coverage [V, B, 1, H, W]
+        logits, weights = [], []
+        for (flip, scale, angle), seg_view in zip(self.views, seg):
+            if scale == 1.0 and angle == 0.0:
+                logits.append(torch.flip(seg_view, dims=[3]) if flip else seg_view)
+                weights.append(torch.ones_like(seg_view[:, :1]))
+            else:
+                # only view pixels fully inside the image (not blended with the zero padding) are
+                # warped back, the result is renormalized by their bilinear coverage, which is
+                # also the weight of the view in the average
+                ones = torch.ones_like(seg_view[:, :1])
+                valid = (_warp(ones, _view_matrix(flip, scale, angle)) > 1 - 1e-3).to(seg_view)
+                theta = _inverse_matrix(_view_matrix(flip, scale, angle))
+                coverage = _warp(valid, theta)
+                coverage = coverage.masked_fill(coverage < 1e-3, 0.0)
+                logits.append(_warp(seg_view * valid, theta) / coverage.clamp(min=1e-3))
+                weights.append(coverage)
+        return torch.stack(logits), torch.stack(weights)
+
+    def _reduce(self, logits, weights=None):
+        if weights is None:
+            weights = torch.ones_like(logits[..., :1])
+        if self.reduction == 'max':
+            return logits.masked_fill(weights <= 0, float('-inf')).max(dim=0).values
+        if self.reduction == 'prob':
+            probs = torch.softmax(logits, dim=2)
+            return torch.log((probs * weights).sum(0) / weights.sum(0).clamp(min=1e-6))
+        return (logits * weights).sum(0) / weights.sum(0).clamp(min=1e-6)
+
+    def forward(self, x):
+        prompts = ()
+        if isinstance(x, (tuple, list)):
+            x, prompts = x[0], tuple(x[1:])
+        image = x.squeeze(1) if x.dim() == 5 else x  # [B, 1, H, W, C] or [B, H, W, C]
+        B = image.shape[0]
+        V = len(self.views)
+
+        views = self._augment(image.permute(0, 3, 1, 2)).permute(0, 2, 3, 1)  # [V*B, H, W, C]
+        if x.dim() == 5:
+            views = views.unsqueeze(1)
+        if prompts:
+            net_input = (views,) + tuple(p.repeat(V, *([1] * (p.dim() - 1))) for p in prompts)
+        else:
+            net_input = views
+        seg, cls_2_way, cls_4_way = self.net(net_input)
+
+        seg_logits, seg_weights = self._deaugment(seg.reshape(V, B, *seg.shape[1:]))
+        seg = self._reduce(seg_logits, seg_weights)
+        cls_2_way = self._reduce(cls_2_way.reshape(V, B, -1).unsqueeze(-1)).squeeze(-1)
+        cls_4_way = self._reduce(cls_4_way.reshape(V, B, -1).unsqueeze(-1)).squeeze(-1)
+        return seg, cls_2_way, cls_4_way
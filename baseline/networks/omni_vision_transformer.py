@@ -12,7 +12,6 @@ from torch.functional import F
 import torch
 import torch.nn as nn
 import torch.utils.checkpoint as checkpoint
-from einops import rearrange
 from timm.models.layers import DropPath, to_2tuple, trunc_normal_
 from torch.functional import F
 
@@ -64,9 +63,10 @@ def window_reverse(windows, window_size, H, W):
     Returns:
         x: (B, H, W, C)
     """
-    B = int(windows.shape[0] / (H * W / window_size / window_size))
-    x = windows.view(B, H // window_size, W // window_size, window_size, window_size, -1)
-    x = x.permute(0, 1, 3, 2, 4, 5).contiguous().view(B, H, W, -1)
+    C = windows.shape[-1]
+    # batch is inferred by view(-1, ...) so traced/exported graphs keep a dynamic batch axis
+    x = windows.view(-1, H // window_size, W // window_size, window_size, window_size, C)
+    x = x.permute(0, 1, 3, 2, 4, 5).contiguous().view(-1, H, W, C)
     return x
 
 
@@ -296,6 +296,22 @@ class SwinTransformerBlock(nn.Module):
         return flops
 
 
+def patch_unshuffle(x, H, W):
+    """
+    B, H*W, C -> B, H/2*W/2, 4*C with the channel order of cat([x0, x1, x2, x3]) in PatchMerging
+    (x0: even row/even col, x1: odd/even, x2: even/odd, x3: odd/odd), as a single copy.
+    """
+    B, L, C = x.shape
+    x = x.view(B, H // 2, 2, W // 2, 2, C)
+    return x.permute(0, 1, 3, 4, 2, 5).reshape(B, (H // 2) * (W // 2), 4 * C)
+
+
+def patch_shuffle(x, H, W, scale):
+    """B, H, W, p1, p2, C -> B, (H*p1)*(W*p2), C, i.e. 'b h w p1 p2 c -> b (h p1) (w p2) c'."""
+    C = x.shape[-1]
+    return x.permute(0, 1, 3, 2, 4, 5).reshape(x.shape[0], H * scale * W * scale, C)
+
+
 class FinalPatchExpand_X4(nn.Module):
     def __init__(self, input_resolution, dim, dim_scale=4, norm_layer=nn.LayerNorm):
         super().__init__()
@@ -315,11 +331,10 @@ class FinalPatchExpand_X4(nn.Module):
         B, L, C = x.shape
         assert L == H * W, "input feature has wrong size"
 
-        x = x.view(B, H, W, C)
-        x = rearrange(x, 'b h w (p1 p2 c)-> b (h p1) (w p2) c', p1=self.dim_scale,
-                      p2=self.dim_scale, c=C//(self.dim_scale**2))
-        x = x.view(B, -1, self.output_dim)
+        # the norm is per output pixel, so it runs before the shuffle on a contiguous view
+        x = x.view(B, H, W, self.dim_scale, self.dim_scale, C // (self.dim_scale**2))
         x = self.norm(x)
+        x = patch_shuffle(x, H, W, self.dim_scale)
 
         return x
 
@@ -349,14 +364,7 @@ class PatchMerging(nn.Module):
         assert L == H * W, "input feature has wrong size"
         assert H % 2 == 0 and W % 2 == 0, f"x size ({H}*{W}) are not even."
 
-        x = x.view(B, H, W, C)
-        x0 = x[:, 0::2, 0::2, :]  # B H/2 W/2 C
-        x1 = x[:, 1::2, 0::2, :]  # B H/2 W/2 C
-        x2 = x[:, 0::2, 1::2, :]  # B H/2 W/2 C
-        x3 = x[:, 1::2, 1::2, :]  # B H/2 W/2 C
-        x = torch.cat([x0, x1, x2, x3], -1)  # B H/2 W/2 4*C
-        x = x.view(B, -1, 4 * C)  # B H/2*W/2 4*C
-
+        x = patch_unshuffle(x, H, W)  # B H/2*W/2 4*C
         x = self.norm(x)
         x = self.reduction(x)
 
@@ -389,10 +397,9 @@ class PatchExpand(nn.Module):
         B, L, C = x.shape
         assert L == H * W, "input feature has wrong size"
 
-        x = x.view(B, H, W, C)
-        x = rearrange(x, 'b h w (p1 p2 c)-> b (h p1) (w p2) c', p1=2, p2=2, c=C//4)
-        x = x.view(B, -1, C//4)
+        x = x.view(B, H, W, 2, 2, C//4)
         x = self.norm(x)
+        x = patch_shuffle(x, H, W, 2)
 
         return x
 
@@ -695,10 +702,19 @@ class SwinTransformer(nn.Module):
 
         return x, x_downsample
 
+    # Prompt embeddings, one per injection point of the decoders
+    def forward_prompt(self, position_prompt, task_prompt, type_prompt, nature_prompt):
+        prompt = torch.cat([position_prompt, task_prompt, type_prompt, nature_prompt], dim=1)
+        return (self.dec_prompt_mlp(prompt).unsqueeze(1),
+                self.dec_prompt_mlp_cls2(prompt).unsqueeze(1),
+                self.dec_prompt_mlp_seg2_cls3(prompt).unsqueeze(1),
+                self.dec_prompt_mlp_seg3(prompt).unsqueeze(1))
+
     # Decoder task head
     def forward_task_features(self, x, x_downsample):
         if self.prompt:
-            x, position_prompt, task_prompt, type_prompt, nature_prompt = x
+            x, prompt_embeds = x
+            _, prompt_cls2, prompt_seg2_cls3, prompt_seg3 = prompt_embeds
 
         # seg
         for inx, layer_seg in enumerate(self.layers_task_seg_up):
@@ -710,11 +726,9 @@ class SwinTransformer(nn.Module):
 
                 if self.prompt and inx > 1:
                     if inx == 2:
-                        x_seg = layer_seg(x_seg +
-                                          self.dec_prompt_mlp_seg2_cls3(torch.cat([position_prompt, task_prompt, type_prompt, nature_prompt], dim=1)).unsqueeze(1))
+                        x_seg = layer_seg(x_seg + prompt_seg2_cls3)
                     if inx == 3:
-                        x_seg = layer_seg(x_seg +
-                                          self.dec_prompt_mlp_seg3(torch.cat([position_prompt, task_prompt, type_prompt, nature_prompt], dim=1)).unsqueeze(1))
+                        x_seg = layer_seg(x_seg + prompt_seg3)
                 else:
                     x_seg = layer_seg(x_seg)
 
@@ -734,11 +748,9 @@ class SwinTransformer(nn.Module):
             else:
                 if self.prompt:
                     if inx == 1:
-                        x_cls = layer_head(x_cls +
-                                           self.dec_prompt_mlp_cls2(torch.cat([position_prompt, task_prompt, type_prompt, nature_prompt], dim=1)).unsqueeze(1))
+                        x_cls = layer_head(x_cls + prompt_cls2)
                     if inx == 2:
-                        x_cls = layer_head(x_cls +
-                                           self.dec_prompt_mlp_seg2_cls3(torch.cat([position_prompt, task_prompt, type_prompt, nature_prompt], dim=1)).unsqueeze(1))
+                        x_cls = layer_head(x_cls + prompt_seg2_cls3)
                 else:
                     x_cls = layer_head(x_cls)
 
@@ -753,14 +765,17 @@ class SwinTransformer(nn.Module):
 
         return (x_seg, x_cls_2_way, x_cls_4_way)
 
+    # Forward with precomputed prompt embeddings (see forward_prompt)
+    def forward_prompted(self, x, prompt_embeds):
+        x, x_downsample = self.forward_features(x)
+        x = x + prompt_embeds[0]
+        return self.forward_task_features((x, prompt_embeds), x_downsample)
+
     def forward(self, x):
         if self.prompt:
             x, position_prompt, task_prompt, type_prompt, nature_prompt = x
-            x, x_downsample = self.forward_features(x)
-            x = x + self.dec_prompt_mlp(torch.cat([position_prompt, task_prompt,
-                                        type_prompt, nature_prompt], dim=1)).unsqueeze(1)
-            x_tuple = self.forward_task_features(
-                (x, position_prompt, task_prompt, type_prompt, nature_prompt), x_downsample)
+            prompt_embeds = self.forward_prompt(position_prompt, task_prompt, type_prompt, nature_prompt)
+            x_tuple = self.forward_prompted(x, prompt_embeds)
         else:
             x, x_downsample = self.forward_features(x)
             x_tuple = self.forward_task_features(x, x_downsample)
@@ -6,18 +6,22 @@ import sys
 import numpy as np
 import torch
 import torch.backends.cudnn as cudnn
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 from tqdm import tqdm
 
 from config import get_config
 
-from datasets.dataset import CenterCropGenerator
+from datasets.dataset import CenterCropGenerator, ShortSideResizeGenerator
 from datasets.dataset import USdatasetCls, USdatasetSeg
+from datasets.omni_dataset import seg_test_set, cls_test_set
 
-from utils import omni_seg_test
+from utils import omni_seg_test_batch, omni_batch_prompts
+from utils import OmniEvalCache, omni_seg_summary, omni_cls_summary, write_eval_summary
 from sklearn.metrics import accuracy_score
 
 from networks.omni_vision_transformer import OmniVisionTransformer as ViT_omni
+from networks.omni_export import load_omni_checkpoint
+from networks.omni_tta import OmniTTA, TTA_PRESETS
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--root_path', type=str,
@@ -56,12 +60,24 @@ parser.add_argument('--eval', action='store_true', help='Perform evaluation only
 parser.add_argument('--throughput', action='store_true', help='Test throughput only')
 
 parser.add_argument('--prompt', action='store_true', help='using prompt')
+parser.add_argument('--tta', type=str, default='none', choices=list(TTA_PRESETS),
+                    help='test-time augmentation views: none, flip, light (flip x 3 zooms), full (x 3 rotations)')
+parser.add_argument('--tta_max_views', type=int, default=None, help='cap on the number of TTA views per image')
+parser.add_argument('--tta_reduction', type=str, default='mean', choices=['mean', 'prob', 'max'],
+                    help='how TTA views are merged: mean of logits, mean of probabilities or max of logits')
+parser.add_argument('--tiled', action='store_true',
+                    help='segment the full short-side resized frame with overlapping img_size windows instead of a center crop')
+parser.add_argument('--tile_overlap', type=float, default=0.5, help='overlap ratio of neighbouring windows')
+parser.add_argument('--tile_batch_size', type=int, default=8, help='windows per forward, bounds the memory of tiled inference')
+parser.add_argument('--eval_cache_dir', type=str, default='exp_out/eval_cache',
+                    help='per-sample results keyed by checkpoint hash and preprocessing, only missing cases are evaluated')
+parser.add_argument('--no_eval_cache', action='store_true', help='evaluate every case and do not touch the cache')
 
 args = parser.parse_args()
 config = get_config(args)
 
 
-def inference(args, model, test_save_path=None):
+def inference(args, model, test_save_path=None, cache=None):
     import csv
     import time
 
@@ -70,21 +86,9 @@ def inference(args, model, test_save_path=None):
             writer = csv.writer(csvfile)
             writer.writerow(['dataset', 'task', 'metric', 'time'])
 
-    seg_test_set = [
-        "BUS-BRA",
-        "BUSIS",
-        "BUSI",
-        "CAMUS",
-        "DDTI",
-        "Fetal_HC",
-        "KidneyUS",
-        "private_Thyroid",
-        "private_Kidney",
-        "private_Fetal_Head",
-        "private_Cardiac",
-        "private_Breast_luminal",
-        "private_Breast",
-    ]
+    tiling = None
+    if args.tiled:
+        tiling = dict(tile_size=args.img_size, overlap=args.tile_overlap, tile_batch_size=args.tile_batch_size)
 
     for dataset_name in seg_test_set:
         num_classes = 2
@@ -92,49 +96,53 @@ def inference(args, model, test_save_path=None):
             base_dir=os.path.join(args.root_path, "segmentation", dataset_name),
             split="test",
             list_dir=os.path.join(args.root_path, "segmentation", dataset_name),
-            transform=CenterCropGenerator(output_size=[args.img_size, args.img_size]),
+            transform=(ShortSideResizeGenerator if args.tiled else CenterCropGenerator)(
+                output_size=[args.img_size, args.img_size]),
             prompt=args.prompt
         )
-        testloader = DataLoader(db_test, batch_size=1, shuffle=False, num_workers=1)
+        all_cases = [case.strip('\n') for case in db_test.sample_list]
+        results = cache.load('seg', dataset_name) if cache is not None and test_save_path is None else {}
+        missing = [idx for idx, case in enumerate(all_cases) if case not in results]
+        logging.info("{}: {} of {} cases cached".format(dataset_name, len(all_cases) - len(missing), len(all_cases)))
+        # full frames differ in size, so tiled inference collates one frame at a time
+        testloader = DataLoader(Subset(db_test, missing), batch_size=1 if args.tiled else args.batch_size,
+                                shuffle=False, num_workers=1)
         logging.info("{} test iterations per epoch".format(len(testloader)))
         model.eval()
 
-        metric_list = 0.0
-        count_matrix = np.ones((len(db_test), num_classes-1))
         for i_batch, sampled_batch in tqdm(enumerate(testloader)):
-            image, label, case_name = sampled_batch["image"], sampled_batch["label"], sampled_batch['case_name'][0]
+            image, label, case_names = sampled_batch["image"], sampled_batch["label"], sampled_batch['case_name']
             if args.prompt:
-                position_prompt = torch.tensor(np.array(sampled_batch['position_prompt'])).permute([1, 0]).float()
-                task_prompt = torch.tensor(np.array([[1], [0]])).permute([1, 0]).float()
-                type_prompt = torch.tensor(np.array(sampled_batch['type_prompt'])).permute([1, 0]).float()
-                nature_prompt = torch.tensor(np.array(sampled_batch['nature_prompt'])).permute([1, 0]).float()
-                metric_i = omni_seg_test(image, label, model,
-                                         classes=num_classes,
-                                         test_save_path=test_save_path,
-                                         case=case_name,
-                                         prompt=args.prompt,
-                                         type_prompt=type_prompt,
-                                         nature_prompt=nature_prompt,
-                                         position_prompt=position_prompt,
-                                         task_prompt=task_prompt
-                                         )
+                position_prompt, task_prompt, type_prompt, nature_prompt = omni_batch_prompts(
+                    sampled_batch, task_prompt=[[1], [0]])
+                dice, _, has_label = omni_seg_test_batch(image, label, model,
+                                                         classes=num_classes,
+                                                         test_save_path=test_save_path,
+                                                         cases=case_names,
+                                                         prompt=args.prompt,
+                                                         type_prompt=type_prompt,
+                                                         nature_prompt=nature_prompt,
+                                                         position_prompt=position_prompt,
+                                                         task_prompt=task_prompt,
+                                                         tiling=tiling
+                                                         )
             else:
-                metric_i = omni_seg_test(image, label, model,
-                                         classes=num_classes,
-                                         test_save_path=test_save_path,
-                                         case=case_name)
-            zero_label_flag = False
-            for i in range(1, num_classes):
-                if not metric_i[i-1][1]:
-                    count_matrix[i_batch, i-1] = 0
-                    zero_label_flag = True
-            metric_i = [element[0] for element in metric_i]
-            metric_list += np.array(metric_i)
+                dice, _, has_label = omni_seg_test_batch(image, label, model,
+                                                         classes=num_classes,
+                                                         test_save_path=test_save_path,
+                                                         cases=case_names,
+                                                         tiling=tiling)
+            for case_name, dice_i, has_label_i in zip(case_names, dice, has_label):
+                results[case_name] = {'dice': dice_i.tolist(), 'has_label': has_label_i.tolist()}
+        if cache is not None:
+            cache.save('seg', dataset_name, all_cases, results)
+
+        for i_case, case_name in enumerate(all_cases):
             logging.info('idx %d case %s mean_dice %f' %
-                         (i_batch, case_name, np.mean(metric_i, axis=0)))
-            logging.info("This case has zero label: %s" % zero_label_flag)
+                         (i_case, case_name, np.mean(results[case_name]['dice'], axis=0)))
+            logging.info("This case has zero label: %s" % (not all(results[case_name]['has_label'])))
 
-        metric_list = metric_list / (count_matrix.sum(axis=0) + 1e-6)
+        metric_list = omni_seg_summary(results, all_cases)
         for i in range(1, num_classes):
             logging.info('Mean class %d mean_dice %f' % (i, metric_list[i-1]))
         performance = np.mean(metric_list, axis=0)
@@ -149,17 +157,6 @@ def inference(args, model, test_save_path=None):
                 writer.writerow([dataset_name, 'omni_seg@'+args.output_dir, performance,
                                 time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())])
 
-    cls_test_set = [
-        "Appendix",
-        "BUS-BRA",
-        "BUSI",
-        "Fatty-Liver",
-        "private_Liver",
-        "private_Breast_luminal",
-        "private_Breast",
-        "private_Appendix",
-    ]
-
     for dataset_name in cls_test_set:
         if dataset_name == "private_Breast_luminal":
             num_classes = 4
@@ -172,13 +169,15 @@ def inference(args, model, test_save_path=None):
             transform=CenterCropGenerator(output_size=[args.img_size, args.img_size]),
             prompt=args.prompt
         )
+        all_cases = [case.strip('\n') for case in db_test.sample_list]
+        results = cache.load('cls', dataset_name) if cache is not None and test_save_path is None else {}
+        missing = [idx for idx, case in enumerate(all_cases) if case not in results]
+        logging.info("{}: {} of {} cases cached".format(dataset_name, len(all_cases) - len(missing), len(all_cases)))
 
-        testloader = DataLoader(db_test, batch_size=1, shuffle=False, num_workers=1)
+        testloader = DataLoader(Subset(db_test, missing), batch_size=1, shuffle=False, num_workers=1)
         logging.info("{} test iterations per epoch".format(len(testloader)))
         model.eval()
 
-        label_list = []
-        prediction_list = []
         for i_batch, sampled_batch in tqdm(enumerate(testloader)):
             image, label, case_name = sampled_batch["image"], sampled_batch["label"], sampled_batch['case_name'][0]
             if args.prompt:
@@ -199,17 +198,19 @@ def inference(args, model, test_save_path=None):
                 logits = output[1]
 
             prediction = np.argmax(torch.softmax(logits, dim=1).data.cpu().numpy())
-            logging.info('idx %d case %s label: %d predict: %d' % (i_batch, case_name, label, prediction))
-
-            label_list.append(label.numpy())
-            prediction_list.append(prediction)
-
-        label_list = np.array(label_list)
-        prediction_list = np.array(prediction_list)
+            results[case_name] = {'label': int(label), 'prediction': int(prediction)}
+        if cache is not None:
+            cache.save('cls', dataset_name, all_cases, results)
+
+        for i_case, case_name in enumerate(all_cases):
+            logging.info('idx %d case %s label: %d predict: %d' %
+                         (i_case, case_name, results[case_name]['label'], results[case_name]['prediction']))
+        label_list = np.array([results[case]['label'] for case in all_cases])
+        prediction_list = np.array([results[case]['prediction'] for case in all_cases])
         for i in range(num_classes):
             logging.info('class %d acc %f' % (i, accuracy_score(
                 (label_list == i).astype(int), (prediction_list == i).astype(int))))
-        performance = accuracy_score(label_list, prediction_list)
+        performance = omni_cls_summary(results, all_cases)
         logging.info('Testing performance in best val model: acc : %f' % (performance))
 
         with open("exp_out/result.csv", 'a', newline='') as csvfile:
@@ -244,21 +245,7 @@ if __name__ == "__main__":
     if not os.path.exists(snapshot):
         snapshot = snapshot.replace('best_model', 'epoch_'+str(args.max_epochs-1))
 
-    device = torch.device("cuda")
-    model = net.to(device=device)
-    model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
-    torch.distributed.init_process_group(backend="nccl", init_method='env://', world_size=1, rank=0)
-    model = torch.nn.parallel.DistributedDataParallel(model, find_unused_parameters=True)
-
-    import copy
-    pretrained_dict = torch.load(snapshot, map_location=device)
-    full_dict = copy.deepcopy(pretrained_dict)
-    for k, v in pretrained_dict.items():
-        if "module." not in k:
-            full_dict["module."+k] = v
-            del full_dict[k]
-
-    msg = model.load_state_dict(full_dict)
+    msg = load_omni_checkpoint(net, snapshot, map_location=torch.device("cuda"))
 
     print("self trained swin unet", msg)
     snapshot_name = snapshot.split('/')[-1]
@@ -275,4 +262,18 @@ if __name__ == "__main__":
         os.makedirs(test_save_path, exist_ok=True)
     else:
         test_save_path = None
-    inference(args, net, test_save_path)
+    if args.tta != 'none':
+        net = OmniTTA(net, max_views=args.tta_max_views, reduction=args.tta_reduction, **TTA_PRESETS[args.tta])
+        logging.info("test-time augmentation views: %s", net.views)
+
+    cache = None
+    if not args.no_eval_cache:
+        # everything that changes the predictions besides the weights
+        preprocess = dict(cfg=args.cfg, img_size=args.img_size, prompt=args.prompt,
+                          tta=args.tta, tta_max_views=args.tta_max_views, tta_reduction=args.tta_reduction,
+                          tiled=args.tiled, tile_overlap=args.tile_overlap if args.tiled else None)
+        cache = OmniEvalCache(args.eval_cache_dir, snapshot, preprocess, args.root_path)
+        logging.info("evaluation cache: %s", cache.root)
+    inference(args, net, test_save_path, cache=cache)
+    if cache is not None:
+        logging.info("summary of all cached evaluations: %s", write_eval_summary(args.eval_cache_dir))
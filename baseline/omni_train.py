@@ -1,4 +1,5 @@
 import argparse
+import copy
 import os
 import random
 import numpy as np
@@ -7,6 +8,7 @@ import torch.backends.cudnn as cudnn
 from networks.omni_vision_transformer import OmniVisionTransformer as ViT_omni
 from omni_trainer import omni_train
 from config import get_config
+from networks.omni_export import load_omni_checkpoint
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--root_path', type=str,
@@ -53,6 +55,14 @@ parser.add_argument('--pretrain_ckpt', type=str, help='pretrained checkpoint')
 parser.add_argument('--prompt', action='store_true', help='using prompt for training')
 parser.add_argument('--adapter_ft', action='store_true', help='using adapter for fine-tuning')
 
+parser.add_argument('--student-cfg', type=str, default=None, metavar="FILE",
+                    help='distillation mode: train a student with this config against the --teacher_ckpt '
+                    'model built from --cfg, e.g. configs/swin_tiny_patch4_window7_224_student.yaml')
+parser.add_argument('--teacher_ckpt', type=str, help='trained (frozen) teacher checkpoint for distillation')
+parser.add_argument('--distill_alpha', type=float, default=0.5,
+                    help='weight of the distillation loss, 1 - alpha goes to the label loss')
+parser.add_argument('--distill_temperature', type=float, default=2.0, help='softmax temperature of the distillation loss')
+
 
 
 args = parser.parse_args()
@@ -79,6 +89,18 @@ if __name__ == "__main__":
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir, exist_ok=True)
 
+    teacher = None
+    if args.student_cfg is not None:
+        assert args.teacher_ckpt is not None, "--student-cfg needs --teacher_ckpt"
+        teacher = ViT_omni(
+            config,
+            prompt=args.prompt,
+        )
+        load_omni_checkpoint(teacher, args.teacher_ckpt)
+        student_args = copy.copy(args)
+        student_args.cfg = args.student_cfg
+        config = get_config(student_args)
+
     net = ViT_omni(
         config,
         prompt=args.prompt,
@@ -97,4 +119,4 @@ if __name__ == "__main__":
             else:
                 param.requires_grad = False
 
-    omni_train(args, net, args.output_dir)
\ No newline at end of file
+    omni_train(args, net, args.output_dir, teacher=teacher)
\ No newline at end of file
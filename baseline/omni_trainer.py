@@ -1,5 +1,6 @@
 
 import os
+import csv
 import sys
 import random
 import logging
@@ -18,14 +19,17 @@ from torch.utils.tensorboard import SummaryWriter
 
 from utils import DiceLoss
 from datasets.dataset import USdatasetCls, USdatasetSeg
-from datasets.omni_dataset import WeightedRandomSamplerDDP
+from datasets.omni_dataset import WeightedRandomSamplerDDP, DistributedEvalSampler
+from datasets.omni_dataset import seg_test_set, cls_test_set
 from datasets.omni_dataset import USdatasetOmni_cls, USdatasetOmni_seg
 from datasets.dataset import RandomGenerator, CenterCropGenerator
 from sklearn.metrics import roc_auc_score
-from utils import omni_seg_test
+from utils import omni_seg_test_batch, omni_batch_prompts
+from utils import distillation_kl, omni_evaluate, omni_throughput
+from networks.omni_export import load_omni_checkpoint
 
 
-def omni_train(args, model, snapshot_path):
+def omni_train(args, model, snapshot_path, teacher=None):
 
     if args.gpu:
         os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
@@ -130,6 +134,12 @@ def omni_train(args, model, snapshot_path):
 
     model.train()
 
+    # distillation: frozen teacher, its logits are soft targets for seg and both cls heads
+    if teacher is not None:
+        teacher = teacher.to(device=device).eval()
+        for param in teacher.parameters():
+            param.requires_grad = False
+
     seg_ce_loss = CrossEntropyLoss()
     seg_dice_loss = DiceLoss()
     # cls_ce_loss = CrossEntropyLoss()
@@ -157,6 +167,19 @@ def omni_train(args, model, snapshot_path):
     best_performance = 0.0
     best_epoch = 0
 
+    # val sets are built once, each epoch every rank evaluates its shard of them
+    transform_val = CenterCropGenerator(output_size=[args.img_size, args.img_size])
+    db_val_seg = {}
+    for dataset_name in seg_test_set:
+        dataset_dir = os.path.join(args.root_path, "segmentation", dataset_name)
+        db_val_seg[dataset_name] = USdatasetSeg(base_dir=dataset_dir, split="val", list_dir=dataset_dir,
+                                                transform=transform_val, prompt=args.prompt)
+    db_val_cls = {}
+    for dataset_name in cls_test_set:
+        dataset_dir = os.path.join(args.root_path, "classification", dataset_name)
+        db_val_cls[dataset_name] = USdatasetCls(base_dir=dataset_dir, split="val", list_dir=dataset_dir,
+                                                transform=transform_val, prompt=args.prompt)
+
     if int(os.environ["LOCAL_RANK"]) != 0:
         iterator = tqdm(range(resume_epoch, max_epoch), ncols=70, disable=True)
     else:
@@ -180,14 +203,21 @@ def omni_train(args, model, snapshot_path):
                     1, 0]).float().to(device=device)
                 nature_prompt = torch.tensor(np.array(sampled_batch['nature_prompt'])).permute([
                     1, 0]).float().to(device=device)
-                (x_seg, _, _) = model((image_batch, position_prompt, task_prompt, type_prompt, nature_prompt))
+                net_input = (image_batch, position_prompt, task_prompt, type_prompt, nature_prompt)
             else:
-                (x_seg, _, _) = model(image_batch)
+                net_input = image_batch
+            (x_seg, _, _) = model(net_input)
 
             loss_ce = seg_ce_loss(x_seg, label_batch[:].long())
             loss_dice = seg_dice_loss(x_seg, label_batch, softmax=True)
             loss = 0.4 * loss_ce + 0.6 * loss_dice
 
+            if teacher is not None:
+                with torch.no_grad():
+                    (t_seg, _, _) = teacher(net_input)
+                loss_kd = distillation_kl(x_seg, t_seg, args.distill_temperature)
+                loss = (1 - args.distill_alpha) * loss + args.distill_alpha * loss_kd
+
             optimizer.zero_grad()
             loss.backward()
             optimizer.step()
@@ -218,9 +248,13 @@ def omni_train(args, model, snapshot_path):
                     1, 0]).float().to(device=device)
                 nature_prompt = torch.tensor(np.array(sampled_batch['nature_prompt'])).permute([
                     1, 0]).float().to(device=device)
-                (_, x_cls_2, x_cls_4) = model((image_batch, position_prompt, task_prompt, type_prompt, nature_prompt))
+                net_input = (image_batch, position_prompt, task_prompt, type_prompt, nature_prompt)
             else:
-                (_, x_cls_2, x_cls_4) = model(image_batch)
+                net_input = image_batch
+            (_, x_cls_2, x_cls_4) = model(net_input)
+            if teacher is not None:
+                with torch.no_grad():
+                    (_, t_cls_2, t_cls_4) = teacher(net_input)
 
             loss = 0.0
             
@@ -232,6 +266,9 @@ def omni_train(args, model, snapshot_path):
                 outputs_2_way = x_cls_2[mask_2_way]
                 labels_2_way = label_batch[mask_2_way]
                 loss_ce_2 = cls_ce_loss_2way(outputs_2_way, labels_2_way[:].long())
+                if teacher is not None:
+                    loss_kd_2 = distillation_kl(outputs_2_way, t_cls_2[mask_2_way], args.distill_temperature)
+                    loss_ce_2 = (1 - args.distill_alpha) * loss_ce_2 + args.distill_alpha * loss_kd_2
                 loss += loss_ce_2
 
 
@@ -239,6 +276,9 @@ def omni_train(args, model, snapshot_path):
                 outputs_4_way = x_cls_4[mask_4_way]
                 labels_4_way = label_batch[mask_4_way]
                 loss_ce_4 = cls_ce_loss_4way(outputs_4_way, labels_4_way[:].long())
+                if teacher is not None:
+                    loss_kd_4 = distillation_kl(outputs_4_way, t_cls_4[mask_4_way], args.distill_temperature)
+                    loss_ce_4 = (1 - args.distill_alpha) * loss_ce_4 + args.distill_alpha * loss_kd_4
                 loss += loss_ce_4
 
             # loss_ce = cls_ce_loss(x_cls, label_batch[:].long())
@@ -262,9 +302,10 @@ def omni_train(args, model, snapshot_path):
 
         dist.barrier()
 
-        if int(os.environ["LOCAL_RANK"]) == 0:
-            torch.cuda.empty_cache()
+        torch.cuda.empty_cache()
+        val_results = omni_validate(args, model.module, db_val_seg, db_val_cls, device, rank, world_size)
 
+        if int(os.environ["LOCAL_RANK"]) == 0:
             save_dict = {'model': model.state_dict(),
                          'optimizer': optimizer.state_dict(),
                          'epoch': epoch_num}
@@ -275,159 +316,25 @@ def omni_train(args, model, snapshot_path):
             torch.save(save_dict, save_latest_path)
             os.system('ln -s ' + os.path.abspath(save_latest_path) + ' ' + os.path.join(snapshot_path, 'latest.pth'))
 
-            model.eval()
             total_performance = 0.0
 
-            seg_val_set = [
-                "BUS-BRA",
-                "BUSIS",
-                "BUSI",
-                "CAMUS",
-                "DDTI",
-                "Fetal_HC",
-                "KidneyUS",
-                "private_Thyroid",
-                "private_Kidney",
-                "private_Fetal_Head",
-                "private_Cardiac",
-                "private_Breast_luminal",
-                "private_Breast",
-                ]
             seg_avg_performance = 0.0
-
-            for dataset_name in seg_val_set:
-                num_classes = 2
-                db_val = USdatasetSeg(
-                    base_dir=os.path.join(args.root_path,
-                     "segmentation", dataset_name),
-                    split="val",
-                    list_dir=os.path.join(args.root_path, "segmentation", dataset_name),
-                    transform=CenterCropGenerator(output_size=[args.img_size, args.img_size]),
-                    prompt=args.prompt
-                )
-                val_loader = DataLoader(db_val, batch_size=batch_size, shuffle=False, num_workers=16)
-                logging.info("{} val iterations per epoch".format(len(val_loader)))
-
-                metric_list = 0.0
-                count_matrix = np.ones((len(db_val), num_classes-1))
-                for i_batch, sampled_batch in tqdm(enumerate(val_loader)):
-                    image, label = sampled_batch["image"], sampled_batch["label"]
-                    if args.prompt:
-                        position_prompt = torch.tensor(
-                            np.array(sampled_batch['position_prompt'])).permute([1, 0]).float()
-                        task_prompt = torch.tensor(
-                            np.array([[1]*position_prompt.shape[0], [0]*position_prompt.shape[0]])).permute([1, 0]).float()
-                        type_prompt = torch.tensor(np.array(sampled_batch['type_prompt'])).permute([1, 0]).float()
-                        nature_prompt = torch.tensor(np.array(sampled_batch['nature_prompt'])).permute([1, 0]).float()
-                        metric_i = omni_seg_test(image, label, model,
-                                                 classes=num_classes,
-                                                 prompt=args.prompt,
-                                                 type_prompt=type_prompt,
-                                                 nature_prompt=nature_prompt,
-                                                 position_prompt=position_prompt,
-                                                 task_prompt=task_prompt
-                                                 )
-                    else:
-                        metric_i = omni_seg_test(image, label, model,
-                                                 classes=num_classes)
-
-                    for sample_index in range(len(metric_i)):
-                        if not metric_i[sample_index][1]:
-                            count_matrix[i_batch*batch_size+sample_index, 0] = 0
-                    metric_i = [element[0] for element in metric_i]
-                    metric_list += np.array(metric_i).sum()
-
-                metric_list = metric_list / (count_matrix.sum(axis=0) + 1e-6)
-                performance = np.mean(metric_list, axis=0)
-
+            for dataset_name in seg_test_set:
+                performance = val_results[('seg', dataset_name)]
                 writer.add_scalar('info/val_seg_metric_{}'.format(dataset_name), performance, epoch_num)
-
                 seg_avg_performance += performance
 
-            seg_avg_performance = seg_avg_performance / (len(seg_val_set)+1e-6)
+            seg_avg_performance = seg_avg_performance / (len(seg_test_set)+1e-6)
             total_performance += seg_avg_performance
             writer.add_scalar('info/val_metric_seg_Total', seg_avg_performance, epoch_num)
 
-            cls_val_set = [
-                "Appendix",
-                "BUS-BRA",
-                "BUSI",
-                "Fatty-Liver",
-                "private_Liver",
-                "private_Breast_luminal",
-                "private_Breast",
-                "private_Appendix",
-                ]
             cls_avg_performance = 0.0
-
-            for dataset_name in cls_val_set:
-                if dataset_name == "private_Breast_luminal":
-                    num_classes = 4
-                else:
-                    num_classes = 2
-                db_val = USdatasetCls(
-                    base_dir=os.path.join(args.root_path, "classification", dataset_name),
-                    split="val",
-                    list_dir=os.path.join(args.root_path, "classification", dataset_name),
-                    transform=CenterCropGenerator(output_size=[args.img_size, args.img_size]),
-                    prompt=args.prompt
-                )
-
-                val_loader = DataLoader(db_val, batch_size=batch_size, shuffle=False, num_workers=16)
-                logging.info("{} val iterations per epoch".format(len(val_loader)))
-                model.eval()
-
-                label_list = []
-                prediction_prob_list = []
-                for i_batch, sampled_batch in tqdm(enumerate(val_loader)):
-                    image, label = sampled_batch["image"], sampled_batch["label"]
-                    if args.prompt:
-                        position_prompt = torch.tensor(
-                            np.array(sampled_batch['position_prompt'])).permute([1, 0]).float()
-                        task_prompt = torch.tensor(
-                            np.array([[0]*position_prompt.shape[0], [1]*position_prompt.shape[0]])).permute([1, 0]).float()
-                        type_prompt = torch.tensor(np.array(sampled_batch['type_prompt'])).permute([1, 0]).float()
-                        nature_prompt = torch.tensor(np.array(sampled_batch['nature_prompt'])).permute([1, 0]).float()
-                        with torch.no_grad():
-                            output = model((image.cuda(), position_prompt.cuda(), task_prompt.cuda(),
-                                           type_prompt.cuda(), nature_prompt.cuda()))
-                    else:
-                        with torch.no_grad():
-                            output = model(image.cuda())
-
-
-                    if num_classes == 4:
-                        logits = output[2]
-                    else:
-                        logits = output[1]
-
-                    output_prob = torch.softmax(logits, dim=0).data.cpu().numpy()
-
-                    label_list.append(label.numpy())
-                    prediction_prob_list.append(output_prob)
-
-                # label_list = np.expand_dims(np.concatenate(
-                #     (np.array(label_list[:-1]).flatten(), np.array(label_list[-1]).flatten())), axis=1).astype('uint8')
-                # label_list_OneHot = np.eye(num_classes)[label_list].squeeze(1)
-                # performance = roc_auc_score(label_list_OneHot, np.concatenate(
-                #     (np.array(prediction_prob_list[:-1]).reshape(-1, 2), prediction_prob_list[-1])), multi_class='ovo')
-                
-
-
-                label_list = np.expand_dims(np.concatenate(
-                    (np.array(label_list[:-1]).flatten(), np.array(label_list[-1]).flatten())), axis=1).astype('uint8')
-                label_list_OneHot = np.eye(num_classes)[label_list].squeeze(1)
-                
-                prediction_probs_reshaped = np.array(prediction_prob_list[:-1]).reshape(-1, num_classes)
-                all_prediction_probs = np.concatenate((prediction_probs_reshaped, prediction_prob_list[-1]))
-
-                performance = roc_auc_score(label_list_OneHot, all_prediction_probs, multi_class='ovo')
-
+            for dataset_name in cls_test_set:
+                performance = val_results[('cls', dataset_name)]
                 writer.add_scalar('info/val_cls_metric_{}'.format(dataset_name), performance, epoch_num)
-
                 cls_avg_performance += performance
 
-            cls_avg_performance = cls_avg_performance / (len(cls_val_set)+1e-6)
+            cls_avg_performance = cls_avg_performance / (len(cls_test_set)+1e-6)
             total_performance += cls_avg_performance
             writer.add_scalar('info/val_metric_cls_Total', cls_avg_performance, epoch_num)
 
@@ -453,5 +360,111 @@ def omni_train(args, model, snapshot_path):
 
         model.train()
 
+    if teacher is not None and int(os.environ["LOCAL_RANK"]) == 0:
+        distill_report(args, teacher, model.module, snapshot_path, device)
+
     writer.close()
     return "Training Finished!"
+
+
+
+def omni_validate(args, net, db_val_seg, db_val_cls, device, rank, world_size):
+    """
+    Distributed validation: every rank evaluates a disjoint shard (DistributedEvalSampler,
+    no padding) of each val set, then per-sample Dice and class probabilities are
+    all-gathered so rank 0 computes the exact per-dataset Dice and ROC AUC.
+
+    `net` is the bare model (model.module), so ranks can run different numbers of batches.
+    Returns {('seg' | 'cls', dataset_name): metric} on rank 0 and None on the other ranks.
+    """
+    net.eval()
+    local_results = {}
+
+    for dataset_name, db_val in db_val_seg.items():
+        num_classes = 2
+        val_loader = DataLoader(db_val, batch_size=args.batch_size, num_workers=4, pin_memory=True,
+                                sampler=DistributedEvalSampler(db_val, num_replicas=world_size, rank=rank))
+        dice_list = [np.zeros((0, num_classes-1))]
+        has_label_list = [np.zeros((0, num_classes-1), dtype=bool)]
+        for sampled_batch in val_loader:
+            image, label = sampled_batch["image"], sampled_batch["label"]
+            prompt_kwargs = {}
+            if args.prompt:
+                position_prompt, task_prompt, type_prompt, nature_prompt = omni_batch_prompts(
+                    sampled_batch, task_prompt=[[1], [0]])
+                prompt_kwargs = dict(prompt=True, type_prompt=type_prompt, nature_prompt=nature_prompt,
+                                     position_prompt=position_prompt, task_prompt=task_prompt)
+            dice, _, has_label = omni_seg_test_batch(image, label, net, classes=num_classes,
+                                                     device=device, **prompt_kwargs)
+            dice_list.append(dice)
+            has_label_list.append(has_label)
+        local_results[('seg', dataset_name)] = (np.concatenate(dice_list), np.concatenate(has_label_list))
+
+    for dataset_name, db_val in db_val_cls.items():
+        num_classes = 4 if dataset_name == "private_Breast_luminal" else 2
+        val_loader = DataLoader(db_val, batch_size=args.batch_size, num_workers=4, pin_memory=True,
+                                sampler=DistributedEvalSampler(db_val, num_replicas=world_size, rank=rank))
+        prob_list = [np.zeros((0, num_classes))]
+        label_list = [np.zeros(0, dtype=np.int64)]
+        for sampled_batch in val_loader:
+            image, label = sampled_batch["image"], sampled_batch["label"]
+            if args.prompt:
+                net_input = tuple(t.to(device) for t in
+                                  (image,) + omni_batch_prompts(sampled_batch, task_prompt=[[0], [1]]))
+            else:
+                net_input = image.to(device)
+            with torch.no_grad():
+                output = net(net_input)
+            logits = output[2] if num_classes == 4 else output[1]
+            prob_list.append(torch.softmax(logits, dim=1).cpu().numpy())
+            label_list.append(label.numpy().astype(np.int64).ravel())
+        local_results[('cls', dataset_name)] = (np.concatenate(prob_list), np.concatenate(label_list))
+
+    gathered_results = [None] * world_size
+    dist.all_gather_object(gathered_results, local_results)
+    if rank != 0:
+        return None
+
+    val_results = {}
+    for key in local_results:
+        first, second = [np.concatenate(element) for element in zip(*[shard[key] for shard in gathered_results])]
+        if key[0] == 'seg':
+            dice, has_label = first, second
+            val_results[key] = float(np.mean(dice.sum(axis=0) / (has_label.sum(axis=0) + 1e-6)))
+        else:
+            probs, labels = first, second
+            label_one_hot = np.eye(probs.shape[1])[labels]
+            val_results[key] = roc_auc_score(label_one_hot, probs, multi_class='ovo')
+    return val_results
+
+
+def distill_report(args, teacher, student, snapshot_path, device):
+    """
+    Throughput vs. Dice/accuracy of the teacher and the best student checkpoint, per val
+    dataset, written to <snapshot_path>/distill_report.csv.
+    """
+    best_model_path = os.path.join(snapshot_path, 'best_model.pth')
+    if os.path.exists(best_model_path):
+        load_omni_checkpoint(student, best_model_path, map_location=device)
+    nets = {'teacher': teacher, 'student': student}
+
+    throughput = {name: omni_throughput(net, args.img_size, batch_size=args.batch_size,
+                                        prompt=args.prompt, device=device)
+                  for name, net in nets.items()}
+    results = omni_evaluate(nets, args.root_path, split='val', img_size=args.img_size,
+                            prompt=args.prompt, device=device)
+
+    report_path = os.path.join(snapshot_path, 'distill_report.csv')
+    with open(report_path, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['task', 'dataset', 'teacher', 'student', 'delta'])
+        writer.writerow(['throughput', 'images/s', throughput['teacher'], throughput['student'],
+                         throughput['student'] - throughput['teacher']])
+        logging.info('throughput (images/s): teacher %f student %f speedup %.2fx',
+                     throughput['teacher'], throughput['student'], throughput['student'] / throughput['teacher'])
+        for key in results['teacher']:
+            teacher_metric, student_metric = results['teacher'][key], results['student'][key]
+            writer.writerow([key[0], key[1], teacher_metric, student_metric, student_metric - teacher_metric])
+            logging.info('%s %s teacher %f student %f delta %f', key[0], key[1],
+                         teacher_metric, student_metric, student_metric - teacher_metric)
+    logging.info("distillation report written to {}".format(report_path))
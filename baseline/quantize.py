@@ -0,0 +1,138 @@
+import argparse
+import csv
+import logging
+import os
+import random
+import sys
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, ConcatDataset, Subset
+
+from config import get_config
+from datasets.dataset import CenterCropGenerator
+from datasets.omni_dataset import USdatasetOmni_cls, USdatasetOmni_seg
+from utils import omni_batch_prompts, omni_throughput, omni_evaluate
+from networks.omni_vision_transformer import OmniVisionTransformer as ViT_omni
+from networks.omni_export import load_omni_checkpoint, export_torchscript
+from networks.omni_quant import select_quantized_engine, quantize_dynamic_linear, quantize_static_linear
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--root_path', type=str,
+                    default='data/', help='root dir for data')
+parser.add_argument('--output_dir', type=str, help='experiment dir holding best_model.pth')
+parser.add_argument('--snapshot', type=str, default=None, help='checkpoint to quantize, default <output_dir>/best_model.pth')
+parser.add_argument('--save_path', type=str, default=None, help='artifact path, default <output_dir>/omni_int8.pt')
+parser.add_argument('--mode', type=str, default='dynamic', choices=['dynamic', 'static'],
+                    help='dynamic: int8 weights, activations quantized per batch; '
+                    'static: int8 weights and calibrated activation scales')
+parser.add_argument('--calib_samples', type=int, default=256, help='training samples used for static calibration')
+parser.add_argument('--calib_batch_size', type=int, default=16, help='batch size for static calibration')
+parser.add_argument('--num_threads', type=int, default=0, help='torch CPU threads, 0 keeps the default')
+parser.add_argument('--bench_iters', type=int, default=20, help='iterations of the CPU latency benchmark')
+parser.add_argument('--skip_eval', action='store_true', help='skip the per-dataset Dice/accuracy comparison')
+parser.add_argument('--img_size', type=int, default=224, help='input patch size of network input')
+parser.add_argument('--seed', type=int, default=1234, help='random seed')
+parser.add_argument('--cfg', type=str, default="configs/swin_tiny_patch4_window7_224_lite.yaml",
+                    metavar="FILE", help='path to config file', )
+parser.add_argument(
+    "--opts",
+    help="Modify config options by adding 'KEY VALUE' pairs. ",
+    default=None,
+    nargs='+',
+)
+parser.add_argument('--zip', action='store_true', help='use zipped dataset instead of folder dataset')
+parser.add_argument('--cache-mode', type=str, default='part', choices=['no', 'full', 'part'],
+                    help='no: no cache, '
+                    'full: cache all data, '
+                    'part: sharding the dataset into nonoverlapping pieces and only cache one piece')
+parser.add_argument('--resume', help='resume from checkpoint')
+parser.add_argument('--accumulation-steps', type=int, help="gradient accumulation steps")
+parser.add_argument('--use-checkpoint', action='store_true',
+                    help="whether to use gradient checkpointing to save memory")
+parser.add_argument('--amp-opt-level', type=str, default='O1', choices=['O0', 'O1', 'O2'],
+                    help='mixed precision opt level, if O0, no amp is used')
+parser.add_argument('--tag', help='tag of experiment')
+parser.add_argument('--eval', action='store_true', help='Perform evaluation only')
+parser.add_argument('--throughput', action='store_true', help='Test throughput only')
+
+parser.add_argument('--prompt', action='store_true', help='using prompt')
+
+args = parser.parse_args()
+config = get_config(args)
+
+
+def calibration_forward(model, sampled_batch):
+    if args.prompt:
+        model((sampled_batch['image'],) + omni_batch_prompts(sampled_batch))
+    else:
+        model(sampled_batch['image'])
+
+
+def calibration_loader():
+    """Random subset of the training manifest (both tasks), center cropped like at test time."""
+    transform = CenterCropGenerator(output_size=[args.img_size, args.img_size])
+    db_seg = USdatasetOmni_seg(base_dir=args.root_path, split="train", transform=transform, prompt=args.prompt)
+    db_cls = USdatasetOmni_cls(base_dir=args.root_path, split="train", transform=transform, prompt=args.prompt)
+    db_calib = ConcatDataset([db_seg, db_cls])
+    indices = random.sample(range(len(db_calib)), min(args.calib_samples, len(db_calib)))
+    # seg and cls samples carry different keys, so calibrate on one task per batch
+    seg_indices = [i for i in indices if i < len(db_seg)]
+    cls_indices = [i - len(db_seg) for i in indices if i >= len(db_seg)]
+    loaders = []
+    for db, sub_indices in [(db_seg, seg_indices), (db_cls, cls_indices)]:
+        if len(sub_indices) > 0:
+            loaders.append(DataLoader(Subset(db, sub_indices), batch_size=args.calib_batch_size,
+                                      shuffle=False, num_workers=4))
+    for loader in loaders:
+        for sampled_batch in loader:
+            yield sampled_batch
+
+
+if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO,
+                        format='[%(asctime)s.%(msecs)03d] %(message)s', datefmt='%H:%M:%S')
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    net = ViT_omni(
+        config,
+        prompt=args.prompt,
+    )
+    snapshot = args.snapshot or os.path.join(args.output_dir, 'best_model.pth')
+    msg = load_omni_checkpoint(net, snapshot, map_location='cpu')
+    logging.info("load %s: %s", snapshot, msg)
+    net.eval()
+
+    engine = select_quantized_engine()
+    logging.info("quantized engine: %s", engine)
+    if args.mode == 'dynamic':
+        qnet = quantize_dynamic_linear(net)
+    else:
+        qnet = quantize_static_linear(net, calibration_loader(), calibration_forward)
+
+    fp32_latency = 1.0 / omni_throughput(net, args.img_size, prompt=args.prompt, device='cpu', iters=args.bench_iters)
+    int8_latency = 1.0 / omni_throughput(qnet, args.img_size, prompt=args.prompt, device='cpu', iters=args.bench_iters)
+    logging.info("CPU latency per image: fp32 %.1f ms, int8 %.1f ms, speedup %.2fx",
+                 fp32_latency * 1000, int8_latency * 1000, fp32_latency / int8_latency)
+
+    if not args.skip_eval:
+        results = omni_evaluate({'fp32': net, 'int8': qnet}, args.root_path, split='test',
+                                img_size=args.img_size, prompt=args.prompt, device='cpu')
+        report_path = os.path.join(args.output_dir, 'quantization_report.csv')
+        with open(report_path, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(['task', 'dataset', 'fp32', 'int8', 'delta'])
+            for key in results['fp32']:
+                fp32_metric, int8_metric = results['fp32'][key], results['int8'][key]
+                writer.writerow([key[0], key[1], fp32_metric, int8_metric, int8_metric - fp32_metric])
+                logging.info('%s %s fp32 %f int8 %f delta %f', key[0], key[1],
+                             fp32_metric, int8_metric, int8_metric - fp32_metric)
+        logging.info("report written to %s", report_path)
+
+    save_path = args.save_path or os.path.join(args.output_dir, 'omni_int8.pt')
+    meta = export_torchscript(qnet, save_path, img_size=args.img_size)
+    logging.info("exported %s %s", save_path, meta)
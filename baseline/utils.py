@@ -1,8 +1,16 @@
+import csv
+import glob
+import hashlib
+import json
+import os
+import time
 import numpy as np
 import torch
 from medpy import metric
 import torch.nn as nn
+from torch.utils.data import DataLoader
 import cv2
+from networks.omni_tiling import sliding_window_seg
 
 
 class DiceLoss(nn.Module):
@@ -44,6 +52,18 @@ class DiceLoss(nn.Module):
         return loss / self.n_classes
 
 
+def distillation_kl(student_logits, teacher_logits, temperature=1.0):
+    """
+    KL(teacher || student) of the temperature-softened class distributions (dim 1), averaged
+    over samples and pixels and scaled by T^2 so its gradient does not shrink with T.
+    Works for seg logits [B, C, H, W] and cls logits [B, C].
+    """
+    student_log_prob = torch.log_softmax(student_logits / temperature, dim=1)
+    teacher_log_prob = torch.log_softmax(teacher_logits / temperature, dim=1)
+    kl = torch.sum(teacher_log_prob.exp() * (teacher_log_prob - student_log_prob), dim=1)
+    return kl.mean() * temperature ** 2
+
+
 def calculate_metric_percase(pred, gt):
     pred[pred > 0] = 1
     gt[gt > 0] = 1
@@ -63,16 +83,17 @@ def omni_seg_test(image, label, net, classes, ClassStartIndex=1, test_save_path=
                   type_prompt=None,
                   nature_prompt=None,
                   position_prompt=None,
-                  task_prompt=None
+                  task_prompt=None,
+                  device='cuda'
                   ):
     label = label.squeeze(0).cpu().detach().numpy()
     image_save = image.squeeze(0).cpu().detach().numpy()
-    input = image.cuda()
+    input = image.to(device)
     if prompt:
-        position_prompt = position_prompt.cuda()
-        task_prompt = task_prompt.cuda()
-        type_prompt = type_prompt.cuda()
-        nature_prompt = nature_prompt.cuda()
+        position_prompt = position_prompt.to(device)
+        task_prompt = task_prompt.to(device)
+        type_prompt = type_prompt.to(device)
+        nature_prompt = nature_prompt.to(device)
     net.eval()
     with torch.no_grad():
         if prompt:
@@ -94,3 +115,274 @@ def omni_seg_test(image, label, net, classes, ClassStartIndex=1, test_save_path=
         cv2.imwrite(test_save_path + '/'+case + "_img.png", ((image.squeeze(0))*255).astype(np.uint8))
         cv2.imwrite(test_save_path + '/'+case + "_gt.png", (label*255).astype(np.uint8))
     return metric_list
+
+
+def calculate_metric_batch(pred, gt):
+    """
+    Batched, on-device `calculate_metric_percase`.
+
+    Args:
+        pred, gt: [B, ...] tensors, nonzero is foreground.
+
+    Returns dice [B], iou [B] and has_label [B] (bool). Dice/IoU are 0 unless both the
+    prediction and the label are non-empty, has_label is True iff the label is non-empty,
+    same as the (dice, has_label) pairs of `calculate_metric_percase`.
+    """
+    pred = (pred > 0).flatten(1)
+    gt = (gt > 0).flatten(1)
+    pred_sum = pred.sum(1).float()
+    gt_sum = gt.sum(1).float()
+    intersection = (pred & gt).sum(1).float()
+    both = (pred_sum > 0) & (gt_sum > 0)
+    dice = torch.where(both, 2.0 * intersection / (pred_sum + gt_sum).clamp(min=1), torch.zeros_like(pred_sum))
+    iou = torch.where(both, intersection / (pred_sum + gt_sum - intersection).clamp(min=1), torch.zeros_like(pred_sum))
+    return dice, iou, gt_sum > 0
+
+
+def omni_seg_test_batch(image, label, net, classes, ClassStartIndex=1, test_save_path=None, cases=None,
+                        prompt=False,
+                        type_prompt=None,
+                        nature_prompt=None,
+                        position_prompt=None,
+                        task_prompt=None,
+                        device='cuda',
+                        tiling=None
+                        ):
+    """
+    `omni_seg_test` for a whole batch: one forward, argmax and metrics on `device`.
+
+    `tiling`: sliding_window_seg kwargs (tile_size, overlap, tile_batch_size) to segment frames
+    larger than the training size with Gaussian-blended overlapping windows instead.
+
+    Returns numpy arrays dice, iou and has_label of shape [B, classes-1].
+    """
+    input = image.to(device)
+    label = label.to(device)
+    net.eval()
+    with torch.no_grad():
+        prompts = ()
+        if prompt:
+            prompts = (position_prompt.to(device), task_prompt.to(device),
+                       type_prompt.to(device), nature_prompt.to(device))
+        if tiling is not None:
+            seg_out = sliding_window_seg(net, input, prompts, **tiling)
+        elif prompt:
+            seg_out = net((input,) + prompts)[0]
+        else:
+            seg_out = net(input)[0]
+        out_label_back_transform = torch.cat(
+            [seg_out[:, 0:1], seg_out[:, ClassStartIndex:ClassStartIndex+classes-1]], axis=1)
+        prediction = torch.argmax(out_label_back_transform, dim=1)  # softmax does not change the argmax
+
+        metric_list = [calculate_metric_batch(prediction == i, label == i) for i in range(1, classes)]
+        dice, iou, has_label = [torch.stack(metric, dim=1).cpu().numpy() for metric in zip(*metric_list)]
+
+    if test_save_path is not None:
+        prediction = prediction.cpu().numpy()
+        label = label.cpu().numpy()
+        image_save = image.cpu().numpy()
+        for b, case in enumerate(cases):
+            image_b = (image_save[b] - np.min(image_save[b])) / (np.max(image_save[b]) - np.min(image_save[b]))
+            cv2.imwrite(test_save_path + '/'+case + "_pred.png", (prediction[b]*255).astype(np.uint8))
+            cv2.imwrite(test_save_path + '/'+case + "_img.png", ((image_b.squeeze(0))*255).astype(np.uint8))
+            cv2.imwrite(test_save_path + '/'+case + "_gt.png", ((label[b] > 0)*255).astype(np.uint8))
+    return dice, iou, has_label
+
+
+def omni_batch_prompts(sampled_batch, task_prompt=None):
+    """
+    Collated prompt lists -> [B, N] float tensors (position, task, type, nature).
+
+    `task_prompt` overrides the batch task prompt, e.g. [[1], [0]] for segmentation on the
+    per-dataset loaders which do not carry one.
+    """
+    def to_tensor(prompt):
+        return torch.tensor(np.array(prompt)).permute([1, 0]).float()
+
+    position_prompt = to_tensor(sampled_batch['position_prompt'])
+    if task_prompt is None:
+        task_prompt = sampled_batch['task_prompt']
+    elif len(task_prompt[0]) != position_prompt.shape[0]:
+        task_prompt = [row * position_prompt.shape[0] for row in task_prompt]
+    return (position_prompt, to_tensor(task_prompt),
+            to_tensor(sampled_batch['type_prompt']), to_tensor(sampled_batch['nature_prompt']))
+
+
+def omni_throughput(net, img_size=224, batch_size=1, prompt=False, device='cuda', iters=20):
+    """Images per second of `net` on random [batch_size, 1, img_size, img_size, 3] inputs."""
+    image = torch.rand(batch_size, 1, img_size, img_size, 3, device=device)
+    if prompt:
+        prompts = tuple(torch.zeros(batch_size, n, device=device) for n in (8, 2, 3, 2))
+        net_input = (image,) + prompts
+    else:
+        net_input = image
+    synchronize = torch.cuda.synchronize if torch.device(device).type == 'cuda' else (lambda: None)
+    net.eval()
+    with torch.no_grad():
+        net(net_input)
+        synchronize()
+        start = time.time()
+        for _ in range(iters):
+            net(net_input)
+        synchronize()
+    return iters * batch_size / (time.time() - start)
+
+
+def omni_evaluate(nets, root_path, split='test', img_size=224, prompt=False, device='cuda', batch_size=16):
+    """
+    Dice per segmentation dataset and accuracy per classification dataset for every net in
+    `nets` ({name: net}), with one pass over the data (segmentation in batches of `batch_size`).
+
+    Returns {name: {('seg' | 'cls', dataset_name): metric}}.
+    """
+    from datasets.dataset import CenterCropGenerator, USdatasetCls, USdatasetSeg
+    from datasets.omni_dataset import seg_test_set, cls_test_set
+
+    results = {name: {} for name in nets}
+    transform = CenterCropGenerator(output_size=[img_size, img_size])
+
+    for dataset_name in seg_test_set:
+        dataset_dir = os.path.join(root_path, "segmentation", dataset_name)
+        db_test = USdatasetSeg(base_dir=dataset_dir, split=split, list_dir=dataset_dir,
+                               transform=transform, prompt=prompt)
+        testloader = DataLoader(db_test, batch_size=batch_size, shuffle=False, num_workers=1)
+        dice_sum = {name: 0.0 for name in nets}
+        count = {name: 0 for name in nets}
+        for sampled_batch in testloader:
+            image, label = sampled_batch["image"], sampled_batch["label"]
+            prompt_kwargs = {}
+            if prompt:
+                position_prompt, task_prompt, type_prompt, nature_prompt = omni_batch_prompts(
+                    sampled_batch, task_prompt=[[1], [0]])
+                prompt_kwargs = dict(prompt=True, type_prompt=type_prompt, nature_prompt=nature_prompt,
+                                     position_prompt=position_prompt, task_prompt=task_prompt)
+            for name, net in nets.items():
+                dice, _, has_label = omni_seg_test_batch(image, label, net, classes=2, device=device, **prompt_kwargs)
+                dice_sum[name] += dice.sum()
+                count[name] += has_label.sum()
+        for name in nets:
+            results[name][('seg', dataset_name)] = float(dice_sum[name] / (count[name] + 1e-6))
+
+    for dataset_name in cls_test_set:
+        num_classes = 4 if dataset_name == "private_Breast_luminal" else 2
+        dataset_dir = os.path.join(root_path, "classification", dataset_name)
+        db_test = USdatasetCls(base_dir=dataset_dir, split=split, list_dir=dataset_dir,
+                               transform=transform, prompt=prompt)
+        testloader = DataLoader(db_test, batch_size=1, shuffle=False, num_workers=1)
+        label_list = []
+        prediction_list = {name: [] for name in nets}
+        for sampled_batch in testloader:
+            image, label = sampled_batch["image"], sampled_batch["label"]
+            if prompt:
+                net_input = (image,) + omni_batch_prompts(sampled_batch, task_prompt=[[0], [1]])
+            else:
+                net_input = image
+            net_input = tuple(t.to(device) for t in net_input) if prompt else net_input.to(device)
+            label_list.append(label.item())
+            for name, net in nets.items():
+                net.eval()
+                with torch.no_grad():
+                    output = net(net_input)
+                logits = output[2] if num_classes == 4 else output[1]
+                prediction_list[name].append(int(torch.argmax(logits, dim=1).item()))
+        for name in nets:
+            results[name][('cls', dataset_name)] = float(np.mean(np.array(label_list) == np.array(prediction_list[name])))
+
+    return results
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    """Hex sha256 of a file's content, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class OmniEvalCache(object):
+    """
+    Per-sample evaluation results on disk, keyed by (checkpoint content hash, preprocessing config,
+    data root, dataset).
+
+    <cache_dir>/<checkpoint hash>/<config hash>/<task>_<dataset>.json holds the case list of the last
+    run and {case_name: result} of every case evaluated so far, seg results are per-class dice and
+    has_label, cls results label and prediction. The config hash covers the preprocessing and the
+    absolute data root, so another data root with the same dataset and case names is not served
+    from the cache. Re-running the same checkpoint, config and data only evaluates cases missing
+    from the cache.
+    """
+    def __init__(self, cache_dir, checkpoint_path, preprocess, data_root):
+        self.cache_dir = cache_dir
+        self.checkpoint_hash = file_sha256(checkpoint_path)[:16]
+        data_root = os.path.abspath(data_root)
+        config_hash = hashlib.sha256(json.dumps({'preprocess': preprocess, 'data_root': data_root},
+                                                sort_keys=True).encode()).hexdigest()[:16]
+        self.root = os.path.join(cache_dir, self.checkpoint_hash, config_hash)
+        os.makedirs(self.root, exist_ok=True)
+        self._write(os.path.join(self.root, 'config.json'),
+                    {'checkpoint': checkpoint_path, 'checkpoint_sha256': self.checkpoint_hash, 'preprocess': preprocess,
+                     'data_root': data_root})
+
+    @staticmethod
+    def _write(path, content):
+        # write then rename, an interrupted run never leaves a truncated cache file
+        with open(path + '.tmp', 'w') as f:
+            json.dump(content, f)
+        os.replace(path + '.tmp', path)
+
+    def _path(self, task, dataset_name):
+        return os.path.join(self.root, '%s_%s.json' % (task, dataset_name))
+
+    def load(self, task, dataset_name):
+        path = self._path(task, dataset_name)
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return json.load(f)['results']
+
+    def save(self, task, dataset_name, case_names, results):
+        self._write(self._path(task, dataset_name), {'cases': list(case_names), 'results': results})
+
+
+def omni_seg_summary(results, case_names):
+    """Mean dice of each foreground class over the labelled cases, as omni_test reports it."""
+    dice = np.array([results[case]['dice'] for case in case_names], dtype=np.float64)
+    has_label = np.array([results[case]['has_label'] for case in case_names], dtype=np.float64)
+    return dice.sum(axis=0) / (has_label.sum(axis=0) + 1e-6)
+
+
+def omni_cls_summary(results, case_names):
+    """Accuracy over the cases."""
+    return float(np.mean([results[case]['label'] == results[case]['prediction'] for case in case_names]))
+
+
+def write_eval_summary(cache_dir, csv_path=None):
+    """
+    Rebuild the summary CSV (default <cache_dir>/summary.csv) from every cached checkpoint/config:
+    one row per dataset with its metric over the case list of the last run.
+    """
+    csv_path = csv_path or os.path.join(cache_dir, 'summary.csv')
+    rows = []
+    for config_path in sorted(glob.glob(os.path.join(cache_dir, '*', '*', 'config.json'))):
+        with open(config_path) as f:
+            config = json.load(f)
+        for result_path in sorted(glob.glob(os.path.join(os.path.dirname(config_path), '*_*.json'))):
+            if result_path == config_path:
+                continue
+            task, dataset_name = os.path.basename(result_path)[:-len('.json')].split('_', 1)
+            with open(result_path) as f:
+                cached = json.load(f)
+            if task == 'seg':
+                performance = float(np.mean(omni_seg_summary(cached['results'], cached['cases'])))
+            else:
+                performance = omni_cls_summary(cached['results'], cached['cases'])
+            rows.append([dataset_name, task, performance, len(cached['cases']),
+                         config['checkpoint'], config['checkpoint_sha256'], json.dumps(config['preprocess'], sort_keys=True),
+                         config.get('data_root', '')])
+    with open(csv_path, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['dataset', 'task', 'metric', 'num_cases', 'checkpoint', 'checkpoint_sha256', 'preprocess',
+                         'data_root'])
+        writer.writerows(rows)
+    return csv_path
@@ -17,10 +17,14 @@ class SAMUSAdapter(nn.Module):
     """
     SAMUS 模型适配器，用于适配 baseline 的接口
     """
-    def __init__(self, config, prompt=False):
+    def __init__(self, config, prompt=False, micro_batch_size=None):
         super().__init__()
         self.config = config
         self.prompt = prompt
+        # 每次前向的最大图像数（显存上限），None 时取配置，0 表示整批一次前向
+        if micro_batch_size is None:
+            micro_batch_size = getattr(getattr(config, 'SAMUS', None), 'MICRO_BATCH_SIZE', 0)
+        self.micro_batch_size = micro_batch_size
         
         # 创建 SAMUS 参数对象
         self.samus_args = self.create_samus_args()
@@ -299,14 +303,18 @@ class SAMUSAdapter(nn.Module):
         # 使用混合精度训练
         # with torch.cuda.amp.autocast():
         try:
-            samus_output = self.samus_model(image_batch)
-            
-            if isinstance(samus_output, dict):
-                seg_features = samus_output.get('masks', list(samus_output.values())[0])
-            elif isinstance(samus_output, tuple):
-                seg_features = samus_output[0]
-            else:
-                seg_features = samus_output
+            chunk_size = self.micro_batch_size or batch_size
+            seg_features_list = []
+            for i in range(0, batch_size, chunk_size):
+                samus_output = self.samus_model(image_batch[i:i + chunk_size])
+                
+                if isinstance(samus_output, dict):
+                    seg_features_list.append(samus_output.get('masks', list(samus_output.values())[0]))
+                elif isinstance(samus_output, tuple):
+                    seg_features_list.append(samus_output[0])
+                else:
+                    seg_features_list.append(samus_output)
+            seg_features = torch.cat(seg_features_list, dim=0)
                 
         except torch.cuda.OutOfMemoryError:
             # 如果仍然内存不足，降级到逐张处理
@@ -83,6 +83,8 @@ _C.SAMUS.ENCODER_INPUT_SIZE = 224
 _C.SAMUS.LOW_IMAGE_SIZE = 128
 _C.SAMUS.VIT_NAME = 'vit_b'
 _C.SAMUS.SAM_CKPT = ''
+# 每次送入 SAMUS 的图像数，0 表示整批一次前向
+_C.SAMUS.MICRO_BATCH_SIZE = 0
 
 # -----------------------------------------------------------------------------
 # Training settings
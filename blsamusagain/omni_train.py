@@ -52,12 +52,16 @@ class SAMUSAdapter(nn.Module):
     """
     SAMUS 模型适配器 - 内存优化版本
     """
-    def __init__(self, config, prompt=False):
+    def __init__(self, config, prompt=False, micro_batch_size=None):
         super().__init__()
         print("初始化 SAMUSAdapter...")
         
         self.config = config
         self.prompt = prompt
+        # 每次前向的最大图像数（显存上限），None 时取配置，0 表示整批一次前向
+        if micro_batch_size is None:
+            micro_batch_size = getattr(getattr(config, 'SAMUS', None), 'MICRO_BATCH_SIZE', 0)
+        self.micro_batch_size = micro_batch_size
         
         # 创建 SAMUS 参数对象
         print("创建 SAMUS 参数...")
@@ -170,24 +174,26 @@ class SAMUSAdapter(nn.Module):
         return image_batch, batch_size
     
     def forward(self, x):
-        """前向传播 - 内存优化版本"""
+        """前向传播 - 整批前向，micro_batch_size 限制显存"""
         # 预处理输入
         image_batch, batch_size = self.preprocess_input(x)
         
-        # 逐张处理以节省内存
+        # 整批（或按 micro_batch_size 分块）送入 SAMUS
         seg_features_list = []
+        chunk_size = self.micro_batch_size or batch_size
         
-        for i in range(batch_size):
-            single_img = image_batch[i:i+1]
+        for i in range(0, batch_size, chunk_size):
+            image_chunk = image_batch[i:i + chunk_size]
             
-            # 处理单张图像
             try:
-                # 使用 SAMUS 模型处理单张图像
                 with torch.amp.autocast('cuda', enabled=False):  # 暂时禁用混合精度
-                    samus_output = self.samus_model(single_img)
+                    samus_output = self.samus_model(image_chunk)
                 
                 # 处理 SAMUS 输出
-                if isinstance(samus_output, dict):
+                if hasattr(samus_output, 'upsample'):
+                    # 低分辨率 logits 只上采样一次, 直接到 seg_head 的输入尺寸
+                    seg_features = samus_output.upsample((224, 224))
+                elif isinstance(samus_output, dict):
                     if 'masks' in samus_output:
                         seg_features = samus_output['masks']
                     elif 'pred_masks' in samus_output:
@@ -226,13 +232,10 @@ class SAMUSAdapter(nn.Module):
                 seg_features_list.append(seg_features)
                 
             except Exception as e:
-                print(f"处理第 {i} 张图像时出错: {e}")
+                print(f"处理第 {i}-{i + image_chunk.shape[0] - 1} 张图像时出错: {e}")
                 # 创建零填充的特征
-                dummy_features = torch.zeros(1, 256, 224, 224, dtype=torch.float32).to(single_img.device)
+                dummy_features = torch.zeros(image_chunk.shape[0], 256, 224, 224, dtype=torch.float32).to(image_chunk.device)
                 seg_features_list.append(dummy_features)
-            
-            # 清理内存
-            torch.cuda.empty_cache()
         
         # 合并特征
         seg_features = torch.cat(seg_features_list, dim=0)